@@ -0,0 +1,98 @@
+"""
+Measures latency of box-only requests ("masks": "none", see container_serving/request_options.py)
+against full Mask R-CNN requests at several instance counts. Both modes run the same loaded
+model, box-only skips the ROI mask head, mask pasting and RLE encoding.
+
+Instance count is forced by setting score threshold of the box predictor to 0 and its
+detections per image to the count, so that every image returns exactly that many instances.
+Latency covers run_batch() and d2_to_json(), i.e. predict_fn and output_fn of the handlers.
+Output includes torch version, threads and model, so that recorded results can be compared.
+
+Sample command:
+    python benchmarks/bench_box_only.py --config config.yaml --weights model.pth --instances 10 50 100
+"""
+
+import argparse
+import json
+import os
+import sys
+import time
+
+import numpy as np
+import torch
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "container_serving"))
+
+import batching
+import d2_deserializer
+import request_options
+from bench_cpu_perf import get_predictor, load_images
+
+MODES = {
+    "full": {},
+    "box_only": {"masks": "none"},
+}
+
+
+def _latencies(predictor, images, options, repeat):
+
+    inputs = [request_options.attach_options(image, options) for image in images]
+    latencies, num_instances = [], []
+    for _ in range(repeat):
+        for image in inputs:
+            start = time.perf_counter()
+            prediction = batching.run_batch(predictor, [image])[0]
+            d2_deserializer.d2_to_json(prediction)
+            latencies.append(time.perf_counter() - start)
+            num_instances.append(len(prediction["instances"]))
+
+    return latencies, num_instances
+
+
+def main(args):
+
+    if args.threads:
+        torch.set_num_threads(args.threads)
+    predictor = get_predictor(args)
+    images = load_images(args)
+    box_predictor = predictor.model.roi_heads.box_predictor
+
+    results = []
+    for count in args.instances:
+        box_predictor.test_score_thresh = 0.0
+        box_predictor.test_topk_per_image = count
+
+        # warm-up of both modes
+        for options in MODES.values():
+            _latencies(predictor, images[:1], options, 1)
+
+        result = {"instances": count}
+        for mode, options in MODES.items():
+            latencies, num_instances = _latencies(predictor, images, options, args.repeat)
+            result[f"{mode}_p50_ms"] = float(np.percentile(latencies, 50) * 1000)
+            result[f"{mode}_p95_ms"] = float(np.percentile(latencies, 95) * 1000)
+            result[f"{mode}_mean_instances"] = float(np.mean(num_instances))
+
+        result["saving_ms"] = result["full_p50_ms"] - result["box_only_p50_ms"]
+        result["saving"] = result["saving_ms"] / result["full_p50_ms"]
+        results.append(result)
+
+    environment = {"torch": torch.__version__, "threads": torch.get_num_threads(),
+                   "model": args.config or "tiny", "images": len(images), "shape": list(images[0].shape)}
+    print(json.dumps({"environment": environment, "results": results}, indent=2))
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--config', type=str, default=None, help="tiny random model if not set")
+    parser.add_argument('--weights', type=str, default=None)
+    parser.add_argument('--image-dir', type=str, default=None, help="random images if not set")
+    parser.add_argument('--images', type=int, default=8)
+    parser.add_argument('--shape', type=int, nargs=2, default=[480, 640], metavar=("HEIGHT", "WIDTH"))
+    parser.add_argument('--instances', type=int, nargs='+', default=[1, 10, 50, 100])
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--threads', type=int, default=None, help="torch intra-op threads, torch default if not set")
+    args = parser.parse_args()
+
+    main(args)
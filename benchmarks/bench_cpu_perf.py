@@ -0,0 +1,151 @@
+"""
+Compares throughput and predictions of CPU performance modes (see container_serving/cpu_perf.py)
+with the eager fp32 path on a fixed image set.
+
+Accuracy delta is measured against eager fp32 predictions of the same images: share of reference
+instances matched by an instance of the same class with IoU >= --iou, mean IoU and mean absolute
+score difference of matched instances.
+
+Sample command:
+    python benchmarks/bench_cpu_perf.py --images 32 --threads 8 --modes eager optimized bf16_all
+
+Without --config a tiny random model is used, so the script runs on CPU-only boxes.
+"""
+
+import argparse
+import json
+import os
+import sys
+import time
+
+import numpy as np
+import torch
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "container_serving"))
+
+import batching
+import cpu_perf
+import tiny_model
+from detectron2.structures import pairwise_iou
+
+# mode name -> cpu_perf.optimize() arguments, None runs the current eager fp32 path
+MODES = {
+    "eager": None,
+    "optimized": dict(channels_last=True, bf16="0", prepack=True, inference_mode=True),
+    "bf16_backbone": dict(channels_last=True, bf16="backbone", prepack=True, inference_mode=True),
+    "bf16_all": dict(channels_last=True, bf16="all", prepack=True, inference_mode=True),
+}
+
+
+def get_predictor(args):
+
+    if not args.config:
+        return tiny_model.get_tiny_predictor()
+
+    from detectron2.config import get_cfg
+    from detectron2.engine import DefaultPredictor
+    cfg = get_cfg()
+    cfg.merge_from_file(args.config)
+    cfg.MODEL.DEVICE = "cpu"
+    if args.weights:
+        cfg.MODEL.WEIGHTS = args.weights
+    return DefaultPredictor(cfg)
+
+
+def load_images(args):
+
+    if args.image_dir:
+        import cv2
+        files = sorted(f for f in os.listdir(args.image_dir) if f.lower().endswith((".jpg", ".jpeg", ".png")))
+        return [cv2.imread(os.path.join(args.image_dir, f)) for f in files[:args.images]]
+
+    height, width = args.shape
+    return tiny_model.random_images(args.images, height, width)
+
+
+def _run(predictor, images, batch_size):
+
+    predictions = []
+    for start in range(0, len(images), batch_size):
+        predictions.extend(batching.run_batch(predictor, images[start:start + batch_size]))
+    return predictions
+
+
+def accuracy_delta(reference, predictions, iou_threshold):
+
+    matched, total, ious, score_diffs = 0, 0, [], []
+    for ref, pred in zip(reference, predictions):
+        ref, pred = ref["instances"].to("cpu"), pred["instances"].to("cpu")
+        total += len(ref)
+        if len(ref) == 0 or len(pred) == 0:
+            continue
+
+        iou = pairwise_iou(ref.pred_boxes, pred.pred_boxes)
+        iou[ref.pred_classes[:, None] != pred.pred_classes[None, :]] = 0
+        best_iou, best = iou.max(dim=1)
+        keep = best_iou >= iou_threshold
+
+        matched += int(keep.sum())
+        ious.extend(best_iou[keep].tolist())
+        score_diffs.extend((ref.scores[keep] - pred.scores[best[keep]]).abs().tolist())
+
+    return {
+        "matched": matched / total if total else 1.0,
+        "mean_iou": float(np.mean(ious)) if ious else None,
+        "mean_abs_score_diff": float(np.mean(score_diffs)) if score_diffs else None,
+    }
+
+
+def main(args):
+
+    cpu_perf.configure_threads(args.threads, args.interop_threads)
+    images = load_images(args)
+
+    results = {}
+    reference = None
+    for mode in ["eager"] + [m for m in args.modes if m != "eager"]:
+        predictor = get_predictor(args)
+        if MODES[mode] is not None:
+            cpu_perf.optimize(predictor, threads=0, interop_threads=0, **MODES[mode])
+
+        # warm-up run, also the predictions compared with reference
+        predictions = _run(predictor, images, args.batch_size)
+
+        timings = []
+        for _ in range(args.repeat):
+            start = time.perf_counter()
+            _run(predictor, images, args.batch_size)
+            timings.append(time.perf_counter() - start)
+
+        if reference is None:
+            reference = predictions
+
+        results[mode] = {
+            "images_per_sec": len(images) / min(timings),
+            "images_per_sec_mean": len(images) / (sum(timings) / len(timings)),
+            "accuracy_delta": accuracy_delta(reference, predictions, args.iou),
+        }
+
+    for mode in results:
+        results[mode]["speedup"] = results[mode]["images_per_sec"] / results["eager"]["images_per_sec"]
+
+    print(json.dumps({"threads": torch.get_num_threads(), "images": len(images), "results": results}, indent=2))
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--config', type=str, default=None)
+    parser.add_argument('--weights', type=str, default=None)
+    parser.add_argument('--image-dir', type=str, default=None, help="fixed image set, random images if not set")
+    parser.add_argument('--images', type=int, default=16)
+    parser.add_argument('--shape', type=int, nargs=2, default=[480, 640], metavar=("HEIGHT", "WIDTH"))
+    parser.add_argument('--batch-size', type=int, default=1)
+    parser.add_argument('--threads', type=int, default=0)
+    parser.add_argument('--interop-threads', type=int, default=0)
+    parser.add_argument('--modes', type=str, nargs='+', default=list(MODES), choices=list(MODES))
+    parser.add_argument('--iou', type=float, default=0.9)
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    main(args)
@@ -0,0 +1,78 @@
+"""
+Compares encode time and payload size of d2_to_json compatible mode (tensor.tolist() and
+json.dumps) with fast mode (rounded numpy arrays, orjson if installed) on synthetic COCO-sized
+predictions, see bench_response_formats.py.
+
+Masks are RLE encoded once upfront by default, so that timings show JSON encoding only,
+--masks includes RLE encoding in every run.
+
+Sample command:
+    python benchmarks/bench_json_encoder.py --instances 10 100 500 --box-precision 1 2 --score-precision 3
+"""
+
+import argparse
+import json
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "container_serving"))
+
+import d2_deserializer
+from bench_response_formats import make_predictions, copy_predictions
+
+
+def _time(fn, repeat):
+
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        timings.append(time.perf_counter() - start)
+
+    return min(timings) * 1000, sum(timings) / len(timings) * 1000
+
+
+def main(args):
+
+    modes = [("compatible", dict(fast=False))]
+    for box_precision in args.box_precision:
+        for score_precision in args.score_precision:
+            modes.append((f"fast_b{box_precision}_s{score_precision}",
+                          dict(fast=True, box_precision=box_precision, score_precision=score_precision)))
+
+    results = []
+    for num_instances in args.instances:
+        predictions = make_predictions(num_instances)
+        if not args.masks:
+            instances = predictions["instances"]
+            instances.pred_masks_rle = d2_deserializer.convert_masks_to_rle(instances.pred_masks)
+            instances.remove("pred_masks")
+
+        for name, kwargs in modes:
+            data = d2_deserializer.d2_to_json(copy_predictions(predictions), **kwargs)
+            encode_min, encode_mean = _time(lambda: d2_deserializer.d2_to_json(copy_predictions(predictions), **kwargs),
+                                            args.repeat)
+            results.append({
+                "mode": name,
+                "backend": "orjson" if kwargs["fast"] and d2_deserializer.orjson is not None else "json",
+                "instances": num_instances,
+                "bytes": len(data),
+                "encode_ms_min": encode_min,
+                "encode_ms_mean": encode_mean,
+            })
+
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--instances', type=int, nargs='+', default=[10, 100, 500])
+    parser.add_argument('--box-precision', type=int, nargs='+', default=[2])
+    parser.add_argument('--score-precision', type=int, nargs='+', default=[4])
+    parser.add_argument('--masks', action='store_true', help="include RLE encoding of masks in timings")
+    parser.add_argument('--repeat', type=int, default=20)
+    args = parser.parse_args()
+
+    main(args)
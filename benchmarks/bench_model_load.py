@@ -0,0 +1,107 @@
+"""
+Compares model load time and peak RSS of DetectionCheckpointer (.pth/.pkl) and memory-mapped
+.d2w weights. Every load runs in a fresh process, so that each load starts cold
+and ru_maxrss is not polluted by previous runs.
+
+Sample command:
+    python benchmarks/bench_model_load.py --config config.yaml --weights model_final.pth --repeat 3
+
+Without --config/--weights a tiny random model is generated, so the script runs on CPU-only boxes.
+"""
+
+import argparse
+import json
+import multiprocessing as mp
+import os
+import resource
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "container_serving"))
+
+
+def _load(mode, config_path, weights_path, device, queue):
+
+    from detectron2.config import get_cfg
+    from detectron2.engine import DefaultPredictor
+    import fast_weights
+
+    cfg = get_cfg()
+    cfg.merge_from_file(config_path)
+    cfg.MODEL.DEVICE = device
+    cfg.MODEL.WEIGHTS = weights_path
+
+    rss_before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    start = time.monotonic()
+    if mode == "d2w":
+        fast_weights.load_predictor(cfg, weights_path)
+    else:
+        DefaultPredictor(cfg)
+    elapsed = time.monotonic() - start
+
+    # ru_maxrss is in kilobytes on Linux
+    queue.put({"mode": mode, "load_sec": elapsed,
+               "peak_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+               "rss_before_load_mb": rss_before / 1024})
+
+
+def _run(mode, config_path, weights_path, device):
+
+    ctx = mp.get_context("spawn")
+    queue = ctx.Queue()
+    proc = ctx.Process(target=_load, args=(mode, config_path, weights_path, device, queue))
+    proc.start()
+    result = queue.get()
+    proc.join()
+
+    return result
+
+
+def main(args):
+
+    import fast_weights
+
+    workdir = tempfile.mkdtemp()
+    config_path, weights_path = args.config, args.weights
+    if config_path is None:
+        import tiny_model
+        tiny_model.dump_tiny_model(workdir)
+        config_path = os.path.join(workdir, "config.yaml")
+        weights_path = os.path.join(workdir, "model_final.pth")
+
+    d2w_path = os.path.join(workdir, "model" + fast_weights.EXTENSION)
+    fast_weights.convert(config_path, weights_path, d2w_path)
+
+    results = []
+    for _ in range(args.repeat):
+        results.append(_run("checkpointer", config_path, weights_path, args.device))
+        results.append(_run("d2w", config_path, d2w_path, args.device))
+
+    summary = {}
+    for mode in ["checkpointer", "d2w"]:
+        runs = [r for r in results if r["mode"] == mode]
+        summary[mode] = {
+            "load_sec_min": min(r["load_sec"] for r in runs),
+            "load_sec_mean": sum(r["load_sec"] for r in runs) / len(runs),
+            "peak_rss_mb_max": max(r["peak_rss_mb"] for r in runs),
+            "load_rss_mb_max": max(r["peak_rss_mb"] - r["rss_before_load_mb"] for r in runs),
+        }
+    summary["file_size_mb"] = {
+        "checkpointer": os.path.getsize(weights_path) / 2**20,
+        "d2w": os.path.getsize(d2w_path) / 2**20,
+    }
+
+    print(json.dumps(summary, indent=2))
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--config', type=str, default=None)
+    parser.add_argument('--weights', type=str, default=None)
+    parser.add_argument('--device', type=str, default='cpu')
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    main(args)
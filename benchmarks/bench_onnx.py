@@ -0,0 +1,142 @@
+"""
+Compares parity and latency of exported models (onnxruntime and TorchScript backends of
+container_serving/exported_model.py) with eager DefaultPredictor on CPU.
+
+Parity is measured as in bench_cpu_perf.py: share of eager instances matched by an exported
+instance of the same class with IoU >= --iou, mean IoU and mean absolute score difference.
+Mask parity is mean mask IoU of matched instances.
+
+Sample command:
+    python benchmarks/bench_onnx.py --images 16 --backends onnxruntime torchscript --ort-threads 4
+
+Without --config a tiny random model is used, so the script runs on CPU-only boxes.
+Requires onnx and onnxruntime packages.
+"""
+
+import argparse
+import json
+import os
+import sys
+import tempfile
+import time
+
+import numpy as np
+import torch
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "container_serving"))
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import exported_model
+import torchscript_export
+from bench_cpu_perf import get_predictor, load_images, accuracy_delta
+from detectron2.structures import Boxes, Instances, pairwise_iou
+
+
+def _to_instances(prediction):
+
+    instances = Instances(prediction["image_size"])
+    instances.pred_boxes = Boxes(prediction["boxes"])
+    instances.scores = prediction["scores"]
+    instances.pred_classes = prediction["classes"]
+    if "masks" in prediction:
+        instances.pred_masks = prediction["masks"]
+    return {"instances": instances}
+
+
+def _mask_iou(reference, predictions, iou_threshold):
+
+    ious = []
+    for ref, pred in zip(reference, predictions):
+        ref, pred = ref["instances"].to("cpu"), pred["instances"].to("cpu")
+        if len(ref) == 0 or len(pred) == 0 or not ref.has("pred_masks"):
+            continue
+
+        box_iou = pairwise_iou(ref.pred_boxes, pred.pred_boxes)
+        best_iou, best = box_iou.max(dim=1)
+        for i in (best_iou >= iou_threshold).nonzero().flatten().tolist():
+            a, b = ref.pred_masks[i], pred.pred_masks[best[i]]
+            union = (a | b).sum().item()
+            ious.append((a & b).sum().item() / union if union else 1.0)
+
+    return float(np.mean(ious)) if ious else None
+
+
+def _time(fn, images, repeat):
+
+    latencies = []
+    for _ in range(repeat):
+        for image in images:
+            start = time.perf_counter()
+            fn(image)
+            latencies.append(time.perf_counter() - start)
+
+    latencies.sort()
+    return {
+        "p50_ms": latencies[len(latencies) // 2] * 1000,
+        "p99_ms": latencies[min(len(latencies) - 1, int(0.99 * len(latencies)))] * 1000,
+        "images_per_sec": len(latencies) / sum(latencies),
+    }
+
+
+def main(args):
+
+    if args.threads > 0:
+        torch.set_num_threads(args.threads)
+    images = load_images(args)
+    predictor = get_predictor(args)
+    cfg = predictor.cfg
+
+    reference = [predictor(image) for image in images]
+    results = {"eager": _time(predictor, images, args.repeat)}
+
+    with tempfile.TemporaryDirectory() as tmp:
+        inputs = torchscript_export.get_sample_inputs(cfg, device="cpu")
+
+        for backend in args.backends:
+            if backend == "onnxruntime":
+                path = os.path.join(tmp, "model.onnx")
+                start = time.perf_counter()
+                torchscript_export.export_onnx(predictor.model, cfg, inputs, path, args.opset)
+                exported = exported_model.OnnxPredictor(path, "cpu", args.ort_optimization_level,
+                                                        args.ort_threads, args.ort_inter_op_threads)
+            else:
+                path = os.path.join(tmp, "model.ts")
+                start = time.perf_counter()
+                torchscript_export.export_torchscript(predictor.model, cfg, inputs, path)
+                exported = exported_model.TorchScriptPredictor(path, "cpu")
+            export_sec = time.perf_counter() - start
+
+            predictions = [_to_instances(exported(image)) for image in images]
+            results[backend] = dict(_time(exported, images, args.repeat),
+                                    export_sec=export_sec,
+                                    file_bytes=os.path.getsize(path),
+                                    parity=dict(accuracy_delta(reference, predictions, args.iou),
+                                                mean_mask_iou=_mask_iou(reference, predictions, args.iou)))
+
+    for backend in results:
+        results[backend]["speedup"] = results[backend]["images_per_sec"] / results["eager"]["images_per_sec"]
+
+    print(json.dumps({"threads": torch.get_num_threads(), "images": len(images), "results": results}, indent=2))
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--config', type=str, default=None)
+    parser.add_argument('--weights', type=str, default=None)
+    parser.add_argument('--image-dir', type=str, default=None, help="fixed image set, random images if not set")
+    parser.add_argument('--images', type=int, default=16)
+    parser.add_argument('--shape', type=int, nargs=2, default=[480, 640], metavar=("HEIGHT", "WIDTH"))
+    parser.add_argument('--backends', type=str, nargs='+', default=["onnxruntime", "torchscript"],
+                        choices=["onnxruntime", "torchscript"])
+    parser.add_argument('--threads', type=int, default=0, help="torch threads of eager and TorchScript models")
+    parser.add_argument('--ort-threads', type=int, default=0)
+    parser.add_argument('--ort-inter-op-threads', type=int, default=0)
+    parser.add_argument('--ort-optimization-level', type=str, default="all",
+                        choices=["disabled", "basic", "extended", "all"])
+    parser.add_argument('--opset', type=int, default=11)
+    parser.add_argument('--iou', type=float, default=0.9)
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    main(args)
@@ -0,0 +1,120 @@
+"""
+Compares encode/decode time and payload size of response formats of output_fn:
+pickled Instances ("detectron2"), JSON and columnar binary.
+
+Predictions are synthetic, COCO-sized: 640x480 image, elliptic masks inside random boxes.
+
+Sample command:
+    python benchmarks/bench_response_formats.py --instances 10 50 100 --repeat 20
+"""
+
+import argparse
+import json
+import os
+import pickle
+import sys
+import time
+
+import numpy as np
+import torch
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "container_serving"))
+
+import d2_deserializer
+from detectron2.structures import Boxes, Instances
+
+
+def make_predictions(num_instances, height=480, width=640, seed=0):
+
+    rng = np.random.RandomState(seed)
+    x0 = rng.uniform(0, width - 20, num_instances)
+    y0 = rng.uniform(0, height - 20, num_instances)
+    x1 = np.minimum(x0 + rng.uniform(10, width / 2, num_instances), width)
+    y1 = np.minimum(y0 + rng.uniform(10, height / 2, num_instances), height)
+
+    yy, xx = np.mgrid[:height, :width]
+    masks = np.zeros((num_instances, height, width), dtype=bool)
+    for i in range(num_instances):
+        cx, cy = (x0[i] + x1[i]) / 2, (y0[i] + y1[i]) / 2
+        rx, ry = (x1[i] - x0[i]) / 2, (y1[i] - y0[i]) / 2
+        masks[i] = ((xx - cx) / rx) ** 2 + ((yy - cy) / ry) ** 2 <= 1
+
+    instances = Instances((height, width))
+    instances.pred_boxes = Boxes(torch.as_tensor(np.stack([x0, y0, x1, y1], axis=1), dtype=torch.float32))
+    instances.scores = torch.as_tensor(rng.uniform(0.5, 1, num_instances), dtype=torch.float32)
+    instances.pred_classes = torch.as_tensor(rng.randint(0, 80, num_instances))
+    instances.pred_masks = torch.as_tensor(masks)
+
+    return {"instances": instances}
+
+
+def copy_predictions(predictions):
+    # encoders remove pred_masks from Instances, every run needs fresh ones
+    instances = predictions["instances"]
+    return {"instances": Instances(instances.image_size, **instances.get_fields())}
+
+
+def _encode_pickle(predictions):
+
+    instances = predictions["instances"]
+    instances.set("pred_masks_rle", d2_deserializer.convert_masks_to_rle(instances.pred_masks))
+    instances.remove("pred_masks")
+    return pickle.dumps(predictions)
+
+
+FORMATS = {
+    "pickle": (_encode_pickle, lambda data: pickle.loads(data)),
+    "json": (d2_deserializer.d2_to_json, lambda data: d2_deserializer.json_to_d2(data, "cpu")),
+    # masks are decoded lazily, these variants also access them
+    "json_masks": (d2_deserializer.d2_to_json, lambda data: d2_deserializer.json_to_d2(data, "cpu")["instances"].pred_masks),
+    "columnar": (d2_deserializer.d2_to_columnar, lambda data: d2_deserializer.columnar_to_d2(data, "cpu")),
+    "columnar_masks": (d2_deserializer.d2_to_columnar,
+                       lambda data: d2_deserializer.columnar_to_d2(data, "cpu")["instances"].pred_masks),
+    # client which needs only numpy arrays, masks stay RLE encoded
+    "columnar_numpy": (d2_deserializer.d2_to_columnar, d2_deserializer.decode_columnar),
+}
+
+
+def _time(fn, repeat):
+
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        timings.append(time.perf_counter() - start)
+
+    return min(timings) * 1000, sum(timings) / len(timings) * 1000
+
+
+def main(args):
+
+    results = []
+    for num_instances in args.instances:
+        predictions = make_predictions(num_instances)
+
+        for name, (encode, decode) in FORMATS.items():
+            data = encode(copy_predictions(predictions))
+            encode_min, encode_mean = _time(lambda: encode(copy_predictions(predictions)), args.repeat)
+            decode_min, decode_mean = _time(lambda: decode(data), args.repeat)
+
+            results.append({
+                "format": name,
+                "instances": num_instances,
+                "bytes": len(data),
+                "encode_ms_min": encode_min,
+                "encode_ms_mean": encode_mean,
+                "decode_ms_min": decode_min,
+                "decode_ms_mean": decode_mean,
+            })
+
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--instances', type=int, nargs='+', default=[10, 50, 100])
+    parser.add_argument('--repeat', type=int, default=20)
+    args = parser.parse_args()
+
+    main(args)
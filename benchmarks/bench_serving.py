@@ -0,0 +1,265 @@
+"""
+Load test of the serving handlers: drives model_fn/input_fn/predict_fn/output_fn in-process
+from several threads, or sends requests to a running local_server.py, and reports as JSON:
+throughput, p50/p95/p99 latency, per-stage breakdown (stage_timer histograms in-process,
+Server-Timing headers of a server), peak RSS and request/response payload sizes.
+
+Without --model-dir a tiny random model (container_serving/tiny_model.py) is dumped to a
+temporary directory, so the benchmark runs on CPU-only CI boxes.
+
+Sample commands:
+    python benchmarks/bench_serving.py --concurrency 1 4 --content-types image/jpeg application/x-npy
+    python benchmarks/bench_serving.py --content-types application/x-npy application/x-d2-shm
+    python benchmarks/bench_serving.py --url http://localhost:8080 --server-pid 1234 --concurrency 8
+"""
+
+import argparse
+import base64
+import http.client
+import io
+import json
+import os
+import resource
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlparse
+
+import cv2
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "container_serving"))
+
+
+def _percentile(values, q):
+
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(q / 100 * (len(values) - 1))))]
+
+
+def _load_images(args):
+
+    if args.image_dir:
+        files = sorted(f for f in os.listdir(args.image_dir) if f.lower().endswith((".jpg", ".jpeg", ".png")))
+        return [cv2.imread(os.path.join(args.image_dir, f)) for f in files[:args.images]]
+
+    import tiny_model
+    height, width = args.shape
+    return tiny_model.random_images(args.images, height, width)
+
+
+def encode_request(image, content_type, batch_size=1):
+    """
+    Returns request body of image in content type.
+    """
+
+    if "jpeg" in content_type:
+        return cv2.imencode(".jpg", image)[1].tobytes()
+    if "x-npy" in content_type:
+        buffer = io.BytesIO()
+        np.save(buffer, image, allow_pickle=False)
+        return buffer.getvalue()
+    if "json" in content_type:
+        jpeg = base64.b64encode(cv2.imencode(".jpg", image)[1].tobytes()).decode("utf-8")
+        return json.dumps({"images": [jpeg] * batch_size} if batch_size > 1 else {"image": jpeg})
+    if "image-batch" in content_type:
+        import d2_deserializer
+        return d2_deserializer.encode_image_batch([cv2.imencode(".jpg", image)[1].tobytes()] * batch_size)
+
+    raise ValueError(f"Unsupported content type {content_type}")
+
+
+def _peak_rss_bytes(pid=None):
+
+    if pid is None:
+        # ru_maxrss is in kilobytes on Linux
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+    with open(f"/proc/{pid}/status") as f:
+        for line in f:
+            if line.startswith("VmHWM:"):
+                return int(line.split()[1]) * 1024
+    return None
+
+
+class InProcessClient:
+
+    def __init__(self, handler, model_dir):
+
+        import stage_timer
+        self.handler = handler
+        self.stage_timer = stage_timer
+        self.model = handler.model_fn(model_dir)
+
+    def reset_stages(self):
+        self.stage_timer.histograms = self.stage_timer.StageHistograms()
+
+    def __call__(self, body, content_type, accept):
+
+        input_object = self.handler.input_fn(body, content_type)
+        prediction = self.handler.predict_fn(input_object, self.model)
+        output = self.handler.output_fn(prediction, accept)
+        if output is not None and not isinstance(output, (str, bytes)):
+            output = "".join(output)
+        if output is None:
+            raise RuntimeError("Handler failed, see log")
+        return output, None
+
+    def stages(self, _):
+        return self.stage_timer.histograms.percentiles()
+
+
+class HttpClient:
+
+    def __init__(self, url):
+
+        self.url = urlparse(url)
+        self._local = threading.local()
+
+    def reset_stages(self):
+        pass
+
+    def __call__(self, body, content_type, accept):
+
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = self._local.conn = http.client.HTTPConnection(self.url.hostname, self.url.port or 80)
+
+        conn.request("POST", "/invocations", body=body, headers={"Content-Type": content_type, "Accept": accept})
+        response = conn.getresponse()
+        output = response.read()
+        if response.status != 200:
+            raise RuntimeError(f"HTTP {response.status}: {output[:200]}")
+        return output, response.getheader("Server-Timing")
+
+    def stages(self, server_timings):
+        # Server-Timing values: "stage;dur=12.34, stage;dur=..."
+        durations = {}
+        for header in server_timings:
+            for item in (header or "").split(","):
+                name, _, dur = item.strip().partition(";dur=")
+                if dur:
+                    durations.setdefault(name, []).append(float(dur))
+
+        return {name: {"p50_ms": _percentile(v, 50), "p95_ms": _percentile(v, 95), "p99_ms": _percentile(v, 99),
+                       "count": len(v)} for name, v in durations.items()}
+
+
+def run_load(client, bodies, content_type, accept, concurrency, requests):
+    """
+    Sends requests from concurrency threads, returns latencies, wall time, errors and response sizes.
+    """
+
+    latencies, sizes, timings, errors = [], [], [], []
+    lock = threading.Lock()
+
+    def send(i):
+        body = bodies[i % len(bodies)]
+        start = time.perf_counter()
+        try:
+            output, server_timing = client(body, content_type, accept)
+        except Exception as e:
+            with lock:
+                errors.append(str(e))
+            return
+        latency = time.perf_counter() - start
+        with lock:
+            latencies.append(latency)
+            sizes.append(len(output))
+            timings.append(server_timing)
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(concurrency) as executor:
+        list(executor.map(send, range(requests)))
+    wall = time.perf_counter() - start
+
+    return latencies, sizes, timings, errors, wall
+
+
+def main(args):
+
+    if args.url:
+        client = HttpClient(args.url)
+    else:
+        import importlib
+        model_dir = args.model_dir
+        if model_dir is None:
+            import tiny_model
+            model_dir = tempfile.mkdtemp()
+            tiny_model.dump_tiny_model(model_dir)
+        client = InProcessClient(importlib.import_module(args.handler), model_dir)
+
+    images = _load_images(args)
+    results = []
+
+    shm_pool = None
+    for content_type in args.content_types:
+        if "x-d2-shm" in content_type:
+            # images are written to shared memory once, requests carry their handles
+            import shm_input
+            shm_pool = shm_pool or shm_input.SlotPool(len(images), max(image.nbytes for image in images))
+            slots = [shm_pool.acquire() for _ in images]
+            bodies = [json.dumps([slot.write(image)] * args.batch_size) for slot, image in zip(slots, images)]
+            for slot in slots:
+                shm_pool.release(slot)
+        else:
+            bodies = [encode_request(image, content_type, args.batch_size) for image in images]
+
+        for accept in args.accept_types:
+            for concurrency in args.concurrency:
+                # warm-up pass, not measured
+                run_load(client, bodies, content_type, accept, concurrency, min(len(bodies), concurrency))
+                client.reset_stages()
+
+                latencies, sizes, timings, errors, wall = run_load(client, bodies, content_type, accept,
+                                                                   concurrency, args.requests)
+                result = {
+                    "content_type": content_type,
+                    "accept": accept,
+                    "concurrency": concurrency,
+                    "requests": len(latencies),
+                    "errors": len(errors),
+                    "throughput_rps": len(latencies) / wall,
+                    "images_per_sec": len(latencies) * args.batch_size / wall,
+                    "request_bytes_mean": float(np.mean([len(b) for b in bodies])),
+                    "response_bytes_mean": float(np.mean(sizes)) if sizes else None,
+                    "stages": client.stages(timings),
+                    "peak_rss_bytes": _peak_rss_bytes(args.server_pid if args.url else None),
+                }
+                if latencies:
+                    result.update({f"p{q}_ms": _percentile(latencies, q) * 1000 for q in (50, 95, 99)})
+                if errors:
+                    result["first_error"] = errors[0]
+                results.append(result)
+
+    if shm_pool is not None:
+        shm_pool.close()
+
+    output = json.dumps(results, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(output)
+    print(output)
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--url', type=str, default=None, help="local_server.py URL, handlers run in-process if not set")
+    parser.add_argument('--server-pid', type=int, default=None, help="server process for peak RSS")
+    parser.add_argument('--handler', type=str, default="predict_coco")
+    parser.add_argument('--model-dir', type=str, default=None, help="tiny random model if not set")
+    parser.add_argument('--image-dir', type=str, default=None, help="random images if not set")
+    parser.add_argument('--images', type=int, default=8)
+    parser.add_argument('--shape', type=int, nargs=2, default=[480, 640], metavar=("HEIGHT", "WIDTH"))
+    parser.add_argument('--content-types', type=str, nargs='+', default=["image/jpeg"])
+    parser.add_argument('--accept-types', type=str, nargs='+', default=["application/json"])
+    parser.add_argument('--batch-size', type=int, default=1, help="images per request of json, image-batch and x-d2-shm types")
+    parser.add_argument('--concurrency', type=int, nargs='+', default=[1, 4])
+    parser.add_argument('--requests', type=int, default=50)
+    parser.add_argument('--output', type=str, default=None, help="also write JSON results to this file")
+    args = parser.parse_args()
+
+    main(args)
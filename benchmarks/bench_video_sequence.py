@@ -0,0 +1,109 @@
+"""
+Measures effective fps, skip rate and accuracy of frame-sequence inference (see
+container_serving/video_sequence.py) for combinations of keyframe interval, difference
+threshold and propagation mode.
+
+Accuracy is measured against detection on every frame, see bench_cpu_perf.accuracy_delta.
+Frames are read from --video, or synthesized by panning a crop window over a larger random
+image by --pan pixels per frame, which simulates a moving drone camera.
+
+Sample command:
+    python benchmarks/bench_video_sequence.py --video clip.mp4 --config config.yaml --weights model.pth \
+        --keyframe-intervals 1 5 10 --diff-thresholds 8 16 --propagate reuse shift
+"""
+
+import argparse
+import itertools
+import json
+import os
+import sys
+import time
+
+import cv2
+import torch
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "container_serving"))
+
+import batching
+import tiny_model
+import video_sequence
+from bench_cpu_perf import get_predictor, accuracy_delta
+from detectron2.structures import Boxes
+
+
+def load_frames(args):
+
+    if args.video:
+        capture = cv2.VideoCapture(args.video)
+        frames = []
+        while len(frames) < args.frames:
+            ok, frame = capture.read()
+            if not ok:
+                break
+            frames.append(frame)
+        capture.release()
+        return frames
+
+    height, width = args.shape
+    scene = tiny_model.random_images(1, height + args.pan * args.frames, width + args.pan * args.frames)[0]
+    return [scene[i * args.pan:i * args.pan + height, i * args.pan:i * args.pan + width] for i in range(args.frames)]
+
+
+def _propagated(result):
+    """
+    Returns prediction of a frame result with shifted boxes, as the client would see it.
+    """
+
+    instances = result.prediction["instances"].to("cpu")
+    if result.shift == (0.0, 0.0):
+        return {"instances": instances}
+
+    shifted = instances[torch.arange(len(instances))]
+    dx, dy = result.shift
+    shifted.pred_boxes = Boxes(instances.pred_boxes.tensor + torch.tensor([dx, dy, dx, dy]))
+    return {"instances": shifted}
+
+
+def main(args):
+
+    predictor = get_predictor(args)
+    frames = load_frames(args)
+
+    def detect(frame):
+        return batching.run_batch(predictor, [frame])[0]
+
+    # warm-up, then reference predictions of every frame
+    detect(frames[0])
+    start = time.perf_counter()
+    reference = [detect(frame) for frame in frames]
+    reference_fps = len(frames) / (time.perf_counter() - start)
+
+    results = []
+    for interval, threshold, propagate in itertools.product(args.keyframe_intervals, args.diff_thresholds,
+                                                            args.propagate):
+        run = video_sequence.SequenceRun(detect, frames, interval, threshold, propagate)
+        predictions = [_propagated(result) for result in run]
+        stats = run.stats()
+        stats.update(accuracy_delta(reference, predictions, args.iou))
+        stats["speedup"] = stats["fps"] / reference_fps
+        results.append(stats)
+
+    print(json.dumps({"every_frame_fps": reference_fps, "frames": len(frames), "results": results}, indent=2))
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--config', type=str, default=None, help="tiny random model if not set")
+    parser.add_argument('--weights', type=str, default=None)
+    parser.add_argument('--video', type=str, default=None, help="synthetic panning frames if not set")
+    parser.add_argument('--frames', type=int, default=60)
+    parser.add_argument('--shape', type=int, nargs=2, default=[480, 640], metavar=("HEIGHT", "WIDTH"))
+    parser.add_argument('--pan', type=int, default=2, help="pixels per frame of synthetic camera motion")
+    parser.add_argument('--keyframe-intervals', type=int, nargs='+', default=[1, 5, 10])
+    parser.add_argument('--diff-thresholds', type=float, nargs='+', default=[8.0, 16.0])
+    parser.add_argument('--propagate', type=str, nargs='+', default=["reuse", "shift"])
+    parser.add_argument('--iou', type=float, default=0.5)
+    args = parser.parse_args()
+
+    main(args)
@@ -0,0 +1,93 @@
+"""
+Measures latency of the first requests after model load with and without warm-up.
+Each mode runs in a fresh process, so that allocator pools and kernel caches start cold.
+Requests run through batching.run_batch(), as in the serving handlers.
+
+Sample command:
+    python benchmarks/bench_warmup.py --requests 20 --shapes 480x640,640x480
+
+Without --config a tiny random model is used, so the script runs on CPU-only boxes.
+"""
+
+import argparse
+import json
+import multiprocessing as mp
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "container_serving"))
+
+
+def _percentile(values, q):
+
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(q / 100 * (len(values) - 1))))]
+
+
+def _first_requests(mode, args, queue):
+
+    import batching
+    import tiny_model
+    import warmup
+
+    if args.config:
+        from detectron2.config import get_cfg
+        from detectron2.engine import DefaultPredictor
+        cfg = get_cfg()
+        cfg.merge_from_file(args.config)
+        cfg.MODEL.DEVICE = args.device
+        predictor = DefaultPredictor(cfg)
+    else:
+        predictor = tiny_model.get_tiny_predictor()
+
+    shapes = warmup.parse_shapes(args.shapes)
+
+    warmup_sec = 0.0
+    if mode == "warm":
+        start = time.monotonic()
+        warmup.warmup(predictor, shapes, args.iterations)
+        warmup_sec = time.monotonic() - start
+
+    latencies = []
+    for i in range(args.requests):
+        height, width = shapes[i % len(shapes)]
+        image = tiny_model.random_images(1, height, width, seed=i + 1)[0]
+        start = time.monotonic()
+        batching.run_batch(predictor, [image])
+        latencies.append(time.monotonic() - start)
+
+    queue.put({
+        "warmup_sec": warmup_sec,
+        "first_request_ms": latencies[0] * 1000,
+        "p50_ms": _percentile(latencies, 50) * 1000,
+        "p99_ms": _percentile(latencies, 99) * 1000,
+    })
+
+
+def main(args):
+
+    ctx = mp.get_context("spawn")
+    results = {}
+
+    for mode in ["cold", "warm"]:
+        queue = ctx.Queue()
+        proc = ctx.Process(target=_first_requests, args=(mode, args, queue))
+        proc.start()
+        results[mode] = queue.get()
+        proc.join()
+
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--config', type=str, default=None)
+    parser.add_argument('--device', type=str, default='cpu')
+    parser.add_argument('--shapes', type=str, default='480x640,640x480')
+    parser.add_argument('--iterations', type=int, default=2)
+    parser.add_argument('--requests', type=int, default=20)
+    args = parser.parse_args()
+
+    main(args)
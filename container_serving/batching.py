@@ -0,0 +1,400 @@
+"""
+Batched inference for Detectron2 DefaultPredictor.
+
+run_batch() runs several images through predictor.model in a single forward pass, reproducing
+the preprocessing of DefaultPredictor.__call__ for each image. Models with inference() (i.e.
+GeneralizedRCNN) apply request options before postprocessing, other meta-architectures run
+predictor.model(inputs) and request options are applied to their postprocessed outputs.
+
+Images whose requests don't need masks (see request_options.wants_masks) run without the ROI
+mask head when a whole forward pass consists of them. The mask head is switched off per thread
+(see skip_mask_head), so box-only and full requests share the same loaded model.
+
+MicroBatcher gathers images submitted concurrently by several request threads for a bounded
+wait window and runs them as one batch. Note, that Sagemaker Multi Model Server calls handlers
+of a worker one request at a time, so micro-batching pays off only when handlers are invoked
+from several threads (e.g. by local_server.py with several workers).
+"""
+
+import logging
+import queue
+import sys
+import threading
+import time
+from concurrent.futures import Future
+from contextlib import contextmanager
+
+import torch
+import detectron2.data.transforms as T
+from detectron2.modeling.postprocessing import detector_postprocess
+
+import cpu_perf
+import request_options
+import stage_timer
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.DEBUG)
+logger.addHandler(logging.StreamHandler(sys.stdout))
+
+_local = threading.local()
+
+
+class _MaskSwitch:
+    """
+    Mixin of ROI heads, which turns mask_on attribute off while the calling thread is in skip_mask_head().
+    """
+
+    @property
+    def mask_on(self):
+        return self.__dict__["mask_on"] and not getattr(_local, "skip_masks", False)
+
+    @mask_on.setter
+    def mask_on(self, value):
+        self.__dict__["mask_on"] = value
+
+
+_switch_classes = {}
+
+
+def _install_mask_switch(roi_heads):
+    """
+    Swaps class of ROI heads module for a subclass with _MaskSwitch. Both StandardROIHeads and
+    Res5ROIHeads check mask_on before running the mask head, the weights are untouched.
+    """
+
+    cls = type(roi_heads)
+    if issubclass(cls, _MaskSwitch):
+        return
+    if cls not in _switch_classes:
+        _switch_classes[cls] = type(cls.__name__, (_MaskSwitch, cls), {})
+    roi_heads.__class__ = _switch_classes[cls]
+
+
+@contextmanager
+def skip_mask_head(predictor, skip=True):
+    """
+    Runs predictor.model without ROI mask head (and so without mask pasting) in the calling thread if skip is set.
+    """
+
+    roi_heads = getattr(predictor.model, "roi_heads", None)
+    if not skip or roi_heads is None or not hasattr(roi_heads, "mask_on"):
+        yield
+        return
+
+    _install_mask_switch(roi_heads)
+    previous = getattr(_local, "skip_masks", False)
+    _local.skip_masks = True
+    try:
+        yield
+    finally:
+        _local.skip_masks = previous
+
+
+def _get_transform(predictor, image, options):
+
+    if "min_size" in options or "max_size" in options:
+        min_size = options.get("min_size", predictor.cfg.INPUT.MIN_SIZE_TEST)
+        max_size = options.get("max_size", predictor.cfg.INPUT.MAX_SIZE_TEST)
+        return T.ResizeShortestEdge([min_size, min_size], max_size).get_transform(image)
+
+    # DefaultPredictor renamed "transform_gen" to "aug" in later Detectron2 releases
+    aug = getattr(predictor, "aug", None) or predictor.transform_gen
+    return aug.get_transform(image)
+
+
+def _preprocess(predictor, image):
+    """
+    Converts HWC numpy image to D2 model input dict, same way as DefaultPredictor.__call__ does.
+    Image can also be a dict with "image", original "height"/"width" and request "options",
+    predictions are then rescaled to the original size (e.g. for images decoded at reduced scale).
+    """
+
+    height = width = None
+    options = request_options.get_options(image)
+    if isinstance(image, dict):
+        height, width, image = image["height"], image["width"], image["image"]
+
+    if predictor.input_format == "RGB":
+        image = image[:, :, ::-1]
+    if height is None:
+        height, width = image.shape[:2]
+
+    image = _get_transform(predictor, image, options).apply_image(image)
+    image = torch.as_tensor(image.astype("float32").transpose(2, 0, 1))
+
+    return {"image": image, "height": height, "width": width}
+
+
+def _postprocess(instances, height, width, options):
+    """
+    Applies request options and rescales raw model outputs to the original image size.
+    Instances are filtered before masks are pasted, and masks which were not requested are
+    dropped without pasting. With "masks": "roi" option mask probabilities are kept at ROI
+    resolution as uint8 "pred_masks_roi" instead of being pasted.
+    """
+
+    instances = request_options.filter_instances(instances, options)
+
+    if instances.has("pred_masks"):
+        if not request_options.wants_masks(options):
+            instances.remove("pred_masks")
+        elif options.get("masks") == "roi":
+            # N x 1 x M x M probabilities -> N x M x M uint8
+            instances.pred_masks_roi = (instances.pred_masks[:, 0] * 255).round().to(torch.uint8)
+            instances.remove("pred_masks")
+
+    instances = detector_postprocess(instances, height, width)
+
+    return request_options.drop_unselected_fields(instances, options)
+
+
+def _apply_options(result, options):
+    """
+    Applies request options to output of predictor.model(inputs) of models without inference(),
+    e.g. RetinaNet, whose instances are already rescaled to the original image size.
+    """
+
+    if "instances" not in result:
+        return result
+    if options.get("masks") == "roi":
+        raise ValueError("masks=roi requires a model with ROI mask head")
+
+    instances = request_options.filter_instances(result["instances"], options)
+    if instances.has("pred_masks") and not request_options.wants_masks(options):
+        instances.remove("pred_masks")
+
+    return dict(result, instances=request_options.drop_unselected_fields(instances, options))
+
+
+def run_batch(predictor, images, batch_size=None):
+    """
+    Runs list of HWC numpy images (or dicts, see _preprocess) through predictor.model as one batch.
+    If batch_size is set, images are split into forward passes of at most batch_size images.
+    Returns list of prediction dicts, one per image, in the same order as images.
+    """
+
+    batch_size = batch_size or len(images)
+    predictions = []
+
+    for start in range(0, len(images), batch_size):
+        chunk = images[start:start + batch_size]
+        with stage_timer.stage("preprocess"):
+            inputs = [_preprocess(predictor, image) for image in chunk]
+
+        # mask head runs only if some image of the forward pass needs masks
+        with_masks = any(request_options.wants_masks(request_options.get_options(image)) for image in chunk)
+
+        # only GeneralizedRCNN can postprocess outside of the model
+        postprocess = hasattr(predictor.model, "inference")
+
+        with cpu_perf.inference_context(predictor), skip_mask_head(predictor, not with_masks):
+            with stage_timer.stage("forward"):
+                if postprocess:
+                    # same as predictor.model(inputs), but request options are applied before postprocessing
+                    results = predictor.model.inference(inputs, do_postprocess=False)
+                else:
+                    results = predictor.model(inputs)
+                if stage_timer.ENABLED and predictor.cfg.MODEL.DEVICE.startswith("cuda"):
+                    # CUDA kernels run asynchronously, charge them to forward stage
+                    torch.cuda.synchronize()
+
+            with stage_timer.stage("postprocess"):
+                for result, image, inp in zip(results, chunk, inputs):
+                    options = request_options.get_options(image)
+                    if postprocess:
+                        predictions.append({"instances": _postprocess(result, inp["height"], inp["width"], options)})
+                    else:
+                        predictions.append(_apply_options(result, options))
+
+    return predictions
+
+
+class MicroBatcher:
+    """
+    Collects images from concurrent callers and runs them through run_batch().
+    A batch is dispatched once it has max_batch_size images or max_delay_ms passed
+    since the first image of the batch arrived.
+    """
+
+    def __init__(self, predictor, max_batch_size=8, max_delay_ms=10):
+
+        self.predictor = predictor
+        self.max_batch_size = max_batch_size
+        self.max_delay = max_delay_ms / 1000.0
+
+        self._queue = queue.Queue()
+        self._closed = False
+        self._close_lock = threading.Lock()
+        self._thread = threading.Thread(target=self._loop, name="d2-micro-batcher", daemon=True)
+        self._thread.start()
+
+    def submit(self, image):
+        """
+        Enqueues image for inference. Returns concurrent.futures.Future with prediction dict.
+        """
+
+        future = Future()
+        with self._close_lock:
+            if not self._closed:
+                self._queue.put((image, future, stage_timer.current()))
+                return future
+
+        # batcher of an evicted model, image runs on its own
+        future.set_result(run_batch(self.predictor, [image])[0])
+        return future
+
+    def __call__(self, image):
+        return self.submit(image).result()
+
+    def close(self):
+        """
+        Stops the batching thread once already submitted images are processed.
+        """
+
+        with self._close_lock:
+            if self._closed:
+                return
+            self._closed = True
+            self._queue.put(None)
+        self._thread.join()
+
+    def _collect(self, first):
+
+        batch = [first]
+        deadline = time.monotonic() + self.max_delay
+
+        while len(batch) < self.max_batch_size:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                item = self._queue.get(timeout=remaining)
+            except queue.Empty:
+                break
+            if item is None:
+                # re-enqueue stop marker so that loop exits after this batch
+                self._queue.put(None)
+                break
+            batch.append(item)
+
+        return batch
+
+    def _loop(self):
+
+        while True:
+            first = self._queue.get()
+            if first is None:
+                return
+
+            batch = self._collect(first)
+            images = [image for image, _, _ in batch]
+            futures = [future for _, future, _ in batch]
+            timers = [timer for _, _, timer in batch]
+
+            logger.debug(f"Running micro-batch of {len(images)} images")
+
+            try:
+                with stage_timer.use(timers):
+                    predictions = run_batch(self.predictor, images)
+            except Exception as e:
+                logger.error("Batched prediction failed...")
+                logger.error(e)
+                for future in futures:
+                    future.set_exception(e)
+                continue
+
+            for future, prediction in zip(futures, predictions):
+                future.set_result(prediction)
+
+
+_batchers = {}
+_batchers_lock = threading.Lock()
+
+
+def get_batcher(predictor, max_batch_size, max_delay_ms, key=None):
+    """
+    Returns MicroBatcher bound to predictor, creates it on first call. key identifies the model,
+    e.g. its name in a model registry, None for single-model endpoints.
+    """
+
+    stale = None
+    with _batchers_lock:
+        batcher = _batchers.get(key)
+        if batcher is None or batcher.predictor is not predictor:
+            stale = batcher
+            batcher = MicroBatcher(predictor, max_batch_size, max_delay_ms)
+            _batchers[key] = batcher
+
+    if stale is not None:
+        stale.close()
+
+    return batcher
+
+
+def close_batcher(key=None):
+    """
+    Stops and drops MicroBatcher of model key, so that it no longer holds the predictor.
+    """
+
+    with _batchers_lock:
+        batcher = _batchers.pop(key, None)
+
+    if batcher is not None:
+        batcher.close()
+
+
+def _assert_same_predictions(expected, actual, atol=1e-3):
+
+    expected, actual = expected["instances"], actual["instances"]
+    assert len(expected) == len(actual), f"{len(expected)} vs {len(actual)} instances"
+    assert torch.equal(expected.pred_classes, actual.pred_classes)
+    assert torch.allclose(expected.scores, actual.scores, atol=atol)
+    assert torch.allclose(expected.pred_boxes.tensor, actual.pred_boxes.tensor, atol=atol)
+    if expected.has("pred_masks"):
+        mismatch = (expected.pred_masks != actual.pred_masks).float().mean().item()
+        assert mismatch < 1e-3, f"{mismatch:.2%} of mask pixels differ"
+
+
+if __name__ == "__main__":
+    """
+    CPU check with a tiny random model: batched and micro-batched predictions
+    must match per-image DefaultPredictor predictions.
+    """
+    from concurrent.futures import ThreadPoolExecutor
+    import tiny_model
+
+    PREDICTOR = tiny_model.get_tiny_predictor()
+    # equal sizes, so that batch padding does not change the receptive field of any image
+    IMAGES = tiny_model.random_images(4)
+
+    EXPECTED = [PREDICTOR(image) for image in IMAGES]
+
+    for exp, act in zip(EXPECTED, run_batch(PREDICTOR, IMAGES)):
+        _assert_same_predictions(exp, act)
+
+    BATCHER = MicroBatcher(PREDICTOR, max_batch_size=4, max_delay_ms=50)
+    with ThreadPoolExecutor(len(IMAGES)) as pool:
+        ACTUAL = list(pool.map(BATCHER, IMAGES))
+    BATCHER.close()
+
+    for exp, act in zip(EXPECTED, ACTUAL):
+        _assert_same_predictions(exp, act)
+
+    BOX_ONLY_IMAGES = [request_options.attach_options(image, {"masks": "none"}) for image in IMAGES]
+    for exp, act in zip(EXPECTED, run_batch(PREDICTOR, BOX_ONLY_IMAGES)):
+        assert not act["instances"].has("pred_masks")
+        exp["instances"].remove("pred_masks")
+        _assert_same_predictions(exp, act)
+    assert PREDICTOR.model.roi_heads.mask_on
+
+    import d2_deserializer
+
+    # ROI masks keep their boxes even if only masks are selected, pasting needs them
+    ROI_IMAGES = [request_options.attach_options(image, {"fields": ["masks"], "masks": "roi"}) for image in IMAGES]
+    for exp, act in zip(EXPECTED, run_batch(PREDICTOR, ROI_IMAGES)):
+        instances = act["instances"]
+        assert set(instances.get_fields()) == {"pred_boxes", "pred_masks_roi"}, instances.get_fields().keys()
+        assert torch.allclose(exp["instances"].pred_boxes.tensor, instances.pred_boxes.tensor, atol=1e-3)
+        assert d2_deserializer.paste_roi_masks(instances).shape == (len(instances),) + instances.image_size
+
+    print("Batched and unbatched predictions match")
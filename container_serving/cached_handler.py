@@ -0,0 +1,101 @@
+"""
+Sagemaker entry point which serves predict_coco.py, predict_drone.py or predict_exported.py handlers through
+a prediction cache (set SAGEMAKER_PROGRAM=cached_handler.py and D2_HANDLER_MODULE).
+
+Hit, miss, coalesced and eviction counters are logged as one JSON line every STATS_EVERY cached requests.
+
+Sagemaker inference toolkit doesn't allow transform_fn in the same module with
+input_fn/predict_fn/output_fn, hence the separate entry point.
+"""
+
+import importlib
+import json
+import logging
+import os
+import sys
+import threading
+import time
+
+import prediction_cache
+import shm_input
+import stage_timer
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.DEBUG)
+logger.addHandler(logging.StreamHandler(sys.stdout))
+
+handler = importlib.import_module(os.environ.get("D2_HANDLER_MODULE", "predict_coco"))
+
+# cache size limit in bytes of serialized responses, 0 disables caching
+CACHE_BYTES = int(os.environ.get("D2_PREDICTION_CACHE_BYTES", 256 * 1024 * 1024))
+
+# number of cached requests between cache stats reports
+STATS_EVERY = int(os.environ.get("D2_PREDICTION_CACHE_STATS_EVERY", 1000))
+
+_cache = prediction_cache.PredictionCache(CACHE_BYTES) if CACHE_BYTES > 0 else None
+_requests = 0
+_requests_lock = threading.Lock()
+_model_keys = {}
+
+
+def _model_key(model):
+    """
+    Hash of model config, covers weights location and inference parameters such as thresholds.
+    """
+
+    key = _model_keys.get(id(model))
+    if key is None and hasattr(model, "cfg"):
+        key = prediction_cache.make_key(model.cfg.dump())
+        _model_keys[id(model)] = key
+    elif key is None and hasattr(model, "names"):
+        # multi-model registry, request content type carries the model name
+        key = prediction_cache.make_key(model.model_dir, *model.names)
+        _model_keys[id(model)] = key
+    elif key is None:
+        # exported model, see exported_model.py
+        key = prediction_cache.make_key(model.path, json.dumps(model.metadata, sort_keys=True))
+        _model_keys[id(model)] = key
+
+    return key
+
+
+def model_fn(model_dir):
+
+    return handler.model_fn(model_dir)
+
+
+def transform_fn(model, request_body, request_content_type, response_content_type):
+
+    computed = []
+
+    def compute():
+        computed.append(True)
+        input_object = handler.input_fn(request_body, request_content_type)
+        prediction = handler.predict_fn(input_object, model)
+        output = handler.output_fn(prediction, response_content_type)
+        # streamed responses have to be materialized to be cached
+        if output is not None and not isinstance(output, (str, bytes)):
+            output = "".join(output)
+        return output
+
+    # shared memory requests carry only a handle of a slot which is reused for other images
+    if _cache is None or shm_input.CONTENT_TYPE in request_content_type:
+        return compute()
+
+    key = prediction_cache.make_key(request_body, request_content_type, response_content_type,
+                                    _model_key(model))
+    start = time.perf_counter()
+    output = _cache.get_or_compute(key, compute)
+    if not computed:
+        # hits and coalesced requests run no handler stages, the lookup is their only stage
+        stage_timer.start_request().add("cache", time.perf_counter() - start)
+        stage_timer.finish_request()
+
+    global _requests
+    with _requests_lock:
+        _requests += 1
+        report = _requests % STATS_EVERY == 0
+    if report:
+        logger.info(json.dumps({"prediction_cache": _cache.stats()}))
+
+    return output
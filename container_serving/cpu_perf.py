@@ -0,0 +1,171 @@
+"""
+CPU inference performance mode of Detectron2 predictors.
+
+optimize() tunes a loaded predictor for CPU instances:
+    - intra-op/inter-op thread counts
+    - channels_last memory format of backbone
+    - optional bfloat16 autocast of backbone ("backbone") or of backbone and heads ("all"),
+      outputs of autocast modules are cast back to float32, so that box decoding and mask
+      pasting keep full precision
+    - oneDNN weight prepacking with intel_extension_for_pytorch, if it is installed
+run_batch() runs forward passes of predictors optimized with inference_mode under torch.inference_mode.
+
+Configured with D2_CPU_* environment variables, all of them are ignored unless D2_CPU_PERF=1.
+bfloat16 changes predictions slightly and is fast only on CPUs with AVX512-BF16/AMX,
+compare accuracy with benchmarks/bench_cpu_perf.py before enabling it.
+"""
+
+import functools
+import logging
+import os
+import sys
+
+import torch
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.DEBUG)
+logger.addHandler(logging.StreamHandler(sys.stdout))
+
+ENABLED = os.environ.get("D2_CPU_PERF", "0") == "1"
+# 0 keeps torch defaults (number of physical cores, resp. inter-op pool size)
+THREADS = int(os.environ.get("D2_CPU_THREADS", 0))
+INTEROP_THREADS = int(os.environ.get("D2_CPU_INTEROP_THREADS", 0))
+CHANNELS_LAST = os.environ.get("D2_CPU_CHANNELS_LAST", "1") == "1"
+# "0", "backbone" or "all"
+BF16 = os.environ.get("D2_CPU_BF16", "0")
+INFERENCE_MODE = os.environ.get("D2_CPU_INFERENCE_MODE", "1") == "1"
+PREPACK = os.environ.get("D2_CPU_PREPACK", "1") == "1"
+
+BF16_MODES = ("0", "backbone", "all")
+
+# submodules run under autocast in "all" mode, (module path, method), missing ones are skipped
+_HEAD_METHODS = [
+    ("proposal_generator.rpn_head", "forward"),
+    ("roi_heads.res5", "forward"),
+    ("roi_heads.box_head", "forward"),
+    ("roi_heads.box_predictor", "forward"),
+    ("roi_heads.mask_head", "layers"),
+]
+
+try:
+    import intel_extension_for_pytorch as ipex
+except ImportError:
+    ipex = None
+
+
+def configure_threads(threads=THREADS, interop_threads=INTEROP_THREADS):
+    """
+    Sets torch thread pools sizes, 0 keeps the current size.
+    """
+
+    if threads > 0:
+        torch.set_num_threads(threads)
+    if interop_threads > 0:
+        try:
+            torch.set_num_interop_threads(interop_threads)
+        except RuntimeError as e:
+            # can be set only once, before any inter-op parallel work started
+            logger.warning(f"Can't set inter-op threads: {e}")
+
+    logger.info(f"Using {torch.get_num_threads()} intra-op and {torch.get_num_interop_threads()} inter-op threads")
+
+
+def inference_context(predictor):
+    """
+    Returns torch.inference_mode() context for predictors optimized with inference_mode
+    if it is available (torch>=1.9), torch.no_grad() otherwise.
+    """
+
+    if getattr(predictor, "inference_mode", False) and hasattr(torch, "inference_mode"):
+        return torch.inference_mode()
+    return torch.no_grad()
+
+
+def _to_float(value):
+
+    if isinstance(value, torch.Tensor):
+        return value.float() if value.dtype == torch.bfloat16 else value
+    if isinstance(value, dict):
+        return {k: _to_float(v) for k, v in value.items()}
+    if isinstance(value, (list, tuple)):
+        return type(value)(_to_float(v) for v in value)
+    return value
+
+
+def _wrap(obj, method, bf16=False, channels_last=False):
+    """
+    Replaces obj.method with a wrapper running it under bfloat16 autocast and/or with channels_last input.
+    Outputs are returned as float32 contiguous tensors, as the rest of the model expects.
+    """
+
+    fn = getattr(obj, method)
+
+    @functools.wraps(fn)
+    def wrapper(x, *args, **kwargs):
+
+        if channels_last and isinstance(x, torch.Tensor) and x.dim() == 4:
+            x = x.contiguous(memory_format=torch.channels_last)
+
+        if bf16:
+            with torch.cpu.amp.autocast(dtype=torch.bfloat16):
+                out = fn(x, *args, **kwargs)
+            out = _to_float(out)
+        else:
+            out = fn(x, *args, **kwargs)
+
+        if channels_last and isinstance(out, dict):
+            # ROIAlign and heads are faster (and some kernels only correct) with contiguous features
+            out = {k: v.contiguous() for k, v in out.items()}
+
+        return out
+
+    setattr(obj, method, wrapper)
+
+
+def _get_submodule(model, path):
+
+    for name in path.split("."):
+        model = getattr(model, name, None)
+        if model is None:
+            return None
+    return model
+
+
+def optimize(predictor, threads=THREADS, interop_threads=INTEROP_THREADS, channels_last=CHANNELS_LAST,
+             bf16=BF16, prepack=PREPACK, inference_mode=INFERENCE_MODE):
+    """
+    Applies CPU optimizations to predictor.model in place, see module docstring. Returns predictor.
+    """
+
+    if bf16 not in BF16_MODES:
+        raise ValueError(f"Unsupported bfloat16 mode {bf16}, expected one of {BF16_MODES}")
+
+    configure_threads(threads, interop_threads)
+
+    model = predictor.model
+    model.eval()
+
+    if channels_last:
+        model.backbone.to(memory_format=torch.channels_last)
+
+    if prepack and ipex is not None:
+        # prepacks conv weights to oneDNN blocked layout, weights are cast to bfloat16 if autocast is on
+        dtype = torch.bfloat16 if bf16 != "0" else torch.float32
+        model.backbone = ipex.optimize(model.backbone, dtype=dtype, inplace=True)
+    elif prepack:
+        logger.info("intel_extension_for_pytorch is not installed, skipping weight prepacking")
+
+    _wrap(model.backbone, "forward", bf16=bf16 != "0", channels_last=channels_last)
+
+    if bf16 == "all":
+        for path, method in _HEAD_METHODS:
+            module = _get_submodule(model, path)
+            if module is not None:
+                _wrap(module, method, bf16=True)
+
+    predictor.inference_mode = inference_mode
+
+    logger.info(f"CPU performance mode: channels_last={channels_last}, bf16={bf16}, "
+                f"prepack={prepack and ipex is not None}, inference_mode={inference_mode}")
+
+    return predictor
@@ -7,38 +7,160 @@ import json
 import torch
 import pycocotools.mask as mask_util
 import numpy as np
+import base64
+import math
+import os
+import struct
+from concurrent.futures import ThreadPoolExecutor
 from detectron2.structures import Instances, Boxes
 
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# content type of multi-image requests, see encode_image_batch()
+BATCH_CONTENT_TYPE = "application/x-image-batch"
+# content type of streamed responses, see d2_to_ndjson()
+NDJSON_CONTENT_TYPE = "application/x-ndjson"
+# content type of columnar binary responses, see d2_to_columnar()
+COLUMNAR_CONTENT_TYPE = "application/x-d2-columnar"
+
+# threads for RLE encoding of large mask stacks and masks per thread task
+RLE_THREADS = int(os.environ.get("D2_RLE_THREADS", 1))
+RLE_CHUNK_SIZE = 32
+_rle_pools = {}
+
+# fast JSON encoding of responses: numpy arrays are written directly (with orjson if installed),
+# boxes and scores are rounded to given decimals. Disabled by default, as output differs from
+# the compatible json.dumps output in float digits and whitespace.
+JSON_FAST = os.environ.get("D2_JSON_FAST", "0") == "1"
+JSON_BOX_PRECISION = int(os.environ.get("D2_JSON_BOX_PRECISION", 2))
+JSON_SCORE_PRECISION = int(os.environ.get("D2_JSON_SCORE_PRECISION", 4))
+
 
 def json_to_d2(predictions, device):
+    """
+    Deserializes JSON produced by d2_to_json(). Masks stay RLE encoded until accessed,
+    see LazyMaskInstances.
+    """
     
-    pred_dict = json.loads(predictions)
+    return _dict_to_d2(json.loads(predictions), device)
+
+
+class LazyMaskInstances(Instances):
+    """
+    Instances whose "pred_masks" are kept as pycocotools RLE and decoded on first access of
+    pred_masks (all at once with a single vectorized call). get_mask(i) decodes a single mask
+    without decoding the others, so clients which use only boxes never pay for masks.
+    Indexing and to() keep masks encoded.
+    """
     
-    for k, v in pred_dict.items():
-        if k=="pred_boxes":
-            boxes_to_tensor = torch.FloatTensor(v).to(device)
-            pred_dict[k] = Boxes(boxes_to_tensor)
-        if k=="scores":
-            pred_dict[k] = torch.Tensor(v).to(device)
-        if k=="pred_classes":
-            pred_dict[k] = torch.Tensor(v).to(device).to(torch.uint8)
-        if k=="pred_masks_rle":
-            # Convert masks from pycoco RLE format to Detectron2 format
-            pred_masks = np.stack([mask_util.decode(rle) for rle in v])
+    def __init__(self, image_size, pred_masks_rle=None, mask_device="cpu", **kwargs):
+        
+        # set before fields, Instances.__init__ checks their lengths with len(self)
+        self._rles = pred_masks_rle
+        self._mask_device = mask_device
+        super().__init__(image_size, **kwargs)
+    
+    def _decode_all(self):
+        
+        masks = convert_rle_to_masks(self._rles, self.image_size)
+        self._rles = None
+        self.set("pred_masks", torch.from_numpy(masks).to(self._mask_device))
+    
+    def __getattr__(self, name):
+        
+        if name == "pred_masks" and self.__dict__.get("_rles") is not None:
+            self._decode_all()
+        return super().__getattr__(name)
+    
+    def has(self, name):
+        
+        return (name == "pred_masks" and self._rles is not None) or super().has(name)
+    
+    def get(self, name):
+        
+        return getattr(self, name)
+    
+    def get_fields(self):
+        
+        if self._rles is not None:
+            self._decode_all()
+        return super().get_fields()
+    
+    def get_mask(self, i):
+        """
+        Returns H x W bool tensor of i-th instance mask.
+        """
+        
+        if self._rles is None:
+            return self.pred_masks[i]
+        return torch.from_numpy(convert_rle_to_masks([self._rles[i]], self.image_size)[0]).to(self._mask_device)
+    
+    def __len__(self):
+        
+        if self._rles is not None and not self._fields:
+            return len(self._rles)
+        return super().__len__()
     
-    pred_dict["pred_masks"] = torch.Tensor(pred_masks).to(device).to(torch.bool)
-    del pred_dict["pred_masks_rle"]
+    def __getitem__(self, item):
+        
+        ret = super().__getitem__(item)
+        if self._rles is None:
+            return ret
+        
+        if type(item) == int:
+            indices = [item % len(self)]
+        else:
+            if isinstance(item, torch.Tensor):
+                item = item.cpu().numpy()
+            indices = np.arange(len(self))[item]
+        
+        return LazyMaskInstances(ret.image_size, [self._rles[i] for i in indices], self._mask_device,
+                                 **Instances.get_fields(ret))
     
-    height, width = pred_dict['image_size']
-    del pred_dict['image_size']
+    def to(self, *args, **kwargs):
+        
+        ret = super().to(*args, **kwargs)
+        if self._rles is None:
+            return ret
+        
+        device = args[0] if args else kwargs.get("device", self._mask_device)
+        return LazyMaskInstances(ret.image_size, self._rles, device, **Instances.get_fields(ret))
+
 
+def _dict_to_d2(pred_dict, device):
+    """
+    Converts dict of _d2_to_dict() schema to predictions, each field with a single tensor construction.
+    """
+    
+    height, width = pred_dict["image_size"]
+    fields = {}
     
-    inst = Instances((height, width,), **pred_dict)
+    if "pred_boxes" in pred_dict:
+        boxes = np.asarray(pred_dict["pred_boxes"], dtype=np.float32).reshape(-1, 4)
+        fields["pred_boxes"] = Boxes(torch.from_numpy(boxes).to(device))
+    if "scores" in pred_dict:
+        fields["scores"] = torch.from_numpy(np.asarray(pred_dict["scores"], dtype=np.float32)).to(device)
+    if "pred_classes" in pred_dict:
+        fields["pred_classes"] = torch.from_numpy(np.asarray(pred_dict["pred_classes"], dtype=np.int64)).to(device)
+    if "pred_masks_roi" in pred_dict:
+        fields["pred_masks_roi"] = torch.from_numpy(decode_roi_masks(pred_dict["pred_masks_roi"])).to(device)
+    
+    if "pred_masks_rle" in pred_dict:
+        inst = LazyMaskInstances((height, width), pred_dict["pred_masks_rle"], device, **fields)
+    else:
+        inst = Instances((height, width), **fields)
     
     return {'instances':inst}
 
 
-def d2_to_json(predictions):
+def _d2_to_dict(predictions, precision=None):
+    """
+    Converts predictions to JSON-serializable dict. With precision = (box decimals, score decimals)
+    boxes, scores and classes are returned as rounded numpy arrays for _fast_dumps().
+    """
     
     instances = predictions["instances"]
     output = {}
@@ -46,43 +168,466 @@ def d2_to_json(predictions):
     # Iterate over fields in Instances
     for k,v in instances.get_fields().items():
         
-        if k in ["scores", "pred_classes"]:
+        if k in ["scores", "pred_classes"] and precision is None:
             output[k] = v.tolist()
             
-        if k=="pred_boxes":
+        if k=="pred_boxes" and precision is None:
             output[k] = v.tensor.tolist()
+        
+        # float32 values widened to float64 print with 17 digits, rounding in float64 keeps them short
+        if k=="pred_boxes" and precision is not None:
+            output[k] = np.round(v.tensor.cpu().numpy().astype(np.float64), precision[0])
+        
+        if k=="scores" and precision is not None:
+            output[k] = np.round(v.cpu().numpy().astype(np.float64), precision[1])
+        
+        if k=="pred_classes" and precision is not None:
+            output[k] = v.cpu().numpy().astype(np.int64)
             
         if k=="pred_masks":            
             output["pred_masks_rle"] = convert_masks_to_rle(v)
+            
+        # masks already encoded by the caller
+        if k=="pred_masks_rle":
+            output[k] = v
+            
+        if k=="pred_masks_roi":
+            output[k] = encode_roi_masks(v)
     
-    instances.remove('pred_masks')
+    if instances.has("pred_masks"):
+        instances.remove('pred_masks')
             
     # Store image size
     output['image_size'] = instances.image_size
-    output = json.dumps(output)
     
     return output
 
 
-def convert_masks_to_rle(pred_masks):
+def _to_list(obj):
+    
+    if isinstance(obj, np.ndarray):
+        return obj.tolist()
+    raise TypeError(f"Object of type {type(obj).__name__} is not JSON serializable")
+
+
+def _fast_dumps(obj):
+    """
+    Serializes dicts with numpy arrays, with orjson if installed, compact stdlib json otherwise.
+    """
+    
+    if orjson is not None:
+        return orjson.dumps(obj, option=orjson.OPT_SERIALIZE_NUMPY).decode("utf-8")
+    return json.dumps(obj, separators=(",", ":"), default=_to_list)
+
+
+def _json_precision(fast, box_precision, score_precision):
+    
+    fast = JSON_FAST if fast is None else fast
+    if not fast:
+        return None
+    return (JSON_BOX_PRECISION if box_precision is None else box_precision,
+            JSON_SCORE_PRECISION if score_precision is None else score_precision)
+
+
+def d2_to_json(predictions, fast=None, box_precision=None, score_precision=None):
+    """
+    Serializes Detectron2 predictions to JSON. Compatible mode (fast=False) produces the same bytes
+    as previous releases, fast mode rounds boxes and scores and writes numpy arrays directly.
+    Defaults come from D2_JSON_* environment variables.
+    """
+    
+    precision = _json_precision(fast, box_precision, score_precision)
+    if precision is None:
+        return json.dumps(_d2_to_dict(predictions))
+    return _fast_dumps(_d2_to_dict(predictions, precision))
+
+
+def d2_batch_to_json(predictions, fast=None, box_precision=None, score_precision=None):
+    """
+    Serializes list of per-image Detectron2 predictions to JSON array, see d2_to_json().
+    """
+    
+    precision = _json_precision(fast, box_precision, score_precision)
+    if precision is None:
+        return json.dumps([_d2_to_dict(p) for p in predictions])
+    return _fast_dumps([_d2_to_dict(p, precision) for p in predictions])
+
+
+def d2_to_ndjson(predictions, image_index=None):
+    """
+    Generator which serializes Detectron2 predictions as newline delimited JSON.
+    First line holds image metadata, then one line per instance. Masks are RLE encoded one
+    at a time while lines are consumed, so the whole response never exists in memory.
+    """
+    
+    instances = predictions["instances"]
+    
+    header = {"image_size": instances.image_size, "num_instances": len(instances)}
+    if image_index is not None:
+        header["image_index"] = image_index
+    yield json.dumps(header) + "\n"
+    
+    boxes = instances.pred_boxes.tensor.tolist() if instances.has("pred_boxes") else None
+    scores = instances.scores.tolist() if instances.has("scores") else None
+    classes = instances.pred_classes.tolist() if instances.has("pred_classes") else None
+    masks = instances.pred_masks if instances.has("pred_masks") else None
+    rles = instances.pred_masks_rle if instances.has("pred_masks_rle") else None
+    roi_masks = instances.pred_masks_roi if instances.has("pred_masks_roi") else None
+    
+    for i in range(len(instances)):
+        line = {}
+        if boxes is not None:
+            line["pred_boxes"] = boxes[i]
+        if scores is not None:
+            line["scores"] = scores[i]
+        if classes is not None:
+            line["pred_classes"] = classes[i]
+        if masks is not None:
+            line["pred_masks_rle"] = convert_masks_to_rle(masks[i:i + 1])[0]
+        if rles is not None:
+            line["pred_masks_rle"] = rles[i]
+        if roi_masks is not None:
+            line["pred_masks_roi"] = encode_roi_masks(roi_masks[i:i + 1])[0]
+        yield json.dumps(line) + "\n"
+
+
+def d2_batch_to_ndjson(predictions):
+    """
+    Serializes list of per-image predictions as NDJSON, image header lines carry image_index.
+    """
+    
+    for i, p in enumerate(predictions):
+        yield from d2_to_ndjson(p, image_index=i)
+
+
+def ndjson_to_d2(lines, device):
+    """
+    Deserializes NDJSON produced by d2_to_ndjson() from iterable of lines (e.g. streamed
+    response) to list of per-image predictions.
+    """
+    
+    images = []
+    for line in lines:
+        if not line.strip():
+            continue
+        item = json.loads(line)
+        if "image_size" in item:
+            images.append({"image_size": item["image_size"]})
+            continue
+        for k, v in item.items():
+            images[-1].setdefault(k, []).append(v)
+    
+    return [_dict_to_d2(p, device) for p in images]
+
+
+def json_to_d2_batch(predictions, device):
+    """
+    Deserializes JSON array produced by d2_batch_to_json() to list of per-image predictions.
+    """
+    
+    return [_dict_to_d2(p, device) for p in json.loads(predictions)]
+
+
+def encode_roi_masks(pred_masks_roi):
+    """
+    Encodes N x M x M uint8 ROI mask probabilities as list of base64 strings, one per instance.
+    """
+    
+    return [base64.b64encode(mask.tobytes()).decode("ascii") for mask in pred_masks_roi.cpu().numpy()]
+
+
+def decode_roi_masks(encoded):
+    """
+    Decodes base64 ROI masks to N x M x M uint8 array, masks are square.
+    """
+    
+    masks = [np.frombuffer(base64.b64decode(m), dtype=np.uint8) for m in encoded]
+    if not masks:
+        return np.zeros((0, 0, 0), dtype=np.uint8)
+    
+    size = int(round(math.sqrt(len(masks[0]))))
+    return np.stack(masks).reshape(-1, size, size)
+
+
+def paste_roi_masks(instances, indices=None, threshold=0.5):
+    """
+    Pastes ROI-resolution masks of instances (all or selected by indices) into full image.
+    Returns K x H x W bool tensor, so clients pay for pasting only the masks they render.
+    """
+    
+    from detectron2.layers import paste_masks_in_image
+    
+    masks = instances.pred_masks_roi
+    boxes = instances.pred_boxes.tensor
+    if indices is not None:
+        masks, boxes = masks[indices], boxes[indices]
+    
+    return paste_masks_in_image(masks.float() / 255, boxes, instances.image_size, threshold=threshold)
+
+
+# Columnar binary format, one record per image:
+#   header: magic, version, flags, instance count N, image height, width, RLE blob length,
+#           ROI mask size M
+#   float32 boxes N x 4 | float32 scores N | uint16 classes N | uint32 RLE offsets N+1 | RLE blob |
+#   uint8 ROI masks N x M x M
+# Every section starts at 8-byte aligned offset, so it can be read with np.frombuffer without copy.
+_COLUMNAR_MAGIC = b"D2CB"
+_COLUMNAR_VERSION = 1
+_COLUMNAR_HEADER = struct.Struct("<4sHHIIIII")
+_COLUMNAR_HAS_MASKS = 1
+_COLUMNAR_HAS_ROI_MASKS = 2
+# columns can be dropped with "fields" request option, absent columns have zero length
+_COLUMNAR_HAS_COLUMN = {"pred_boxes": 4, "scores": 8, "pred_classes": 16}
+
+
+def _pad8(n):
+    return (8 - n % 8) % 8
+
+
+def _columnar_sections(n, rle_len, roi_size, flags):
+    """
+    Returns list of (name, dtype, count) in the order of sections in a record.
+    """
+    
+    def column(name, count):
+        return count if flags & _COLUMNAR_HAS_COLUMN[name] else 0
+    
+    return [("pred_boxes", np.float32, column("pred_boxes", n * 4)), ("scores", np.float32, column("scores", n)),
+            ("pred_classes", np.uint16, column("pred_classes", n)), ("rle_offsets", np.uint32, n + 1),
+            ("rle_blob", np.uint8, rle_len), ("pred_masks_roi", np.uint8, n * roi_size * roi_size)]
+
+
+def d2_to_columnar(predictions):
+    """
+    Serializes Detectron2 predictions (or list of them) to columnar binary format.
+    """
+    
+    if isinstance(predictions, list):
+        return b"".join(d2_to_columnar(p) for p in predictions)
+    
+    instances = predictions["instances"]
+    n = len(instances)
+    height, width = instances.image_size
+    
+    flags = 0
+    rle_offsets = np.zeros(n + 1, dtype=np.uint32)
+    rle_blob = b""
+    if instances.has("pred_masks") or instances.has("pred_masks_rle"):
+        flags |= _COLUMNAR_HAS_MASKS
+        rles = instances.pred_masks_rle if instances.has("pred_masks_rle") \
+            else convert_masks_to_rle(instances.pred_masks)
+        counts = [rle["counts"].encode("utf-8") for rle in rles]
+        rle_offsets[1:] = np.cumsum([len(c) for c in counts])
+        rle_blob = b"".join(counts)
+    
+    pred_masks_roi = np.zeros((n, 0, 0), dtype=np.uint8)
+    if instances.has("pred_masks_roi"):
+        flags |= _COLUMNAR_HAS_ROI_MASKS
+        pred_masks_roi = instances.pred_masks_roi.cpu().numpy()
+    roi_size = pred_masks_roi.shape[-1]
+    
+    arrays = {
+        "pred_boxes": np.zeros(0, dtype=np.float32),
+        "scores": np.zeros(0, dtype=np.float32),
+        "pred_classes": np.zeros(0, dtype=np.uint16),
+        "rle_offsets": rle_offsets,
+        "rle_blob": np.frombuffer(rle_blob, dtype=np.uint8),
+        "pred_masks_roi": pred_masks_roi,
+    }
+    
+    if instances.has("pred_boxes"):
+        arrays["pred_boxes"] = instances.pred_boxes.tensor.cpu().numpy().astype(np.float32)
+    if instances.has("scores"):
+        arrays["scores"] = instances.scores.cpu().numpy().astype(np.float32)
+    if instances.has("pred_classes"):
+        arrays["pred_classes"] = instances.pred_classes.cpu().numpy().astype(np.uint16)
+    for name, flag in _COLUMNAR_HAS_COLUMN.items():
+        if instances.has(name):
+            flags |= flag
+    
+    chunks = [_COLUMNAR_HEADER.pack(_COLUMNAR_MAGIC, _COLUMNAR_VERSION, flags, n, height, width,
+                                     len(rle_blob), roi_size)]
+    chunks.append(b"\0" * _pad8(_COLUMNAR_HEADER.size))
+    for name, _, _ in _columnar_sections(n, len(rle_blob), roi_size, flags):
+        data = arrays[name].tobytes()
+        chunks.append(data)
+        chunks.append(b"\0" * _pad8(len(data)))
+    
+    return b"".join(chunks)
+
+
+def decode_columnar(data):
+    """
+    Parses columnar binary response into list of per-image dicts of numpy arrays.
+    Arrays are zero-copy views of data. "pred_masks_rle" holds pycocotools RLE dicts,
+    whose counts are memoryview slices of the RLE blob.
+    """
+    
+    data = memoryview(data)
+    offset = 0
+    images = []
+    
+    while offset < len(data):
+        magic, version, flags, n, height, width, rle_len, roi_size = _COLUMNAR_HEADER.unpack_from(data, offset)
+        if magic != _COLUMNAR_MAGIC or version != _COLUMNAR_VERSION:
+            raise ValueError(f"Not a columnar D2 record at offset {offset}")
+        offset += _COLUMNAR_HEADER.size + _pad8(_COLUMNAR_HEADER.size)
+        
+        image = {"image_size": (height, width)}
+        for name, dtype, count in _columnar_sections(n, rle_len, roi_size, flags):
+            arr = np.frombuffer(data, dtype=dtype, count=count, offset=offset)
+            image[name] = arr
+            offset += arr.nbytes + _pad8(arr.nbytes)
+        
+        for name, flag in _COLUMNAR_HAS_COLUMN.items():
+            if not flags & flag:
+                del image[name]
+        if "pred_boxes" in image:
+            image["pred_boxes"] = image["pred_boxes"].reshape(n, 4)
+        
+        pred_masks_roi = image.pop("pred_masks_roi")
+        if flags & _COLUMNAR_HAS_ROI_MASKS:
+            image["pred_masks_roi"] = pred_masks_roi.reshape(n, roi_size, roi_size)
+        
+        rle_offsets, rle_blob = image.pop("rle_offsets"), image.pop("rle_blob")
+        if flags & _COLUMNAR_HAS_MASKS:
+            blob = memoryview(rle_blob)
+            image["pred_masks_rle"] = [{"size": [height, width], "counts": blob[rle_offsets[i]:rle_offsets[i + 1]]}
+                                       for i in range(n)]
+        images.append(image)
+    
+    return images
+
+
+def _columnar_image_to_d2(image, device):
+    
+    height, width = image["image_size"]
+    fields = {}
+    if "pred_boxes" in image:
+        fields["pred_boxes"] = Boxes(torch.as_tensor(image["pred_boxes"]).to(device))
+    if "scores" in image:
+        fields["scores"] = torch.as_tensor(image["scores"]).to(device)
+    if "pred_classes" in image:
+        fields["pred_classes"] = torch.as_tensor(image["pred_classes"].astype(np.int64)).to(device)
+    if "pred_masks_roi" in image:
+        fields["pred_masks_roi"] = torch.as_tensor(image["pred_masks_roi"]).to(device)
+    if "pred_masks_rle" in image:
+        return {"instances": LazyMaskInstances((height, width), image["pred_masks_rle"], device, **fields)}
+    
+    return {"instances": Instances((height, width), **fields)}
+
+
+def columnar_to_d2(data, device):
+    """
+    Deserializes single-image columnar binary response to Detectron2 predictions.
+    """
+    
+    return _columnar_image_to_d2(decode_columnar(data)[0], device)
+
+
+def columnar_to_d2_batch(data, device):
+    """
+    Deserializes multi-image columnar binary response to list of Detectron2 predictions.
+    """
+    
+    return [_columnar_image_to_d2(image, device) for image in decode_columnar(data)]
+
+
+def encode_image_batch(images):
+    """
+    Packs list of encoded images (JPEG or NPY bytes) into a single request body of
+    BATCH_CONTENT_TYPE: uint32 image count, then uint32 length and bytes of each image.
+    """
+    
+    chunks = [struct.pack("<I", len(images))]
+    for image in images:
+        chunks.append(struct.pack("<I", len(image)))
+        chunks.append(bytes(image))
+    
+    return b"".join(chunks)
+
+
+def decode_image_batch(body):
+    """
+    Splits BATCH_CONTENT_TYPE request body into list of memoryviews, one per encoded image.
+    """
+    
+    body = memoryview(body)
+    count, = struct.unpack_from("<I", body, 0)
+    offset = 4
+    
+    images = []
+    for _ in range(count):
+        length, = struct.unpack_from("<I", body, offset)
+        offset += 4
+        if offset + length > len(body):
+            raise ValueError(f"Batch body is truncated: image {len(images)} needs {length} bytes")
+        images.append(body[offset:offset + length])
+        offset += length
+    
+    return images
+
+
+def _encode_masks(pred_masks):
+    """
+    Encodes N x H x W numpy stack of binary masks with a single pycocotools call.
+    """
+    
+    if len(pred_masks) == 0:
+        return []
+    
+    # pycocotools expects column-major H x W x N uint8 array, so the whole stack is
+    # transposed with one copy instead of one np.asfortranarray per mask
+    masks = np.asfortranarray(pred_masks.view(np.uint8).transpose(1, 2, 0))
+    return mask_util.encode(masks)
+
+
+def _get_rle_pool(num_threads):
+    
+    if num_threads not in _rle_pools:
+        _rle_pools[num_threads] = ThreadPoolExecutor(num_threads, thread_name_prefix="rle")
+    return _rle_pools[num_threads]
+
+
+def convert_masks_to_rle(pred_masks, num_threads=None):
     """
     Convert masks to pycoco binary RLE format to reduce size
     https://github.com/cocodataset/cocoapi/blob/master/PythonAPI/pycocotools/mask.py
+    
+    With num_threads > 1 large mask stacks are split in chunks encoded in a thread pool,
+    mostly transposition copies run in parallel as pycocotools encoding holds the GIL.
     """
     
-    pred_masks = pred_masks.cpu()
-    pred_masks_rle = [mask_util.encode(np.asfortranarray(mask)) for mask in pred_masks]
+    num_threads = num_threads or RLE_THREADS
+    pred_masks = pred_masks.cpu().numpy()
+    
+    if num_threads > 1 and len(pred_masks) > RLE_CHUNK_SIZE:
+        chunks = [pred_masks[i:i + RLE_CHUNK_SIZE] for i in range(0, len(pred_masks), RLE_CHUNK_SIZE)]
+        pred_masks_rle = [rle for rles in _get_rle_pool(num_threads).map(_encode_masks, chunks) for rle in rles]
+    else:
+        pred_masks_rle = _encode_masks(pred_masks)
     
     for rle in pred_masks_rle:
         rle['counts'] = rle['counts'].decode('utf-8')
     
     return pred_masks_rle
 
-def convert_rle_to_masks(pred_masks_rle):
+def convert_rle_to_masks(pred_masks_rle, image_size=None):
     """
-    Convert RLE masks to D2 mask format
+    Convert RLE masks to N x H x W bool array (D2 mask format) with a single pycocotools call.
+    image_size gives the shape of an empty result.
     """
-    return np.stack([mask_util.decode(pred_masks_rle) for rle in v])    
+    
+    if len(pred_masks_rle) == 0:
+        return np.zeros((0,) + tuple(image_size or (0, 0)), dtype=bool)
+    
+    # counts of columnar responses are memoryviews, pycocotools needs bytes or str
+    rles = [rle if isinstance(rle["counts"], (bytes, str)) else {"size": rle["size"], "counts": bytes(rle["counts"])}
+            for rle in pred_masks_rle]
+    
+    # H x W x N column-major array is N x H x W after transposition, one copy makes it contiguous
+    masks = mask_util.decode(rles)
+    return np.ascontiguousarray(masks.transpose(2, 0, 1)).view(bool)
     
     
 if __name__ == "__main__":
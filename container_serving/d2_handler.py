@@ -0,0 +1,343 @@
+"""
+Detectron2 inference shared by predict_coco.py and predict_drone.py handlers: model loading
+(single model or multi-model registry, see model_registry.py), request decoding, prediction and
+response serialization. Handlers wrap these functions into Sagemaker model_fn/input_fn/predict_fn/
+output_fn, which log and swallow errors, and add their dataset specific parts.
+
+Configured with D2_* environment variables below.
+"""
+
+import io
+import logging
+import os
+import pickle
+import sys
+import time
+
+import cv2
+import numpy as np
+from detectron2.config import get_cfg
+from detectron2.engine import DefaultPredictor
+from sagemaker_inference import content_types, decoder
+
+import batching
+import cpu_perf
+import d2_deserializer
+import fast_weights
+import image_decode
+import model_registry
+import request_options
+import shm_input
+import stage_timer
+import warmup
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.DEBUG)
+logger.addHandler(logging.StreamHandler(sys.stdout))
+
+# lowest score threshold, requests can raise it with score_threshold option
+SCORE_THRESH_TEST = float(os.environ.get("D2_SCORE_THRESH_TEST", 0.5))
+
+# micro-batching of concurrent requests, disabled when max batch size is 1
+MAX_BATCH_SIZE = int(os.environ.get("D2_MAX_BATCH_SIZE", 1))
+MAX_BATCH_DELAY_MS = float(os.environ.get("D2_MAX_BATCH_DELAY_MS", 10))
+# max images per forward pass for multi-image requests
+REQUEST_BATCH_SIZE = int(os.environ.get("D2_REQUEST_BATCH_SIZE", 8))
+# decode JPEGs at reduced scale close to model input size
+REDUCED_JPEG_DECODE = os.environ.get("D2_REDUCED_JPEG_DECODE", "0") == "1"
+
+# return NDJSON responses as generator of lines instead of joined string,
+# only for servers which can stream iterables (Multi Model Server can't)
+STREAM_RESPONSES = os.environ.get("D2_STREAM_RESPONSES", "0") == "1"
+
+# warm-up runs per image shape at model load, 0 disables warm-up
+WARMUP_ITERATIONS = int(os.environ.get("D2_WARMUP_ITERATIONS", 1))
+# warm-up shapes as "HxW,HxW", used when model_dir has no warm-up manifest
+WARMUP_SHAPES = os.environ.get("D2_WARMUP_SHAPES", "")
+WARMUP_MANIFEST = "warmup.json"
+# if set, shapes of incoming images are recorded to this warm-up manifest
+WARMUP_RECORD_PATH = os.environ.get("D2_WARMUP_RECORD_PATH")
+
+_shape_recorder = warmup.ShapeRecorder(WARMUP_RECORD_PATH) if WARMUP_RECORD_PATH else None
+
+# multi-model endpoints: memory budget of loaded predictors and model used when request has no "model" option
+MODEL_MEMORY_BUDGET_MB = int(os.environ.get("D2_MODEL_MEMORY_BUDGET_MB", 4096))
+DEFAULT_MODEL = os.environ.get("D2_DEFAULT_MODEL")
+
+# (MIN_SIZE_TEST, MAX_SIZE_TEST) of loaded models by name, None is the name of single model
+_test_sizes = {}
+_default_model = None
+
+
+def get_predictor(config_path, model_path, warmup_shapes=(), configure=None):
+    """
+    Builds predictor of config and weights, configure(cfg) adds handler specific config.
+    """
+
+    cfg = get_cfg()
+
+    cfg.merge_from_file(config_path) # get baseline parameters from YAML config
+    cfg.MODEL.ROI_HEADS.SCORE_THRESH_TEST = SCORE_THRESH_TEST  # set threshold for this model, requests can only raise it
+    cfg.MODEL.WEIGHTS = model_path
+    if configure is not None:
+        configure(cfg)
+
+    if model_path.endswith(fast_weights.EXTENSION):
+        pred = fast_weights.load_predictor(cfg, model_path)
+    else:
+        pred = DefaultPredictor(cfg)
+    logger.info(cfg)
+    pred.model.eval()
+
+    if cpu_perf.ENABLED and cfg.MODEL.DEVICE == "cpu":
+        cpu_perf.optimize(pred)
+
+    if WARMUP_ITERATIONS > 0 and warmup_shapes:
+        warmup.warmup(pred, warmup_shapes, WARMUP_ITERATIONS, MAX_BATCH_SIZE)
+
+    return pred
+
+
+def load_predictor(model_dir, name=None, configure=None):
+    """
+    Loads single model from model_dir, name identifies it in multi-model endpoints.
+    """
+
+    # Restoring trained model, take a first .yaml and .pth/.pkl/.d2w file in the model directory
+    for file in os.listdir(model_dir):
+        # looks up for yaml file with model config
+        if file.endswith(".yaml"):
+            config_path = os.path.join(model_dir, file)
+        # looks up for *.pkl or *.pth files with model weights
+        if file.endswith(".pth") or file.endswith(".pkl"):
+            model_path = os.path.join(model_dir, file)
+
+    # memory-mapped weights load faster, prefer them if present
+    for file in os.listdir(model_dir):
+        if file.endswith(fast_weights.EXTENSION):
+            model_path = os.path.join(model_dir, file)
+
+    manifest_path = os.path.join(model_dir, WARMUP_MANIFEST)
+    if os.path.exists(manifest_path):
+        warmup_shapes = warmup.load_manifest(manifest_path)
+    elif WARMUP_SHAPES:
+        warmup_shapes = warmup.parse_shapes(WARMUP_SHAPES)
+    else:
+        warmup_shapes = warmup.DEFAULT_SHAPES
+
+    logger.info(f"Using config file {config_path}")
+    logger.info(f"Using model weights from {model_path}")
+
+    pred = get_predictor(config_path, model_path, warmup_shapes, configure)
+
+    _test_sizes[name] = (pred.cfg.INPUT.MIN_SIZE_TEST, pred.cfg.INPUT.MAX_SIZE_TEST)
+
+    return pred
+
+
+def load_model(model_dir, configure=None):
+    """
+    Loads predictor from model_dir, or ModelRegistry which loads them lazily if model_dir
+    has a subdirectory per model.
+    """
+
+    global _default_model
+
+    names = model_registry.find_models(model_dir)
+    if names is None:
+        return load_predictor(model_dir, configure=configure)
+
+    logger.info(f"Found models {names}")
+    registry = model_registry.ModelRegistry(model_dir, names,
+                                            lambda path: load_predictor(path, os.path.basename(path), configure),
+                                            MODEL_MEMORY_BUDGET_MB * 2**20, DEFAULT_MODEL,
+                                            on_evict=batching.close_batcher)
+    _default_model = registry.default_model
+
+    return registry
+
+
+def shape(input_object):
+
+    if isinstance(input_object, list):
+        return [shape(image) for image in input_object]
+    if isinstance(input_object, dict):
+        return input_object["image"].shape
+    return input_object.shape
+
+
+def decode_jpeg(payload, options=None, reduced=True):
+    """
+    Decodes JPEG. With reduced decoding returns dict with reduced image and original size,
+    reduced=False forces full resolution.
+    """
+
+    options = options or {}
+    test_size = _test_sizes.get(options.get("model", _default_model))
+    # models of multi-model endpoints are decoded at full size until they are loaded
+    if REDUCED_JPEG_DECODE and reduced and test_size is not None:
+        min_size = options.get("min_size", test_size[0])
+        max_size = options.get("max_size", test_size[1])
+        img, (height, width) = image_decode.decode_jpeg(payload, min_size, max_size)
+        return {"image": img, "height": height, "width": width}
+
+    return cv2.imdecode(np.frombuffer(payload, np.uint8), cv2.IMREAD_COLOR)
+
+
+def decode_batch_item(payload, options=None, reduced=True):
+    """
+    Decodes single image of multi-image request, format is detected by magic bytes.
+    """
+
+    if bytes(payload[:6]) == b"\x93NUMPY":
+        return np.load(io.BytesIO(payload), allow_pickle=False)
+    elif bytes(payload[:2]) == b"\xff\xd8":
+        return decode_jpeg(payload, options, reduced)
+    else:
+        raise Exception("Batch item is neither JPEG nor NPY")
+
+
+def decode_input(request_body, request_content_type, reduced=True):
+    """
+    Decodes request to numpy image (or image dict), or list of them for multi-image requests,
+    with request options attached. Records shapes of the images if WARMUP_RECORD_PATH is set.
+    """
+
+    options = request_options.parse_options(request_content_type)
+
+    if d2_deserializer.BATCH_CONTENT_TYPE in request_content_type:
+        input_object = [decode_batch_item(p, options, reduced)
+                        for p in d2_deserializer.decode_image_batch(request_body)]
+    elif shm_input.CONTENT_TYPE in request_content_type:
+        # zero-copy view of image in shared memory of a co-located client
+        input_object = shm_input.decode_request(request_body)
+    elif "application/x-npy" in request_content_type:
+        input_object = decoder.decode(request_body, content_types.NPY)
+    elif "jpeg" in request_content_type:
+        input_object = decode_jpeg(request_body, options, reduced)
+    elif "json" in request_content_type:
+        payloads, envelope_options, batched = request_options.parse_envelope(request_body)
+        options = dict(options, **envelope_options)
+        input_object = [decode_batch_item(p, options, reduced) for p in payloads]
+        if not batched:
+            input_object = input_object[0]
+    else:
+        raise Exception(f"Unsupported request content type {request_content_type}")
+
+    if options and isinstance(input_object, list):
+        input_object = [request_options.attach_options(image, options) for image in input_object]
+    elif options:
+        input_object = request_options.attach_options(input_object, options)
+
+    if _shape_recorder is not None:
+        for image in (input_object if isinstance(input_object, list) else [input_object]):
+            if isinstance(image, dict):
+                _shape_recorder.record(image["height"], image["width"])
+            else:
+                _shape_recorder.record(*image.shape[:2])
+
+    return input_object
+
+
+def resolve_predictor(model, options):
+    """
+    Returns (predictor, model name) of request options, name is None for single-model endpoints.
+    """
+
+    if not isinstance(model, model_registry.ModelRegistry):
+        return model, None
+
+    name = model.resolve(options.get("model"))
+    return model.get(name), name
+
+
+def predict(input_object, model, predict_image=None):
+    """
+    Runs decoded request through predictor or ModelRegistry model. predict_image(predictor, image)
+    replaces batched inference if it is set, e.g. for tiled inference.
+    """
+
+    predictor, model_name = resolve_predictor(model, request_options.get_options(input_object))
+    start = time.monotonic()
+
+    if predict_image is not None:
+        images = input_object if isinstance(input_object, list) else [input_object]
+        prediction = [predict_image(predictor, image) for image in images]
+        if not isinstance(input_object, list):
+            prediction = prediction[0]
+    elif isinstance(input_object, list):
+        prediction = batching.run_batch(predictor, input_object, REQUEST_BATCH_SIZE)
+    elif MAX_BATCH_SIZE > 1:
+        prediction = batching.get_batcher(predictor, MAX_BATCH_SIZE, MAX_BATCH_DELAY_MS, model_name)(input_object)
+    else:
+        # same as predictor(input_object), but with per-stage timings and request options
+        prediction = batching.run_batch(predictor, [input_object])[0]
+
+    if model_name is not None:
+        model.record_latency(model_name, time.monotonic() - start)
+        # stats() sorts latency windows, compute it only for sampled requests
+        if stage_timer.sample_debug(logger):
+            logger.debug("Model registry stats: %s", model.stats())
+
+    # stringifying Instances is expensive, log only sampled requests
+    if stage_timer.sample_debug(logger):
+        logger.debug("Predictions are: %s", prediction)
+
+    return prediction
+
+
+def _masks_to_rle(prediction):
+
+    instances = prediction['instances']
+    if not instances.has("pred_masks"):
+        return prediction
+
+    rle_masks = d2_deserializer.convert_masks_to_rle(instances.get_fields()["pred_masks"])
+    instances.set("pred_masks_rle", rle_masks)
+    instances.remove('pred_masks')
+
+    return prediction
+
+
+def serialize(prediction, response_content_type):
+    """
+    Serializes predictions. Predictions of multi-image request are serialized as a list,
+    one item per image. NDJSON responses are generators of lines if STREAM_RESPONSES is set,
+    their serialization happens after output_fn returns and is not included in its timing.
+    """
+
+    if d2_deserializer.NDJSON_CONTENT_TYPE not in response_content_type:
+        # masks are encoded upfront, so that RLE time is reported apart from serialization,
+        # NDJSON encodes them lazily line by line
+        with stage_timer.stage("rle"):
+            for p in (prediction if isinstance(prediction, list) else [prediction]):
+                _masks_to_rle(p)
+
+    with stage_timer.stage("serialize"):
+        if d2_deserializer.NDJSON_CONTENT_TYPE in response_content_type:
+            if isinstance(prediction, list):
+                output = d2_deserializer.d2_batch_to_ndjson(prediction)
+            else:
+                output = d2_deserializer.d2_to_ndjson(prediction)
+            if not STREAM_RESPONSES:
+                output = "".join(output)
+
+        elif d2_deserializer.COLUMNAR_CONTENT_TYPE in response_content_type:
+            output = d2_deserializer.d2_to_columnar(prediction)
+
+        elif "json" in response_content_type:
+            if isinstance(prediction, list):
+                output = d2_deserializer.d2_batch_to_json(prediction)
+            else:
+                output = d2_deserializer.d2_to_json(prediction)
+
+        elif "detectron2" in response_content_type:
+            logger.debug("check prediction before pickling")
+            logger.debug(type(prediction))
+
+            output = pickle.dumps(prediction)
+
+        else:
+            raise Exception(f"Unsupported response content type {response_content_type}")
+
+    return output
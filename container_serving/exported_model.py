@@ -0,0 +1,231 @@
+"""
+Inference with models exported by torchscript_export.py, without Detectron2.
+
+Exported graph takes image resized to test resolution and returns plain tensors (boxes, scores,
+classes, masks) in original image resolution, see torchscript_export.ExportWrapper. Resize
+parameters come from metadata stored with the graph.
+
+TorchScriptPredictor runs .ts graphs with pasted masks, OnnxPredictor runs .onnx graphs with
+onnxruntime (optional dependency) and pastes ROI masks itself.
+"""
+
+import json
+import logging
+import os
+import sys
+
+import cv2
+import numpy as np
+import pycocotools.mask as mask_util
+import torch
+import torchvision  # registers nms/roi_align ops used by traced graphs
+from PIL import Image
+
+import request_options
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.DEBUG)
+logger.addHandler(logging.StreamHandler(sys.stdout))
+
+TORCHSCRIPT_EXTENSION = ".ts"
+ONNX_EXTENSION = ".onnx"
+# keep in sync with torchscript_export.METADATA_FILE
+METADATA_FILE = "metadata.json"
+
+
+def resize_shortest_edge(image, min_size, max_size):
+    """
+    Resizes HxWxC uint8 image as detectron2 ResizeShortestEdge does at test time.
+    """
+
+    h, w = image.shape[:2]
+    scale = min_size / min(h, w)
+    if max(h, w) * scale > max_size:
+        scale = max_size / max(h, w)
+    new_h, new_w = int(h * scale + 0.5), int(w * scale + 0.5)
+
+    if (new_h, new_w) == (h, w):
+        return image
+    # PIL bilinear, same as detectron2 ResizeTransform for uint8 images
+    return np.asarray(Image.fromarray(image).resize((new_w, new_h), Image.BILINEAR))
+
+
+class TorchScriptPredictor:
+    """
+    Callable similar to DefaultPredictor: takes HxWx3 BGR numpy image, returns dict of
+    boxes, scores, classes and masks tensors in original image resolution.
+    """
+
+    def __init__(self, path, device="cpu"):
+
+        extra_files = {METADATA_FILE: ""}
+        self.model = torch.jit.load(path, map_location=device, _extra_files=extra_files)
+        self.model.eval()
+        self.metadata = json.loads(extra_files[METADATA_FILE])
+        self.path = path
+        self.device = device
+
+        logger.info(f"Loaded TorchScript model {path} with metadata {self.metadata}")
+
+    def __call__(self, image, min_size=None, max_size=None, with_masks=True):
+
+        height, width = image.shape[:2]
+        image = resize_shortest_edge(image, min_size or self.metadata["min_size_test"],
+                                     max_size or self.metadata["max_size_test"])
+
+        # the traced graph always runs the mask head, with_masks only drops its output
+        with torch.no_grad():
+            boxes, scores, classes, masks = self.model(
+                torch.as_tensor(np.ascontiguousarray(image), device=self.device),
+                torch.tensor(height, device=self.device), torch.tensor(width, device=self.device))
+
+        predictions = {"boxes": boxes, "scores": scores, "classes": classes, "image_size": (height, width)}
+        if self.metadata["mask_on"] and with_masks:
+            predictions["masks"] = masks
+
+        return predictions
+
+
+def paste_masks(roi_masks, boxes, height, width, threshold=0.5):
+    """
+    Pastes N x 1 x M x M ROI mask probabilities into N x height x width binary masks.
+    Each mask is resized to its box extent with bilinear interpolation, as detectron2 pastes them.
+    """
+
+    masks = np.zeros((len(roi_masks), height, width), dtype=bool)
+    for mask, mask_roi, box in zip(masks, roi_masks, boxes):
+        x0, y0 = int(np.floor(box[0])), int(np.floor(box[1]))
+        x1, y1 = int(np.ceil(box[2])), int(np.ceil(box[3]))
+        if x1 <= x0 or y1 <= y0:
+            continue
+
+        resized = cv2.resize(mask_roi[0], (x1 - x0, y1 - y0), interpolation=cv2.INTER_LINEAR) >= threshold
+        # boxes are clipped to image, rounding out can still exceed it by a pixel
+        mask[y0:y1, x0:x1] = resized[:height - y0, :width - x0]
+
+    return masks
+
+
+class OnnxPredictor:
+    """
+    Same interface as TorchScriptPredictor, runs ONNX graph with onnxruntime.
+    graph_optimization_level is one of "disabled", "basic", "extended", "all",
+    0 threads lets onnxruntime choose.
+    """
+
+    def __init__(self, path, device="cpu", graph_optimization_level="all", intra_op_threads=0, inter_op_threads=0):
+
+        import onnxruntime as ort
+
+        options = ort.SessionOptions()
+        options.graph_optimization_level = {
+            "disabled": ort.GraphOptimizationLevel.ORT_DISABLE_ALL,
+            "basic": ort.GraphOptimizationLevel.ORT_ENABLE_BASIC,
+            "extended": ort.GraphOptimizationLevel.ORT_ENABLE_EXTENDED,
+            "all": ort.GraphOptimizationLevel.ORT_ENABLE_ALL,
+        }[graph_optimization_level]
+        options.intra_op_num_threads = intra_op_threads
+        options.inter_op_num_threads = inter_op_threads
+        if inter_op_threads > 1:
+            options.execution_mode = ort.ExecutionMode.ORT_PARALLEL
+
+        providers = ["CUDAExecutionProvider", "CPUExecutionProvider"] if device.startswith("cuda") \
+            else ["CPUExecutionProvider"]
+        self.session = ort.InferenceSession(path, options, providers=providers)
+        self.metadata = {k: json.loads(v) for k, v in self.session.get_modelmeta().custom_metadata_map.items()}
+        self.path = path
+        self.device = device
+
+        logger.info(f"Loaded ONNX model {path} with providers {self.session.get_providers()} and metadata {self.metadata}")
+
+    def __call__(self, image, min_size=None, max_size=None, with_masks=True):
+
+        height, width = image.shape[:2]
+        image = resize_shortest_edge(image, min_size or self.metadata["min_size_test"],
+                                     max_size or self.metadata["max_size_test"])
+
+        boxes, scores, classes, masks = self.session.run(None, {
+            "image": np.ascontiguousarray(image),
+            "height": np.array(height, dtype=np.int64),
+            "width": np.array(width, dtype=np.int64),
+        })
+
+        predictions = {"boxes": torch.from_numpy(boxes), "scores": torch.from_numpy(scores),
+                       "classes": torch.from_numpy(classes), "image_size": (height, width)}
+        if self.metadata["mask_on"] and with_masks:
+            predictions["masks"] = torch.from_numpy(paste_masks(masks, boxes, height, width))
+
+        return predictions
+
+
+def load_predictor(model_dir, device="cpu", backend=None, **onnx_options):
+    """
+    Loads exported model from model_dir. backend "torchscript" or "onnxruntime" selects
+    .ts or .onnx file if model_dir has both, by default the first exported file found is used.
+    """
+
+    extensions = {"torchscript": [TORCHSCRIPT_EXTENSION], "onnxruntime": [ONNX_EXTENSION],
+                  None: [TORCHSCRIPT_EXTENSION, ONNX_EXTENSION]}[backend]
+
+    for file in sorted(os.listdir(model_dir)):
+        path = os.path.join(model_dir, file)
+        if file.endswith(TORCHSCRIPT_EXTENSION) and TORCHSCRIPT_EXTENSION in extensions:
+            return TorchScriptPredictor(path, device)
+        if file.endswith(ONNX_EXTENSION) and ONNX_EXTENSION in extensions:
+            return OnnxPredictor(path, device, **onnx_options)
+
+    raise Exception(f"No {' or '.join(extensions)} model found in {model_dir}")
+
+
+def apply_options(predictions, options):
+    """
+    Applies request options (see request_options.py) to predictions of exported model.
+    "masks" option supports only "full" and "none", exported graph returns pasted masks.
+    """
+
+    if options.get("masks") == "roi":
+        raise ValueError("masks=roi is not supported by exported models")
+
+    keep = torch.ones_like(predictions["scores"], dtype=torch.bool)
+    if "score_threshold" in options:
+        keep &= predictions["scores"] >= options["score_threshold"]
+    if "classes" in options:
+        allowed = torch.as_tensor(options["classes"], device=predictions["classes"].device)
+        keep &= (predictions["classes"][:, None] == allowed[None, :]).any(dim=1)
+
+    indices = keep.nonzero().flatten()
+    if "max_detections" in options:
+        # exported models return instances sorted by score
+        indices = indices[:options["max_detections"]]
+
+    fields = options.get("fields", ["boxes", "scores", "classes", "masks"])
+    if not request_options.wants_masks(options):
+        fields = [f for f in fields if f != "masks"]
+    output = {k: v[indices] for k, v in predictions.items() if k in fields}
+    output["image_size"] = predictions["image_size"]
+
+    return output
+
+
+def to_dict(predictions):
+    """
+    Converts predictions to dict of the same schema as d2_deserializer.d2_to_json output.
+    """
+
+    output = {}
+    if "boxes" in predictions:
+        output["pred_boxes"] = predictions["boxes"].tolist()
+    if "scores" in predictions:
+        output["scores"] = predictions["scores"].tolist()
+    if "classes" in predictions:
+        output["pred_classes"] = predictions["classes"].tolist()
+    if "masks" in predictions:
+        masks = predictions["masks"].cpu().numpy()
+        rles = mask_util.encode(np.asfortranarray(masks.view(np.uint8).transpose(1, 2, 0))) if len(masks) else []
+        for rle in rles:
+            rle["counts"] = rle["counts"].decode("utf-8")
+        output["pred_masks_rle"] = rles
+
+    output["image_size"] = list(predictions["image_size"])
+
+    return output
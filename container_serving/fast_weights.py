@@ -0,0 +1,166 @@
+"""
+Flat, memory-mapped weights format for fast model loading.
+
+Loading .pth/.pkl through DetectionCheckpointer unpickles the whole checkpoint, remaps Caffe2
+names (for .pkl) and copies every tensor. A .d2w file stores tensors of the model state dict
+under their final names as raw aligned bytes, so loading is an mmap plus zero-copy views for
+CPU models, or a single host-to-device copy per tensor for GPU models.
+
+File layout:
+    b"D2W1" | uint64 header length | JSON header | padding | tensor data, each 64-byte aligned
+
+Convert existing weights with:
+    python fast_weights.py --config config.yaml --weights model_final.pth --output model_final.d2w
+"""
+
+import argparse
+import json
+import logging
+import struct
+import sys
+
+import numpy as np
+import torch
+from detectron2.checkpoint import DetectionCheckpointer
+from detectron2.config import get_cfg
+from detectron2.engine import DefaultPredictor
+from detectron2.modeling import build_model
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.DEBUG)
+logger.addHandler(logging.StreamHandler(sys.stdout))
+
+MAGIC = b"D2W1"
+EXTENSION = ".d2w"
+_ALIGNMENT = 64
+
+
+def _aligned(offset):
+    return (offset + _ALIGNMENT - 1) // _ALIGNMENT * _ALIGNMENT
+
+
+def save(state_dict, path):
+    """
+    Writes state dict to .d2w file.
+    """
+
+    arrays = {name: tensor.detach().cpu().contiguous().numpy() for name, tensor in state_dict.items()}
+
+    tensors = []
+    offset = 0
+    for name, arr in arrays.items():
+        offset = _aligned(offset)
+        tensors.append({"name": name, "dtype": arr.dtype.str, "shape": list(arr.shape),
+                        "offset": offset, "nbytes": arr.nbytes})
+        offset += arr.nbytes
+
+    header = json.dumps({"tensors": tensors}).encode("utf-8")
+    data_start = _aligned(len(MAGIC) + 8 + len(header))
+
+    with open(path, "wb") as f:
+        f.write(MAGIC)
+        f.write(struct.pack("<Q", len(header)))
+        f.write(header)
+        for meta, arr in zip(tensors, arrays.values()):
+            f.seek(data_start + meta["offset"])
+            f.write(arr.tobytes())
+
+    logger.info(f"Saved {len(tensors)} tensors to {path}")
+
+
+def load(path):
+    """
+    Returns dict of CPU tensors which are copy-on-write views of memory-mapped .d2w file.
+    """
+
+    buffer = np.memmap(path, dtype=np.uint8, mode="c")
+    if bytes(buffer[:4]) != MAGIC:
+        raise ValueError(f"{path} is not a {EXTENSION} file")
+
+    header_len, = struct.unpack("<Q", bytes(buffer[4:12]))
+    header = json.loads(bytes(buffer[12:12 + header_len]))
+    data_start = _aligned(len(MAGIC) + 8 + header_len)
+
+    state_dict = {}
+    for meta in header["tensors"]:
+        start = data_start + meta["offset"]
+        arr = buffer[start:start + meta["nbytes"]].view(np.dtype(meta["dtype"])).reshape(meta["shape"])
+        state_dict[meta["name"]] = torch.from_numpy(arr)
+
+    return state_dict
+
+
+def load_into(model, path):
+    """
+    Loads .d2w weights into model parameters and buffers without intermediate copies.
+    """
+
+    state_dict = load(path)
+
+    # parameters and persistent buffers, not detached
+    targets = model.state_dict(keep_vars=True)
+
+    missing = sorted(set(targets) - set(state_dict))
+    unexpected = sorted(set(state_dict) - set(targets))
+    if missing:
+        logger.warning(f"Weights missing in {path}: {missing}")
+    if unexpected:
+        logger.warning(f"Weights not used by the model: {unexpected}")
+
+    for name, tensor in state_dict.items():
+        target = targets.get(name)
+        if target is None:
+            continue
+        if target.shape != tensor.shape:
+            raise ValueError(f"Shape mismatch for {name}: {tuple(tensor.shape)} in file, "
+                             f"{tuple(target.shape)} in model")
+
+        if target.device.type == "cpu" and target.dtype == tensor.dtype:
+            # point parameter to the mapped memory, pages are loaded on first access
+            target.data = tensor
+        else:
+            target.data.copy_(tensor)
+
+    return model
+
+
+def load_predictor(cfg, path):
+    """
+    Builds DefaultPredictor for cfg and loads its weights from .d2w file.
+    """
+
+    cfg = cfg.clone()
+    cfg.MODEL.WEIGHTS = "" # skip DetectionCheckpointer
+    pred = DefaultPredictor(cfg)
+
+    load_into(pred.model, path)
+    pred.cfg.MODEL.WEIGHTS = path
+
+    return pred
+
+
+def convert(config_path, weights_path, output_path):
+    """
+    Converts .pth/.pkl weights to .d2w. Names are remapped by DetectionCheckpointer once,
+    here, instead of on every model load.
+    """
+
+    cfg = get_cfg()
+    cfg.merge_from_file(config_path)
+    cfg.MODEL.DEVICE = "cpu"
+
+    model = build_model(cfg)
+    DetectionCheckpointer(model).load(weights_path)
+
+    save(model.state_dict(), output_path)
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--config', type=str, required=True)
+    parser.add_argument('--weights', type=str, required=True)
+    parser.add_argument('--output', type=str, required=True)
+    args = parser.parse_args()
+
+    convert(args.config, args.weights, args.output)
@@ -0,0 +1,115 @@
+"""
+Size-aware JPEG decoding.
+
+DefaultPredictor shrinks every image to INPUT.MIN_SIZE_TEST/MAX_SIZE_TEST right after decode.
+For large images (e.g. 6000x4000 drone frames) most of the decode work and memory is thrown away.
+decode_jpeg() reads image size from JPEG header first and lets libjpeg decode directly at 1/2, 1/4
+or 1/8 scale (DCT scaling), so that decoded image is still not smaller than the model input.
+"""
+
+import math
+import struct
+
+import cv2
+import numpy as np
+
+# libjpeg DCT scaling factors supported by OpenCV, largest first
+_REDUCED_FLAGS = [
+    (8, cv2.IMREAD_REDUCED_COLOR_8),
+    (4, cv2.IMREAD_REDUCED_COLOR_4),
+    (2, cv2.IMREAD_REDUCED_COLOR_2),
+]
+
+# start of frame markers which carry image size, DHT (C4), JPG (C8) and DAC (CC) share the range
+_SOF_MARKERS = set(range(0xC0, 0xD0)) - {0xC4, 0xC8, 0xCC}
+
+
+def jpeg_size(data):
+    """
+    Returns (height, width) stored in JPEG header or None if data is not a valid JPEG.
+    Only header segments are scanned, no pixel data is decoded.
+    """
+
+    data = memoryview(data)
+    if bytes(data[:2]) != b"\xff\xd8":
+        return None
+
+    offset = 2
+    while offset + 4 <= len(data):
+        if data[offset] != 0xFF:
+            return None
+
+        marker = data[offset + 1]
+        # fill bytes and standalone markers don't have length field
+        if marker == 0xFF:
+            offset += 1
+            continue
+        if marker == 0x01 or 0xD0 <= marker <= 0xD8:
+            offset += 2
+            continue
+
+        length, = struct.unpack_from(">H", data, offset + 2)
+        if marker in _SOF_MARKERS:
+            if offset + 9 > len(data):
+                return None
+            height, width = struct.unpack_from(">HH", data, offset + 5)
+            return height, width
+
+        offset += 2 + length
+
+    return None
+
+
+def target_scale(height, width, min_size, max_size):
+    """
+    Returns scale which ResizeShortestEdge(min_size, max_size) applies to image of given size.
+    """
+
+    if min_size <= 0:
+        return 1.0
+
+    scale = min_size / min(height, width)
+    if max(height, width) * scale > max_size:
+        scale = max_size / max(height, width)
+
+    return scale
+
+
+def reduction_factor(height, width, min_size, max_size):
+    """
+    Returns largest DCT scaling factor which keeps decoded image not smaller than the model input.
+    """
+
+    scale = target_scale(height, width, min_size, max_size)
+
+    for factor, _ in _REDUCED_FLAGS:
+        if factor * scale <= 1.0:
+            return factor
+
+    return 1
+
+
+def decode_jpeg(data, min_size, max_size):
+    """
+    Decodes JPEG at the smallest scale that still covers the model input size.
+    Returns tuple of BGR image and (height, width) of the original image, so that predictions
+    can be rescaled back to the original resolution.
+    """
+
+    nparr = np.frombuffer(data, np.uint8)
+    size = jpeg_size(data)
+
+    factor = reduction_factor(*size, min_size, max_size) if size else 1
+    if factor == 1:
+        img = cv2.imdecode(nparr, cv2.IMREAD_COLOR)
+        return img, img.shape[:2]
+
+    img = cv2.imdecode(nparr, dict(_REDUCED_FLAGS)[factor])
+    height, width = size
+
+    # OpenCV applies EXIF orientation, header size is before rotation
+    expected = (math.ceil(height / factor), math.ceil(width / factor))
+    if img.shape[:2] != expected and img.shape[:2] == expected[::-1]:
+        height, width = width, height
+
+    return img, (height, width)
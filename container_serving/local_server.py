@@ -0,0 +1,266 @@
+"""
+Asyncio HTTP front-end of the serving handlers, a local stand-in for Sagemaker model server.
+
+Serves GET /ping and POST /invocations (Content-Type and Accept headers are passed to the
+handlers as request/response content types) of a handler module with model_fn/input_fn/
+predict_fn/output_fn (e.g. predict_coco) or model_fn/transform_fn (cached_handler).
+
+The event loop only parses HTTP. Decoding, inference and serialization run in a thread pool of
+`workers` threads, so several requests are in flight at once (and can share micro-batches, see
+batching.py). At most `max_queue` requests wait for a worker, further requests are rejected with
+503 right away, so latency stays bounded under overload. Server-Timing header carries stage
+timings of the request (see stage_timer.py), generator responses (NDJSON with
+D2_STREAM_RESPONSES=1) are sent with chunked transfer encoding. worker_pool.py runs several
+servers in forked processes pinned to disjoint cores, sharing one loaded model.
+
+Sample command:
+    python local_server.py --model-dir /opt/ml/model --handler predict_coco --port 8080 --workers 4
+"""
+
+import argparse
+import asyncio
+import importlib
+import logging
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+from http import HTTPStatus
+
+import stage_timer
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.DEBUG)
+logger.addHandler(logging.StreamHandler(sys.stdout))
+
+MAX_HEADER_BYTES = 64 * 1024
+MAX_BODY_BYTES = 100 * 1024 * 1024
+DEFAULT_CONTENT_TYPE = "application/x-npy"
+DEFAULT_ACCEPT = "application/json"
+
+
+class HttpError(Exception):
+
+    def __init__(self, status, message=""):
+        super().__init__(message)
+        self.status = status
+
+
+class ModelServer:
+    """
+    Runs handler module behind asyncio HTTP server with bounded request queue.
+    """
+
+    def __init__(self, handler, model_dir, workers=1, max_queue=16, model=None, request_counter=None):
+        """
+        model is loaded with handler.model_fn(model_dir) unless it is passed already loaded
+        (e.g. by worker_pool.py). request_counter (e.g. multiprocessing.RawValue) counts served requests.
+        """
+
+        self.handler = handler
+        self.workers = workers
+        self.max_queue = max_queue
+        self.executor = ThreadPoolExecutor(workers, thread_name_prefix="handler")
+
+        if model is None:
+            start = time.monotonic()
+            model = handler.model_fn(model_dir)
+            logger.info(f"Model loaded in {time.monotonic() - start:.2f} s")
+        self.model = model
+
+        self._pending = 0
+        self.rejected = 0
+        self.request_counter = request_counter
+
+    def _invoke(self, body, content_type, accept):
+        """
+        Runs the handlers in a worker thread, returns output and Server-Timing header value.
+        """
+
+        stage_timer.clear_server_timing()
+        if hasattr(self.handler, "transform_fn"):
+            output = self.handler.transform_fn(self.model, body, content_type, accept)
+        else:
+            input_object = self.handler.input_fn(body, content_type)
+            prediction = self.handler.predict_fn(input_object, self.model)
+            output = self.handler.output_fn(prediction, accept)
+
+        return output, stage_timer.last_server_timing()
+
+    async def invoke(self, body, content_type, accept):
+
+        # requests beyond workers + max_queue are shed instead of queued
+        if self._pending >= self.workers + self.max_queue:
+            self.rejected += 1
+            raise HttpError(HTTPStatus.SERVICE_UNAVAILABLE, "Server is overloaded")
+
+        self._pending += 1
+        streamed = False
+        try:
+            loop = asyncio.get_event_loop()
+            output, server_timing = await loop.run_in_executor(self.executor, self._invoke, body, content_type,
+                                                               accept)
+            # generators are serialized in the executor while they are sent, the request stays
+            # counted until _write_response() consumed it
+            streamed = output is not None and not isinstance(output, (str, bytes))
+            return output, server_timing
+        finally:
+            if not streamed:
+                self._pending -= 1
+
+    async def _read_request(self, reader):
+
+        try:
+            head = await reader.readuntil(b"\r\n\r\n")
+        except asyncio.LimitOverrunError:
+            raise HttpError(HTTPStatus.REQUEST_HEADER_FIELDS_TOO_LARGE)
+
+        lines = head.decode("latin-1").split("\r\n")
+        headers = {}
+        for line in lines[1:]:
+            name, sep, value = line.partition(":")
+            if sep:
+                headers[name.strip().lower()] = value.strip()
+
+        try:
+            method, path, _ = lines[0].split(" ", 2)
+            length = int(headers.get("content-length", 0))
+        except ValueError:
+            raise HttpError(HTTPStatus.BAD_REQUEST, "Malformed request")
+
+        if "chunked" in headers.get("transfer-encoding", ""):
+            raise HttpError(HTTPStatus.LENGTH_REQUIRED, "Chunked request bodies are not supported")
+        if length < 0:
+            raise HttpError(HTTPStatus.BAD_REQUEST, "Negative Content-Length")
+        if length > MAX_BODY_BYTES:
+            raise HttpError(HTTPStatus.REQUEST_ENTITY_TOO_LARGE)
+        body = await reader.readexactly(length) if length else b""
+
+        return method, path.split("?")[0], headers, body
+
+    async def _write_response(self, writer, status, body=b"", content_type="text/plain", headers=None):
+
+        head = [f"HTTP/1.1 {status.value} {status.phrase}", f"Content-Type: {content_type}"]
+        head += [f"{k}: {v}" for k, v in (headers or {}).items() if v]
+
+        if isinstance(body, (str, bytes)):
+            body = body.encode("utf-8") if isinstance(body, str) else body
+            head.append(f"Content-Length: {len(body)}")
+            writer.write(("\r\n".join(head) + "\r\n\r\n").encode("latin-1") + body)
+            await writer.drain()
+            return
+
+        # generator response of invoke(), lines are produced in the executor as they are sent
+        try:
+            head.append("Transfer-Encoding: chunked")
+            writer.write(("\r\n".join(head) + "\r\n\r\n").encode("latin-1"))
+            loop = asyncio.get_event_loop()
+            iterator = iter(body)
+            while True:
+                chunk = await loop.run_in_executor(self.executor, next, iterator, None)
+                if chunk is None:
+                    break
+                chunk = chunk.encode("utf-8") if isinstance(chunk, str) else chunk
+                writer.write(f"{len(chunk):x}\r\n".encode("latin-1") + chunk + b"\r\n")
+                await writer.drain()
+            writer.write(b"0\r\n\r\n")
+            await writer.drain()
+        finally:
+            self._pending -= 1
+
+    async def _handle(self, method, path, headers, body):
+
+        if path == "/ping" and method == "GET":
+            return HTTPStatus.OK, b"", "text/plain", {}
+
+        if path == "/invocations" and method == "POST":
+            accept = headers.get("accept", DEFAULT_ACCEPT)
+            output, server_timing = await self.invoke(body, headers.get("content-type", DEFAULT_CONTENT_TYPE), accept)
+            if output is None:
+                # handlers log and swallow their exceptions
+                raise HttpError(HTTPStatus.INTERNAL_SERVER_ERROR, "Inference failed, see server log")
+            if self.request_counter is not None:
+                self.request_counter.value += 1
+            return HTTPStatus.OK, output, accept, {"Server-Timing": server_timing}
+
+        raise HttpError(HTTPStatus.NOT_FOUND)
+
+    async def handle_connection(self, reader, writer):
+
+        try:
+            while True:
+                try:
+                    method, path, headers, body = await self._read_request(reader)
+                except (asyncio.IncompleteReadError, ConnectionError):
+                    break
+
+                try:
+                    status, output, content_type, response_headers = await self._handle(method, path, headers, body)
+                except HttpError as e:
+                    status, output, content_type, response_headers = e.status, str(e), "text/plain", {}
+                except Exception as e:
+                    # handlers reject bad requests with inference toolkit errors carrying status_code
+                    status = getattr(e, "status_code", None)
+                    if isinstance(status, int) and 400 <= status < 500:
+                        status, output, content_type, response_headers = (HTTPStatus(status),
+                                                                          getattr(e, "message", None) or str(e),
+                                                                          "text/plain", {})
+                    else:
+                        logger.error(f"Request {method} {path} failed...")
+                        logger.exception(e)
+                        status, output, content_type, response_headers = (HTTPStatus.INTERNAL_SERVER_ERROR,
+                                                                          "Inference failed, see server log",
+                                                                          "text/plain", {})
+
+                await self._write_response(writer, status, output, content_type, response_headers)
+                if headers.get("connection", "").lower() == "close":
+                    break
+        except HttpError as e:
+            await self._write_response(writer, e.status, str(e))
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+
+    def serve(self, host, port, sock=None):
+        """
+        Serves on host:port, or on already bound sock shared by several processes.
+        """
+
+        # written without asyncio.run(), the serving image runs Python 3.6
+        loop = asyncio.get_event_loop()
+        if sock is not None:
+            host, port = sock.getsockname()[:2]
+            server = loop.run_until_complete(
+                asyncio.start_server(self.handle_connection, sock=sock, limit=MAX_HEADER_BYTES))
+        else:
+            server = loop.run_until_complete(
+                asyncio.start_server(self.handle_connection, host, port, limit=MAX_HEADER_BYTES))
+        logger.info(f"Serving on {host}:{port} with {self.workers} workers and queue of {self.max_queue} requests")
+
+        try:
+            loop.run_forever()
+        finally:
+            server.close()
+            loop.run_until_complete(server.wait_closed())
+            self.executor.shutdown()
+
+
+def main(args):
+
+    handler = importlib.import_module(args.handler)
+    server = ModelServer(handler, args.model_dir, args.workers, args.max_queue)
+    server.serve(args.host, args.port)
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--model-dir', type=str, default="/opt/ml/model")
+    parser.add_argument('--handler', type=str, default="predict_coco", help="handler module")
+    parser.add_argument('--host', type=str, default="0.0.0.0")
+    parser.add_argument('--port', type=int, default=8080)
+    parser.add_argument('--workers', type=int, default=1, help="requests processed concurrently")
+    parser.add_argument('--max-queue', type=int, default=16, help="requests waiting for a worker, more are rejected")
+    args = parser.parse_args()
+
+    main(args)
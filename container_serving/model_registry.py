@@ -0,0 +1,173 @@
+"""
+Hosting of several named models in one endpoint.
+
+Multi-model layout of model_dir has one subdirectory per model, each in the layout model_fn()
+expects for a single model (.yaml config and .pth/.pkl/.d2w weights):
+
+    model_dir/coco/config.yaml, model_dir/coco/model_final.pth
+    model_dir/drone/config.yaml, model_dir/drone/model_final.d2w
+
+Requests select a model with "model" option (e.g. "image/jpeg; model=drone"). Predictors are
+loaded on first use and kept in an LRU bounded by memory budget, least recently used predictors
+are evicted when a new one doesn't fit. on_evict(name) callback releases what else holds the
+evicted predictor (e.g. its micro-batcher, see batching.close_batcher).
+"""
+
+import gc
+import logging
+import os
+import sys
+import threading
+import time
+from collections import OrderedDict
+
+import torch
+
+import stage_timer
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.DEBUG)
+logger.addHandler(logging.StreamHandler(sys.stdout))
+
+
+def _is_model_dir(path):
+
+    files = os.listdir(path)
+    return any(f.endswith(".yaml") for f in files) and \
+        any(f.endswith((".pth", ".pkl", ".d2w")) for f in files)
+
+
+def find_models(model_dir):
+    """
+    Returns sorted names of model subdirectories, or None if model_dir holds a single model.
+    """
+
+    if _is_model_dir(model_dir):
+        return None
+
+    return sorted(name for name in os.listdir(model_dir)
+                  if os.path.isdir(os.path.join(model_dir, name)) and _is_model_dir(os.path.join(model_dir, name)))
+
+
+def predictor_bytes(predictor):
+    """
+    Estimates memory held by predictor as size of model parameters and buffers.
+    """
+
+    return sum(t.numel() * t.element_size() for t in predictor.model.state_dict().values())
+
+
+class ModelRegistry:
+    """
+    Lazily loads predictors with loader(model_path) and keeps them in a memory-bounded LRU.
+    """
+
+    def __init__(self, model_dir, names, loader, memory_budget_bytes, default_model=None, on_evict=None):
+
+        if not names:
+            raise ValueError(f"No models found in {model_dir}")
+
+        self.model_dir = model_dir
+        self.names = list(names)
+        self.default_model = default_model or self.names[0]
+        self.memory_budget_bytes = memory_budget_bytes
+
+        self.loads = 0
+        self.evictions = 0
+        self.latencies = stage_timer.StageHistograms()
+
+        self._loader = loader
+        self._on_evict = on_evict
+        self._predictors = OrderedDict()
+        self._sizes = {}
+        self._lock = threading.Lock()
+        self._load_locks = {name: threading.Lock() for name in self.names}
+
+    def resolve(self, name):
+
+        name = name or self.default_model
+        if name not in self._load_locks:
+            raise ValueError(f"Unknown model {name}, available models are {self.names}")
+        return name
+
+    def get(self, name=None):
+        """
+        Returns predictor of named model, loads it on first use.
+        """
+
+        name = self.resolve(name)
+
+        with self._lock:
+            if name in self._predictors:
+                self._predictors.move_to_end(name)
+                return self._predictors[name]
+
+        # one loader per model, other models stay available while it runs
+        with self._load_locks[name]:
+            with self._lock:
+                if name in self._predictors:
+                    self._predictors.move_to_end(name)
+                    return self._predictors[name]
+
+            start = time.monotonic()
+            predictor = self._loader(os.path.join(self.model_dir, name))
+            size = predictor_bytes(predictor)
+            logger.info(f"Loaded model {name} ({size / 2**20:.1f} MB) in {time.monotonic() - start:.2f} s")
+
+            with self._lock:
+                self._predictors[name] = predictor
+                self._sizes[name] = size
+                self.loads += 1
+                evicted = self._evict(keep=name)
+
+            # outside of the lock, callbacks may wait for in-flight requests of evicted models
+            self._release(evicted)
+
+        return predictor
+
+    def _evict(self, keep):
+        """
+        Drops least recently used predictors until loaded ones fit memory budget, returns their names.
+        """
+
+        evicted = []
+        while sum(self._sizes.values()) > self.memory_budget_bytes and len(self._predictors) > 1:
+            name = next(n for n in self._predictors if n != keep)
+            del self._predictors[name]
+            size = self._sizes.pop(name)
+            self.evictions += 1
+            evicted.append(name)
+            logger.info(f"Evicted model {name} ({size / 2**20:.1f} MB) to fit memory budget")
+
+        return evicted
+
+    def _release(self, evicted):
+
+        if not evicted:
+            return
+
+        if self._on_evict is not None:
+            for name in evicted:
+                self._on_evict(name)
+
+        gc.collect()
+        if torch.cuda.is_available():
+            torch.cuda.empty_cache()
+
+    def record_latency(self, name, seconds):
+
+        self.latencies.add({name: seconds})
+
+    def stats(self):
+
+        with self._lock:
+            loaded = {name: self._sizes[name] for name in self._predictors}
+
+        return {
+            "loaded": list(loaded),
+            "loaded_bytes": sum(loaded.values()),
+            "memory_budget_bytes": self.memory_budget_bytes,
+            "loads": self.loads,
+            "evictions": self.evictions,
+            "latency": self.latencies.percentiles(),
+        }
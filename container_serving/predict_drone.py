@@ -32,52 +32,51 @@ from sagemaker_inference import content_types, decoder, default_inference_handle
 # from sagemaker.content_types import CONTENT_TYPE_JSON, CONTENT_TYPE_CSV, CONTENT_TYPE_NPY # TODO: for local debug only. Remove or comment when deploying remotely.
 # from six import StringIO, BytesIO  # TODO: for local debug only. Remove or comment when deploying remotely.
 import d2_deserializer
+import d2_handler
+import batching
+import request_options
+import stage_timer
+import tiling
+import video_sequence
 import pycocotools.mask as mask_util
 
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.DEBUG)
 logger.addHandler(logging.StreamHandler(sys.stdout))
 
+# tiled inference of images larger than tile size at native resolution, see tiling.py
+TILED_INFERENCE = os.environ.get("D2_TILED_INFERENCE", "0") == "1"
+TILE_SIZE = int(os.environ.get("D2_TILE_SIZE", 1024))
+TILE_OVERLAP = int(os.environ.get("D2_TILE_OVERLAP", 128))
+TILE_BATCH_SIZE = int(os.environ.get("D2_TILE_BATCH_SIZE", 4))
+TILE_MERGE_THRESH = float(os.environ.get("D2_TILE_MERGE_THRESH", 0.5))
 
-def _get_predictor(config_path, model_path):
-    
-    cfg = get_cfg()
-    
-    cfg.merge_from_file(config_path) # get baseline parameters from YAML config
-    cfg.MODEL.ROI_HEADS.SCORE_THRESH_TEST = 0.5  # set threshold for this model
-    cfg.MODEL.WEIGHTS = model_path
-    cfg.DATASETS.TEST = ("drone_dataset", )
+# frame-sequence requests (video chunks or ordered frame batches), see video_sequence.py;
+# requests can override the defaults with keyframe_interval, diff_threshold and propagate options
+SEQUENCE_KEYFRAME_INTERVAL = int(os.environ.get("D2_SEQUENCE_KEYFRAME_INTERVAL", 5))
+SEQUENCE_DIFF_THRESH = float(os.environ.get("D2_SEQUENCE_DIFF_THRESH", 12.0))
+SEQUENCE_PROPAGATE = os.environ.get("D2_SEQUENCE_PROPAGATE", "reuse")
+# decoded frames buffered ahead of inference
+SEQUENCE_DECODE_QUEUE = int(os.environ.get("D2_SEQUENCE_DECODE_QUEUE", 8))
 
-    pred = DefaultPredictor(cfg)
-    logger.info(cfg)
-    eval_results = pred.model.eval()
 
-    return pred
+def _configure(cfg):
+    
+    cfg.DATASETS.TEST = ("drone_dataset", )
 
 
+@stage_timer.timed("model_fn", start=True, finish=True)
 def model_fn(model_dir):
     """
     Deserialize and load D2 model. This method is called automatically by Sagemaker.
     model_dir is location where your trained model will be downloaded.
+    If model_dir has a subdirectory per model, returns ModelRegistry which loads them lazily.
     """
     
     logger.info("Deserializing Detectron2 model...")
     
     try:
-        # Restoring trained model, take a first .yaml and .pth/.pkl file in the model directory
-        for file in os.listdir(model_dir):
-            # looks up for yaml file with model config
-            if file.endswith(".yaml"):
-                config_path = os.path.join(model_dir, file)
-            # looks up for *.pkl or *.pth files with model weights
-            if file.endswith(".pth") or file.endswith(".pkl"):
-                model_path = os.path.join(model_dir, file)
-
-        logger.info(f"Using config file {config_path}")
-        logger.info(f"Using model weights from {model_path}")            
-
-        pred = _get_predictor(config_path,model_path)
-        
+        pred = d2_handler.load_model(model_dir, _configure)
     except Exception as e:
         logger.error("Model deserialization failed...")
         logger.error(e)  
@@ -87,76 +86,129 @@ def model_fn(model_dir):
     return pred
 
 
+def _shape(input_object):
+    
+    if isinstance(input_object, video_sequence.FrameSequence):
+        return f"{input_object.mime} sequence"
+    return d2_handler.shape(input_object)
+
+
+@stage_timer.timed("input_fn", start=True)
 def input_fn(request_body, request_content_type):
     """
     Converts image from NPY format to numpy.
+    Multi-image requests are converted to list of numpy images.
+    Inference options from content type parameters or JSON envelope are attached to images,
+    see request_options.py.
+    Video chunks and frame sequences are converted to FrameSequence, which decodes frames
+    in background thread during prediction.
     """
     logger.info(f"Handling inputs...Content type is {request_content_type}")
     
+    # tiled inference needs native resolution
+    reduced = not TILED_INFERENCE
+    
     try:
-        if "application/x-npy" in request_content_type:
-            input_object = decoder.decode(request_body, CONTENT_TYPE_NPY)
-        elif "jpeg" in request_content_type:
-            nparr = np.frombuffer(request_body, np.uint8)
-            img = cv2.imdecode(nparr, cv2.IMREAD_COLOR)
-            input_object = np.asarray(img)
+        if video_sequence.is_sequence_request(request_content_type):
+            options = request_options.parse_options(request_content_type)
+            input_object = video_sequence.FrameSequence(
+                request_body, request_content_type,
+                lambda payload: d2_handler.decode_batch_item(payload, options, reduced),
+                options, SEQUENCE_DECODE_QUEUE)
         else:
-            raise Exception(f"Unsupported request content type {request_content_type}")
+            input_object = d2_handler.decode_input(request_body, request_content_type, reduced)
     except Exception as e:
         logger.error("Input deserialization failed...")
         logger.error(e)  
         return None
-            
+    
     logger.info("Input deserialization completed...")
-    logger.info(f"Input object type is {type(input_object)} and shape {input_object.shape}")
+    logger.info(f"Input object type is {type(input_object)} and shape {_shape(input_object)}")
 
     return input_object
 
 
+def _predict_tiled(model, image):
+    """
+    Runs tiled inference of images larger than tile size, smaller images go to the model as a whole.
+    """
+    
+    height, width = d2_handler.shape(image)[:2]
+    if max(height, width) <= TILE_SIZE:
+        return batching.run_batch(model, [image])[0]
+    
+    return tiling.run_tiled(model, image, TILE_SIZE, TILE_OVERLAP, TILE_BATCH_SIZE, TILE_MERGE_THRESH)
+
+
+def _predict_sequence(model, sequence):
+    """
+    Returns lazy SequenceRun, frames are decoded and detected while its results are consumed by output_fn.
+    """
+    
+    model, _ = d2_handler.resolve_predictor(model, sequence.options)
+    
+    def detect(frame):
+        if TILED_INFERENCE:
+            return _predict_tiled(model, frame)
+        return batching.run_batch(model, [frame])[0]
+    
+    options = sequence.options
+    return video_sequence.SequenceRun(detect, sequence,
+                                      options.get("keyframe_interval", SEQUENCE_KEYFRAME_INTERVAL),
+                                      options.get("diff_threshold", SEQUENCE_DIFF_THRESH),
+                                      options.get("propagate", SEQUENCE_PROPAGATE))
+
+
+@stage_timer.timed("predict_fn")
 def predict_fn(input_object, model):
     # according to D2 rquirements: https://detectron2.readthedocs.io/tutorials/models.html
     
     logger.info("Doing predictions...")
-    logger.debug(f"Input object type is {type(input_object)} and shape {input_object.shape}")
+    logger.debug(f"Input object type is {type(input_object)} and shape {_shape(input_object)}")
     logger.debug(f"Predictor type is {type(model)}")
     
     try:
-        prediction = model(input_object)
+        if isinstance(input_object, video_sequence.FrameSequence):
+            prediction = _predict_sequence(model, input_object)
+        else:
+            prediction = d2_handler.predict(input_object, model, _predict_tiled if TILED_INFERENCE else None)
     except Exception as e:
         logger.error("Prediction failed...")
         logger.error(e)
         return None
-
-    logger.debug("Predictions are:")
-    logger.debug(prediction)
     
     return prediction
 
+
+def _serialize_sequence(run, response_content_type):
+    
+    if d2_deserializer.NDJSON_CONTENT_TYPE in response_content_type:
+        output = video_sequence.sequence_to_ndjson(run)
+        if not d2_handler.STREAM_RESPONSES:
+            output = "".join(output)
+    elif "json" in response_content_type:
+        output = video_sequence.sequence_to_json(run)
+    else:
+        raise Exception(f"Unsupported response content type {response_content_type} of frame sequence")
+    
+    return output
+
+
+@stage_timer.timed("output_fn", finish=True)
 def output_fn(prediction, response_content_type):
+    """
+    Serializes predictions, see d2_handler.serialize(). Frame sequences are serialized
+    one line per frame, with D2_STREAM_RESPONSES frames are processed while the response is sent.
+    """
     
     logger.info("Processing output predictions...")
     logger.debug(f"Output object type is {type(prediction)}")
         
     try:
-        if "json" in response_content_type:
-            output = d2_deserializer.d2_to_json(prediction)
-
-        elif "detectron2" in response_content_type:
-            logger.debug("check prediction before pickling")
-            logger.debug(type(prediction))
-            
-            instances = prediction['instances']
-            rle_masks = d2_deserializer.convert_masks_to_rle(instances.get_fields()["pred_masks"])
-            instances.set("pred_masks_rle", rle_masks)
-            instances.remove('pred_masks')
-            
-            pickled_outputs = pickle.dumps(prediction)
-            stream = io.BytesIO(pickled_outputs)
-            output = stream.getvalue()
-            
+        if isinstance(prediction, video_sequence.SequenceRun):
+            output = _serialize_sequence(prediction, response_content_type)
         else:
-            raise Exception(f"Unsupported response content type {response_content_type}")
-        
+            output = d2_handler.serialize(prediction, response_content_type)
     except Exception as e:
         logger.error("Output processing failed...")
         logger.error(e)
@@ -166,7 +218,3 @@ def output_fn(prediction, response_content_type):
     logger.debug(f"Predicted output type is {type(output)}")
 
     return output
-    
-    
-    
-
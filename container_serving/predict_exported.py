@@ -0,0 +1,134 @@
+# Inference handler of models exported with torchscript_export.py to TorchScript or ONNX.
+# Doesn't import Detectron2 and doesn't construct the model in Python, so cold start is
+# limited to loading the (frozen) TorchScript graph or onnxruntime session.
+# SM specs: https://sagemaker.readthedocs.io/en/stable/using_pytorch.html
+
+import os
+import io
+import http.client
+import logging
+import sys
+import json
+import numpy as np
+import cv2
+
+import torch
+from sagemaker_inference import errors
+
+import exported_model
+import request_options
+import stage_timer
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.DEBUG)
+logger.addHandler(logging.StreamHandler(sys.stdout))
+
+DEVICE = os.environ.get("D2_DEVICE", "cuda" if torch.cuda.is_available() else "cpu")
+# "torchscript" or "onnxruntime", by default backend follows the exported file in model_dir
+BACKEND = os.environ.get("D2_EXPORTED_BACKEND") or None
+# onnxruntime session options
+ORT_GRAPH_OPTIMIZATION_LEVEL = os.environ.get("D2_ORT_GRAPH_OPTIMIZATION_LEVEL", "all")
+ORT_INTRA_OP_THREADS = int(os.environ.get("D2_ORT_INTRA_OP_THREADS", 0))
+ORT_INTER_OP_THREADS = int(os.environ.get("D2_ORT_INTER_OP_THREADS", 0))
+
+
+@stage_timer.timed("model_fn", start=True, finish=True)
+def model_fn(model_dir):
+    """
+    Loads .ts or .onnx model from model_dir, see exported_model.load_predictor().
+    """
+
+    logger.info("Loading exported model...")
+
+    return exported_model.load_predictor(model_dir, DEVICE, BACKEND,
+                                         graph_optimization_level=ORT_GRAPH_OPTIMIZATION_LEVEL,
+                                         intra_op_threads=ORT_INTRA_OP_THREADS,
+                                         inter_op_threads=ORT_INTER_OP_THREADS)
+
+
+def _decode(payload):
+
+    if bytes(payload[:6]) == b"\x93NUMPY":
+        return np.load(io.BytesIO(payload), allow_pickle=False)
+    return cv2.imdecode(np.frombuffer(payload, np.uint8), cv2.IMREAD_COLOR)
+
+
+@stage_timer.timed("input_fn", start=True)
+def input_fn(request_body, request_content_type):
+    """
+    Decodes JPEG, NPY or JSON envelope (see request_options.py) to list of (image, options).
+    Requests with unsupported masks=roi option are rejected with status 400.
+    """
+
+    logger.info(f"Handling inputs...Content type is {request_content_type}")
+
+    try:
+        options = request_options.parse_options(request_content_type)
+
+        if "application/x-npy" in request_content_type or "jpeg" in request_content_type:
+            input_object = [(_decode(request_body), options)]
+        elif "json" in request_content_type:
+            payloads, envelope_options, batched = request_options.parse_envelope(request_body)
+            options = dict(options, **envelope_options)
+            input_object = [(_decode(p), options) for p in payloads]
+            if batched:
+                input_object = {"batch": input_object}
+        else:
+            raise Exception(f"Unsupported request content type {request_content_type}")
+
+        if options.get("masks") == "roi":
+            # exported graphs return pasted masks only
+            raise errors.GenericInferenceToolkitError(http.client.BAD_REQUEST,
+                                                      "masks=roi is not supported by exported models")
+    except errors.BaseInferenceToolkitError:
+        raise
+    except Exception as e:
+        logger.error("Input deserialization failed...")
+        logger.error(e)
+        return None
+
+    return input_object
+
+
+@stage_timer.timed("predict_fn")
+def predict_fn(input_object, model):
+
+    batched = isinstance(input_object, dict)
+    images = input_object["batch"] if batched else input_object
+
+    try:
+        predictions = []
+        for image, options in images:
+            with stage_timer.stage("forward"):
+                prediction = model(image, options.get("min_size"), options.get("max_size"),
+                                   request_options.wants_masks(options))
+            predictions.append(exported_model.apply_options(prediction, options))
+    except Exception as e:
+        logger.error("Prediction failed...")
+        logger.error(e)
+        return None
+
+    return predictions if batched else predictions[0]
+
+
+@stage_timer.timed("output_fn", finish=True)
+def output_fn(prediction, response_content_type):
+    """
+    Serializes predictions to JSON of the same schema as predict_coco.py JSON responses.
+    """
+
+    try:
+        if "json" not in response_content_type:
+            raise Exception(f"Unsupported response content type {response_content_type}")
+
+        with stage_timer.stage("serialize"):
+            if isinstance(prediction, list):
+                output = json.dumps([exported_model.to_dict(p) for p in prediction])
+            else:
+                output = json.dumps(exported_model.to_dict(prediction))
+    except Exception as e:
+        logger.error("Output processing failed...")
+        logger.error(e)
+        return None
+
+    return output
@@ -0,0 +1,120 @@
+"""
+Content-addressed LRU cache of serialized predictions.
+
+Entries are keyed by a hash of request bytes, content types and model parameters, and hold
+response bytes, so a hit skips decoding, inference and serialization. Concurrent requests with
+the same key wait for a single in-flight computation instead of running the model each.
+"""
+
+import hashlib
+import threading
+from collections import OrderedDict
+from concurrent.futures import Future
+
+
+def make_key(*parts):
+    """
+    Returns hex digest of parts, which can be bytes-like objects or strings.
+    """
+
+    h = hashlib.blake2b(digest_size=16)
+    for part in parts:
+        if isinstance(part, str):
+            part = part.encode("utf-8")
+        # length prefix, so that ("ab", "c") and ("a", "bc") produce different keys
+        h.update(len(part).to_bytes(8, "little"))
+        h.update(part)
+
+    return h.hexdigest()
+
+
+def _size(value):
+
+    if isinstance(value, str):
+        return len(value.encode("utf-8"))
+    return len(value)
+
+
+class PredictionCache:
+    """
+    LRU cache bounded by total size of stored values in bytes.
+    """
+
+    def __init__(self, max_bytes):
+
+        self.max_bytes = max_bytes
+        self.size = 0
+
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+        self.evictions = 0
+
+        self._entries = OrderedDict()
+        self._inflight = {}
+        self._lock = threading.Lock()
+
+    def get_or_compute(self, key, compute):
+        """
+        Returns cached value for key. On miss calls compute() and stores its result,
+        concurrent callers with the same key wait for that call.
+        """
+
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return self._entries[key]
+
+            future = self._inflight.get(key)
+            owner = future is None
+            if owner:
+                future = Future()
+                self._inflight[key] = future
+                self.misses += 1
+            else:
+                self.coalesced += 1
+
+        if not owner:
+            return future.result()
+
+        try:
+            value = compute()
+        except Exception as e:
+            with self._lock:
+                del self._inflight[key]
+            future.set_exception(e)
+            raise
+
+        with self._lock:
+            del self._inflight[key]
+            self._put(key, value)
+        future.set_result(value)
+
+        return value
+
+    def _put(self, key, value):
+
+        # failed requests produce None, values larger than the whole cache are not worth storing
+        if value is None or _size(value) > self.max_bytes:
+            return
+
+        self._entries[key] = value
+        self.size += _size(value)
+
+        while self.size > self.max_bytes:
+            _, evicted = self._entries.popitem(last=False)
+            self.size -= _size(evicted)
+            self.evictions += 1
+
+    def stats(self):
+
+        with self._lock:
+            return {
+                "entries": len(self._entries),
+                "bytes": self.size,
+                "hits": self.hits,
+                "misses": self.misses,
+                "coalesced": self.coalesced,
+                "evictions": self.evictions,
+            }
@@ -0,0 +1,232 @@
+"""
+Per-request inference options.
+
+Sagemaker passes only request body and content types to the handlers, so options are sent either
+as parameters of request Content-Type, e.g. "image/jpeg; score_threshold=0.7; max_detections=5",
+or in a JSON envelope of Content-Type "application/json":
+
+    {"image": "<base64 JPEG or NPY>", "options": {"score_threshold": 0.7, "fields": ["boxes"]}}
+
+("images": [...] instead of "image" makes a multi-image request). input_fn attaches parsed options
+to every decoded image dict under "options" key, they are applied by batching.run_batch().
+
+Supported options:
+    score_threshold  drop instances with lower score, can't go below model SCORE_THRESH_TEST
+    max_detections   keep only top scoring instances, can't exceed TEST.DETECTIONS_PER_IMAGE
+    classes          class ids allow-list, "1,3,5" in content type
+    fields           subset of FIELDS to return, "boxes,scores" in content type
+    min_size         test resolution, overrides INPUT.MIN_SIZE_TEST
+    max_size         overrides INPUT.MAX_SIZE_TEST
+    masks            "full" (pasted into full image), "roi" (raw probabilities at ROI resolution) or
+                     "none" (box-only, mask head doesn't run)
+    model            name of the model in multi-model endpoints, see model_registry.py
+
+Options of frame-sequence requests (see video_sequence.py):
+    keyframe_interval  max frames between full detections
+    diff_threshold     frame difference to the last keyframe which forces full detection
+    propagate          how detections are carried to skipped frames, "reuse" or "shift"
+"""
+
+import base64
+import json
+import os
+
+import torch
+
+MASK_FORMATS = ("full", "roi", "none")
+# box-only endpoint: masks are returned only to requests which list them in "fields" option
+BOX_ONLY = os.environ.get("D2_BOX_ONLY", "0") == "1"
+PROPAGATION_MODES = ("reuse", "shift")
+
+# response field names and corresponding Instances fields
+FIELDS = {
+    "boxes": "pred_boxes",
+    "scores": "scores",
+    "classes": "pred_classes",
+    "masks": "pred_masks",
+}
+
+
+def _int_list(value):
+
+    if isinstance(value, str):
+        value = [v for v in value.split(",") if v.strip()]
+    return [int(v) for v in value]
+
+
+def _str_list(value):
+
+    if isinstance(value, str):
+        value = value.split(",")
+    return [v.strip().lower() for v in value if v.strip()]
+
+
+def _mask_format(value):
+
+    if value not in MASK_FORMATS:
+        raise ValueError(f"Unsupported masks format {value}, expected one of {MASK_FORMATS}")
+    return value
+
+
+def _propagation(value):
+
+    if value not in PROPAGATION_MODES:
+        raise ValueError(f"Unsupported propagation {value}, expected one of {PROPAGATION_MODES}")
+    return value
+
+
+def _fields(value):
+
+    fields = _str_list(value)
+    if not fields:
+        raise ValueError("At least one field has to be selected")
+    unknown = set(fields) - set(FIELDS)
+    if unknown:
+        raise ValueError(f"Unsupported fields {sorted(unknown)}, expected subset of {list(FIELDS)}")
+    return fields
+
+
+_PARSERS = {
+    "score_threshold": float,
+    "max_detections": int,
+    "classes": _int_list,
+    "fields": _fields,
+    "min_size": int,
+    "max_size": int,
+    "masks": _mask_format,
+    "model": str,
+    "keyframe_interval": int,
+    "diff_threshold": float,
+    "propagate": _propagation,
+}
+
+
+def parse_content_type(content_type):
+    """
+    Splits content type into lower-cased MIME type and dict of its parameters.
+    """
+
+    mime, _, rest = content_type.partition(";")
+    params = {}
+    for item in rest.split(";"):
+        key, sep, value = item.partition("=")
+        if sep:
+            params[key.strip().lower()] = value.strip().strip('"')
+
+    return mime.strip().lower(), params
+
+
+def validate(raw_options):
+    """
+    Converts raw option values (strings or JSON values) to their types, unknown keys are ignored.
+    """
+
+    return {k: _PARSERS[k](v) for k, v in raw_options.items() if k in _PARSERS}
+
+
+def parse_options(content_type):
+    """
+    Returns dict of inference options set in content type parameters.
+    """
+
+    _, params = parse_content_type(content_type)
+    return validate(params)
+
+
+def parse_envelope(body):
+    """
+    Parses JSON envelope. Returns tuple of encoded image payloads (bytes), options and
+    flag whether it is a multi-image request.
+    """
+
+    if isinstance(body, (bytes, bytearray, memoryview)):
+        body = bytes(body).decode("utf-8")
+    envelope = json.loads(body)
+
+    batched = "images" in envelope
+    if batched:
+        payloads = [base64.b64decode(image) for image in envelope["images"]]
+    else:
+        payloads = [base64.b64decode(envelope["image"])]
+
+    return payloads, validate(envelope.get("options", {})), batched
+
+
+def attach_options(image, options):
+    """
+    Returns image dict (see batching._preprocess) carrying options.
+    """
+
+    if not isinstance(image, dict):
+        height, width = image.shape[:2]
+        image = {"image": image, "height": height, "width": width}
+
+    return dict(image, options=options)
+
+
+def get_options(input_object):
+    """
+    Returns options of decoded request, all images of a request share the same options.
+    """
+
+    if isinstance(input_object, list):
+        return get_options(input_object[0]) if input_object else {}
+    if isinstance(input_object, dict):
+        return input_object.get("options", {})
+
+    return {}
+
+
+def filter_instances(instances, options):
+    """
+    Applies score threshold, class allow-list and max detections to Instances.
+    Called before mask pasting, so that dropped instances don't cost anything.
+    """
+
+    if "score_threshold" in options:
+        instances = instances[instances.scores >= options["score_threshold"]]
+
+    if "classes" in options:
+        allowed = torch.as_tensor(options["classes"], device=instances.pred_classes.device)
+        keep = (instances.pred_classes[:, None] == allowed[None, :]).any(dim=1)
+        instances = instances[keep]
+
+    if "max_detections" in options and len(instances) > options["max_detections"]:
+        order = torch.argsort(instances.scores, descending=True)
+        instances = instances[order[:options["max_detections"]]]
+
+    return instances
+
+
+def wants_masks(options):
+    """
+    Returns whether request asks for masks, by default it does unless BOX_ONLY is set.
+    """
+
+    if options.get("masks") == "none":
+        return False
+    if "fields" in options:
+        return "masks" in options["fields"]
+    return not BOX_ONLY
+
+
+def drop_unselected_fields(instances, options):
+    """
+    Removes Instances fields not listed in "fields" option. Boxes are kept with ROI-resolution
+    masks, which can't be pasted into the image without them (see d2_deserializer.paste_roi_masks).
+    """
+
+    if "fields" not in options:
+        return instances
+
+    selected = {FIELDS[f] for f in options["fields"]}
+    if "masks" in options["fields"]:
+        selected.add("pred_masks_roi")
+    if instances.has("pred_masks_roi"):
+        selected.add("pred_boxes")
+
+    for name in list(instances.get_fields()):
+        if name not in selected:
+            instances.remove(name)
+
+    return instances
@@ -0,0 +1,205 @@
+"""
+Zero-copy image input for clients running on the same host as the model server.
+
+Instead of JPEG or NPY bytes the request of CONTENT_TYPE carries a JSON handle of an image in
+a POSIX shared-memory segment (a file in /dev/shm):
+
+    {"name": "d2shm_0", "shape": [1080, 1920, 3], "dtype": "uint8", "strides": [5760, 3, 1], "offset": 0}
+
+or a list of handles for a multi-image request. input_fn wraps the segment as a read-only numpy
+view without copying, segments are mapped once and the mappings are reused by later requests.
+
+The client owns the segments: SlotPool creates a fixed set of segments (slots), the producer
+writes a frame into a free slot, sends its handle and releases the slot after the response
+arrived, so the server never reads a slot which is being rewritten.
+"""
+
+import json
+import logging
+import mmap
+import os
+import re
+import sys
+import threading
+from contextlib import contextmanager
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.DEBUG)
+logger.addHandler(logging.StreamHandler(sys.stdout))
+
+CONTENT_TYPE = "application/x-d2-shm"
+SHM_DIR = "/dev/shm"
+# only segments with this prefix can be mapped by requests
+PREFIX = os.environ.get("D2_SHM_PREFIX", "d2shm_")
+
+_NAME_PATTERN = re.compile(r"^[A-Za-z0-9_.-]+$")
+_mappings = {}
+_mappings_lock = threading.Lock()
+
+
+def _path(name):
+
+    if not name.startswith(PREFIX) or not _NAME_PATTERN.match(name):
+        raise ValueError(f"Invalid shared memory segment name {name}, expected prefix {PREFIX}")
+    return os.path.join(SHM_DIR, name)
+
+
+def _get_mapping(name):
+    """
+    Returns read-only mmap of segment, cached by name and inode, so that recreated segments are remapped.
+    """
+
+    path = _path(name)
+    inode = os.stat(path).st_ino
+
+    with _mappings_lock:
+        cached = _mappings.get(name)
+        if cached is not None and cached[0] == inode:
+            return cached[1]
+
+        with open(path, "rb") as f:
+            mapping = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        if cached is not None:
+            try:
+                cached[1].close()
+            except BufferError:
+                # views of in-flight requests still use it, it is freed with them
+                pass
+        _mappings[name] = (inode, mapping)
+
+        return mapping
+
+
+def open_view(handle):
+    """
+    Returns numpy view of image described by handle dict.
+    """
+
+    mapping = _get_mapping(handle["name"])
+    dtype = np.dtype(handle.get("dtype", "uint8"))
+    shape = tuple(handle["shape"])
+    strides = tuple(handle["strides"]) if handle.get("strides") else None
+    offset = int(handle.get("offset", 0))
+
+    # np.ndarray checks that shape, strides and offset fit in the buffer
+    return np.ndarray(shape, dtype=dtype, buffer=mapping, offset=offset, strides=strides)
+
+
+def decode_request(body):
+    """
+    Decodes request body of CONTENT_TYPE to image view or list of views.
+    """
+
+    if isinstance(body, (bytes, bytearray, memoryview)):
+        body = bytes(body).decode("utf-8")
+    handles = json.loads(body)
+
+    if isinstance(handles, list):
+        return [open_view(h) for h in handles]
+    return open_view(handles)
+
+
+class Slot:
+
+    def __init__(self, pool, index, name, mapping, size):
+
+        self.pool = pool
+        self.index = index
+        self.name = name
+        self.mapping = mapping
+        self.size = size
+
+    def array(self, shape, dtype=np.uint8):
+        """
+        Returns writable numpy view of the slot for the producer to fill.
+        """
+
+        return np.ndarray(shape, dtype=dtype, buffer=self.mapping)
+
+    def write(self, image):
+        """
+        Copies image into the slot, returns its request handle.
+        """
+
+        image = np.asarray(image)
+        if image.nbytes > self.size:
+            raise ValueError(f"Image of {image.nbytes} bytes doesn't fit slot of {self.size} bytes")
+        self.array(image.shape, image.dtype)[...] = image
+        return self.handle(image.shape, image.dtype)
+
+    def handle(self, shape, dtype=np.uint8):
+        """
+        Returns request handle of C-contiguous array written with array().
+        """
+
+        return {"name": self.name, "shape": list(shape), "dtype": np.dtype(dtype).str, "offset": 0}
+
+
+class SlotPool:
+    """
+    Fixed set of shared-memory segments of slot_bytes each, reused by the producer.
+    acquire() blocks while all slots are in flight. Segments are removed by close().
+    """
+
+    def __init__(self, num_slots, slot_bytes, prefix=PREFIX):
+
+        self.slot_bytes = slot_bytes
+        self._free = []
+        self._slots = []
+        self._cond = threading.Condition()
+
+        for i in range(num_slots):
+            name = f"{prefix}{os.getpid()}_{i}"
+            path = os.path.join(SHM_DIR, name)
+            fd = os.open(path, os.O_CREAT | os.O_RDWR | os.O_TRUNC, 0o600)
+            try:
+                os.ftruncate(fd, slot_bytes)
+                mapping = mmap.mmap(fd, slot_bytes)
+            finally:
+                os.close(fd)
+            slot = Slot(self, i, name, mapping, slot_bytes)
+            self._slots.append(slot)
+            self._free.append(slot)
+
+    def acquire(self, timeout=None):
+
+        with self._cond:
+            if not self._cond.wait_for(lambda: self._free, timeout):
+                raise TimeoutError("No free shared memory slot")
+            return self._free.pop()
+
+    def release(self, slot):
+
+        with self._cond:
+            self._free.append(slot)
+            self._cond.notify()
+
+    @contextmanager
+    def slot(self, timeout=None):
+        """
+        Context manager which releases the slot after the response was received.
+        """
+
+        slot = self.acquire(timeout)
+        try:
+            yield slot
+        finally:
+            self.release(slot)
+
+    def close(self):
+
+        for slot in self._slots:
+            slot.mapping.close()
+            try:
+                os.unlink(os.path.join(SHM_DIR, slot.name))
+            except FileNotFoundError:
+                pass
+        self._slots, self._free = [], []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
@@ -0,0 +1,255 @@
+"""
+Low-overhead per-stage latency instrumentation of the serving handlers.
+
+input_fn starts a RequestTimer for the calling thread, handlers and helpers add stage timings
+to it with timed() decorator and stage() context manager, output_fn finishes the request:
+its breakdown is logged as one JSON line and added to rolling per-stage histograms, which are
+logged as p50/p95/p99 every REPORT_EVERY requests.
+
+Multi Model Server doesn't let handlers set response headers, so Server-Timing header value of
+the last finished request of a thread is available from last_server_timing() for servers that can
+send them (local_server.py does).
+"""
+
+import functools
+import json
+import logging
+import os
+import random
+import sys
+import threading
+import time
+import uuid
+from collections import OrderedDict, deque
+from contextlib import contextmanager
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+logger.addHandler(logging.StreamHandler(sys.stdout))
+
+ENABLED = os.environ.get("D2_STAGE_TIMING", "1") == "1"
+# number of finished requests between histogram reports
+REPORT_EVERY = int(os.environ.get("D2_TIMING_REPORT_EVERY", 100))
+# size of rolling window of each stage histogram
+WINDOW = int(os.environ.get("D2_TIMING_WINDOW", 1000))
+# share of requests whose predictions are logged in full at debug level
+DEBUG_SAMPLE_RATE = float(os.environ.get("D2_DEBUG_SAMPLE_RATE", 0.01))
+
+_local = threading.local()
+
+
+class RequestTimer:
+    """
+    Accumulates durations of named stages of a single request.
+    """
+
+    def __init__(self, request_id=None):
+
+        self.request_id = request_id or uuid.uuid4().hex[:16]
+        self.start = time.monotonic()
+        self.stages = OrderedDict()
+
+    def add(self, name, seconds):
+        self.stages[name] = self.stages.get(name, 0.0) + seconds
+
+    @contextmanager
+    def stage(self, name):
+
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            self.add(name, time.monotonic() - start)
+
+    def summary(self):
+
+        return {
+            "request_id": self.request_id,
+            "total_ms": round((time.monotonic() - self.start) * 1000, 3),
+            "stages_ms": {k: round(v * 1000, 3) for k, v in self.stages.items()},
+        }
+
+    def server_timing(self):
+        return ", ".join(f"{k};dur={v * 1000:.2f}" for k, v in self.stages.items())
+
+
+class _FanOutTimer:
+    """
+    Adds stage timings to several request timers, used for micro-batches shared by requests.
+    """
+
+    def __init__(self, timers):
+        self.timers = [t for t in timers if t is not None]
+
+    def add(self, name, seconds):
+        for timer in self.timers:
+            timer.add(name, seconds)
+
+    @contextmanager
+    def stage(self, name):
+
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            self.add(name, time.monotonic() - start)
+
+
+class _NullTimer:
+
+    def add(self, name, seconds):
+        pass
+
+    @contextmanager
+    def stage(self, name):
+        yield
+
+
+_NULL_TIMER = _NullTimer()
+
+
+class StageHistograms:
+    """
+    Rolling windows of per-stage durations with percentile summaries.
+    """
+
+    def __init__(self, window=WINDOW):
+
+        self.window = window
+        self._samples = {}
+        self._lock = threading.Lock()
+
+    def add(self, stages):
+
+        with self._lock:
+            for name, seconds in stages.items():
+                self._samples.setdefault(name, deque(maxlen=self.window)).append(seconds)
+
+    def percentiles(self, qs=(50, 95, 99)):
+
+        with self._lock:
+            samples = {name: sorted(values) for name, values in self._samples.items()}
+
+        report = {}
+        for name, values in samples.items():
+            report[name] = {f"p{q}_ms": round(values[min(len(values) - 1, int(q / 100 * len(values)))] * 1000, 3)
+                            for q in qs}
+            report[name]["count"] = len(values)
+
+        return report
+
+
+histograms = StageHistograms()
+_finished = 0
+_finished_lock = threading.Lock()
+
+
+def start_request(request_id=None):
+    """
+    Starts timer of a new request in the calling thread.
+    """
+
+    timer = RequestTimer(request_id) if ENABLED else None
+    _local.timer = timer
+    return timer or _NULL_TIMER
+
+
+def current():
+    """
+    Returns timer of the request handled by the calling thread.
+    """
+
+    return getattr(_local, "timer", None) or _NULL_TIMER
+
+
+@contextmanager
+def use(timers):
+    """
+    Makes stage timings in the calling thread go to given request timers, e.g. in batching thread.
+    """
+
+    previous = getattr(_local, "timer", None)
+    _local.timer = _FanOutTimer(timers)
+    try:
+        yield
+    finally:
+        _local.timer = previous
+
+
+def stage(name):
+    return current().stage(name)
+
+
+def finish_request():
+    """
+    Logs breakdown of the current request and adds it to histograms.
+    """
+
+    global _finished
+
+    timer = getattr(_local, "timer", None)
+    if not isinstance(timer, RequestTimer):
+        return
+
+    _local.timer = None
+    _local.last_server_timing = timer.server_timing()
+
+    logger.info(json.dumps({"request_timing": timer.summary()}))
+    histograms.add(timer.stages)
+
+    with _finished_lock:
+        _finished += 1
+        report = _finished % REPORT_EVERY == 0
+    if report:
+        logger.info(json.dumps({"stage_percentiles": histograms.percentiles()}))
+
+
+def last_server_timing():
+    """
+    Returns Server-Timing header value of the last request finished by the calling thread.
+    """
+
+    return getattr(_local, "last_server_timing", "")
+
+
+def clear_server_timing():
+    """
+    Forgets Server-Timing of the last request of the calling thread, so that a request which
+    finishes no timer doesn't report timings of the previous one.
+    """
+
+    _local.last_server_timing = ""
+
+
+def timed(name, start=False, finish=False):
+    """
+    Decorator which times the whole handler function as stage name.
+    start begins a new request, finish completes it after the function returns.
+    """
+
+    def decorator(fn):
+
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+
+            if start:
+                start_request()
+            try:
+                with stage(name):
+                    return fn(*args, **kwargs)
+            finally:
+                if finish:
+                    finish_request()
+
+        return wrapper
+
+    return decorator
+
+
+def sample_debug(log):
+    """
+    Returns True for DEBUG_SAMPLE_RATE share of calls if log has debug level enabled,
+    to log large objects only occasionally.
+    """
+
+    return log.isEnabledFor(logging.DEBUG) and random.random() < DEBUG_SAMPLE_RATE
@@ -0,0 +1,237 @@
+"""
+Tiled sliding-window inference for images much larger than model input size (e.g. 6000x4000
+aerial images), which would otherwise be downsampled to MAX_SIZE_TEST and lose small objects.
+
+Image is split into overlapping tiles which run through the model at native resolution, a few
+tiles per forward pass. Tiles are views of the image and are consumed batch by batch, each
+instance keeps only its mask cropped to its box, so memory doesn't grow with image size beyond
+the image itself. Detections are shifted to image coordinates and merged across tiles: an
+instance which touches the overlap band of its tile and a neighbouring tile is merged into a
+higher scoring instance of the same class from the neighbouring tile, if one of their boxes
+mostly lies within the other (intersection over the smaller box >= merge_threshold). The higher
+scoring box is kept and the masks are united. This joins objects cut by tile borders, which
+plain IoU NMS keeps as separate partial detections, while detections within a single tile are
+left as the model's own NMS returned them.
+
+Masks are returned RLE encoded as "pred_masks_rle", encoded one at a time from a reused
+full-image buffer.
+"""
+
+import logging
+import sys
+
+import cv2
+import numpy as np
+import torch
+import pycocotools.mask as mask_util
+from detectron2.structures import Boxes, Instances
+
+import batching
+import request_options
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.DEBUG)
+logger.addHandler(logging.StreamHandler(sys.stdout))
+
+
+def tile_grid(height, width, tile_size, overlap):
+    """
+    Yields (y0, x0, y1, x1) of tiles covering the image, tiles at the right and bottom edges are
+    shifted inside the image, so all tiles have full size unless the image is smaller.
+    """
+
+    stride = tile_size - overlap
+    if stride <= 0:
+        raise ValueError(f"Tile overlap {overlap} has to be smaller than tile size {tile_size}")
+
+    def starts(length):
+        if length <= tile_size:
+            return [0]
+        positions = list(range(0, length - tile_size, stride))
+        return positions + [length - tile_size]
+
+    for y0 in starts(height):
+        for x0 in starts(width):
+            yield y0, x0, min(y0 + tile_size, height), min(x0 + tile_size, width)
+
+
+def _batches(iterable, batch_size):
+
+    batch = []
+    for item in iterable:
+        batch.append(item)
+        if len(batch) == batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def _crop_mask(roi_mask, box):
+    """
+    Resizes M x M uint8 mask probabilities to integer box extent, returns (x0, y0, binary crop).
+    """
+
+    x0, y0 = int(np.floor(box[0])), int(np.floor(box[1]))
+    x1, y1 = max(int(np.ceil(box[2])), x0 + 1), max(int(np.ceil(box[3])), y0 + 1)
+    crop = cv2.resize(roi_mask, (x1 - x0, y1 - y0), interpolation=cv2.INTER_LINEAR) >= 128
+    return x0, y0, crop
+
+
+def _detect_tiles(predictor, image, tile_size, overlap, batch_size, options):
+    """
+    Runs tiles through the model, returns boxes, scores, classes in image coordinates, tile index
+    of each detection, tiles as N x 4 (x0, y0, x1, y1) array and list of mask crops (None if masks
+    are not requested).
+    """
+
+    height, width = image.shape[:2]
+    with_masks = request_options.wants_masks(options) and predictor.cfg.MODEL.MASK_ON
+
+    tile_options = {k: v for k, v in options.items() if k in ("score_threshold", "classes")}
+    tile_options["fields"] = ["boxes", "scores", "classes"] + (["masks"] if with_masks else [])
+    tile_options["masks"] = "roi"
+
+    grid = list(tile_grid(height, width, tile_size, overlap))
+    boxes, scores, classes, tile_ids, crops = [], [], [], [], []
+    for tiles in _batches(enumerate(grid), batch_size):
+        inputs = []
+        for _, (y0, x0, y1, x1) in tiles:
+            # min/max size equal to tile size keep native resolution
+            th, tw = y1 - y0, x1 - x0
+            inputs.append({"image": image[y0:y1, x0:x1], "height": th, "width": tw,
+                           "options": dict(tile_options, min_size=min(th, tw), max_size=max(th, tw))})
+
+        for (tile_id, (y0, x0, _, _)), prediction in zip(tiles, batching.run_batch(predictor, inputs)):
+            instances = prediction["instances"].to("cpu")
+            tile_boxes = instances.pred_boxes.tensor.numpy()
+            if with_masks:
+                for box, roi_mask in zip(tile_boxes, instances.pred_masks_roi.numpy()):
+                    x, y, crop = _crop_mask(roi_mask, box)
+                    crops.append((x + x0, y + y0, crop))
+
+            boxes.append(tile_boxes + np.array([x0, y0, x0, y0], dtype=np.float32))
+            scores.append(instances.scores.numpy())
+            classes.append(instances.pred_classes.numpy())
+            tile_ids.append(np.full(len(instances), tile_id, dtype=np.int64))
+
+    tile_boxes = np.array([(x0, y0, x1, y1) for y0, x0, y1, x1 in grid], dtype=np.float32)
+
+    return (np.concatenate(boxes), np.concatenate(scores), np.concatenate(classes), np.concatenate(tile_ids),
+            tile_boxes, crops if with_masks else None)
+
+
+def _intersection(a, b):
+    """
+    Intersection of N x 4 boxes with (broadcast) boxes, empty intersections have zero or negative extent.
+    """
+
+    return np.concatenate([np.maximum(a[..., :2], b[..., :2]), np.minimum(a[..., 2:], b[..., 2:])], axis=-1)
+
+
+def _positive_area(boxes):
+
+    return (boxes[..., 2] > boxes[..., 0]) & (boxes[..., 3] > boxes[..., 1])
+
+
+def merge_detections(boxes, scores, classes, tile_ids, tiles, merge_threshold):
+    """
+    Greedy merge by score across tiles: returns list of groups of indices, first index of each
+    group is the highest scoring instance, the others are instances of neighbouring tiles in the
+    overlap band, which lie within its box by intersection over smaller box.
+    """
+
+    order = np.argsort(-scores, kind="stable")
+    kept, groups = [], []
+
+    for i in order:
+        box = boxes[i]
+        if kept:
+            kept_idx = np.array(kept)
+            kept_boxes = boxes[kept_idx]
+
+            # overlap band of tile of the instance and tile of each kept instance
+            band = _intersection(tiles[tile_ids[kept_idx]], tiles[tile_ids[i]][None])
+            candidates = (tile_ids[kept_idx] != tile_ids[i]) & (classes[kept_idx] == classes[i]) & \
+                _positive_area(band) & _positive_area(_intersection(band, box[None])) & \
+                _positive_area(_intersection(band, kept_boxes))
+
+            if candidates.any():
+                inter = _intersection(kept_boxes, box[None])
+                inter_area = np.clip(inter[:, 2] - inter[:, 0], 0, None) * np.clip(inter[:, 3] - inter[:, 1], 0, None)
+                area = (box[2] - box[0]) * (box[3] - box[1])
+                kept_areas = (kept_boxes[:, 2] - kept_boxes[:, 0]) * (kept_boxes[:, 3] - kept_boxes[:, 1])
+                ios = inter_area / np.maximum(np.minimum(kept_areas, area), 1e-6)
+                ios[~candidates] = 0
+
+                best = int(np.argmax(ios))
+                if ios[best] >= merge_threshold:
+                    # box of the higher scoring instance is kept as is, so merges don't chain
+                    groups[best].append(i)
+                    continue
+
+        kept.append(i)
+        groups.append([i])
+
+    return groups
+
+
+def _encode_merged_masks(groups, crops, height, width):
+    """
+    Unites mask crops of each group and RLE encodes them in a single reused full-image buffer.
+    """
+
+    buffer = np.zeros((height, width, 1), dtype=np.uint8, order="F")
+    rles = []
+    for group in groups:
+        regions = []
+        for i in group:
+            x0, y0, crop = crops[i]
+            region = buffer[y0:y0 + crop.shape[0], x0:x0 + crop.shape[1], 0]
+            region |= crop[:region.shape[0], :region.shape[1]]
+            regions.append(region)
+
+        rle = mask_util.encode(buffer)[0]
+        rle["counts"] = rle["counts"].decode("utf-8")
+        rles.append(rle)
+
+        for region in regions:
+            region[:] = 0
+
+    return rles
+
+
+def run_tiled(predictor, image, tile_size=1024, overlap=128, batch_size=4, merge_threshold=0.5):
+    """
+    Runs tiled inference of HWC numpy image (or dict with "image" and "options", see
+    batching._preprocess). Returns prediction dict with Instances in image resolution.
+    Tiled images have to be decoded at full resolution.
+    """
+
+    options = request_options.get_options(image)
+    if isinstance(image, dict):
+        image = image["image"]
+    height, width = image.shape[:2]
+
+    boxes, scores, classes, tile_ids, tiles, crops = _detect_tiles(predictor, image, tile_size, overlap,
+                                                                   batch_size, options)
+    groups = merge_detections(boxes, scores, classes, tile_ids, tiles, merge_threshold)
+    keep = [group[0] for group in groups]
+
+    if "max_detections" in options:
+        # groups are ordered by score
+        n = options["max_detections"]
+        groups, keep = groups[:n], keep[:n]
+
+    instances = Instances((height, width))
+    instances.pred_boxes = Boxes(torch.as_tensor(boxes[keep], dtype=torch.float32).reshape(-1, 4))
+    instances.scores = torch.as_tensor(scores[keep], dtype=torch.float32)
+    instances.pred_classes = torch.as_tensor(classes[keep], dtype=torch.int64)
+    instances = request_options.drop_unselected_fields(instances, options)
+
+    if crops is not None:
+        instances.pred_masks_rle = _encode_merged_masks(groups, crops, height, width)
+
+    logger.debug(f"Tiled inference of {height}x{width} image: {len(boxes)} tile detections merged into {len(instances)}")
+
+    return {"instances": instances}
@@ -0,0 +1,72 @@
+"""
+Tiny, randomly initialized Mask R-CNN used to exercise the serving handlers on CPU-only boxes.
+Weights are random, so predictions are meaningless - only shapes, code paths and timings matter.
+"""
+
+import os
+
+import numpy as np
+import torch
+from detectron2.config import get_cfg
+from detectron2.engine import DefaultPredictor
+
+
+def get_tiny_cfg():
+    """
+    Returns config of a narrow R50-C4 Mask R-CNN which runs in milliseconds on CPU.
+    """
+
+    cfg = get_cfg()
+    cfg.MODEL.DEVICE = "cpu"
+    cfg.MODEL.WEIGHTS = ""
+    cfg.MODEL.MASK_ON = True
+
+    # shrink backbone width, C4 heads derive their channels from these values
+    cfg.MODEL.RESNETS.NUM_GROUPS = 1
+    cfg.MODEL.RESNETS.WIDTH_PER_GROUP = 8
+    cfg.MODEL.RESNETS.RES2_OUT_CHANNELS = 32
+    cfg.MODEL.ROI_MASK_HEAD.CONV_DIM = 16
+
+    cfg.MODEL.RPN.PRE_NMS_TOPK_TEST = 200
+    cfg.MODEL.RPN.POST_NMS_TOPK_TEST = 50
+    cfg.MODEL.ROI_HEADS.SCORE_THRESH_TEST = 0.0 # keep detections of random model
+    cfg.TEST.DETECTIONS_PER_IMAGE = 20
+
+    cfg.INPUT.MIN_SIZE_TEST = 128
+    cfg.INPUT.MAX_SIZE_TEST = 224
+
+    return cfg
+
+
+def get_tiny_predictor(seed=0):
+
+    torch.manual_seed(seed)
+    return DefaultPredictor(get_tiny_cfg())
+
+
+def dump_tiny_model(model_dir, seed=0):
+    """
+    Writes tiny model as .yaml config and .pth weights, i.e. in the layout model_fn() expects.
+    """
+
+    os.makedirs(model_dir, exist_ok=True)
+    pred = get_tiny_predictor(seed)
+
+    cfg = pred.cfg.clone()
+    cfg.defrost()
+    cfg.MODEL.WEIGHTS = ""
+    with open(os.path.join(model_dir, "config.yaml"), "w") as f:
+        f.write(cfg.dump())
+
+    torch.save({"model": pred.model.state_dict()}, os.path.join(model_dir, "model_final.pth"))
+
+    return model_dir
+
+
+def random_images(count, height=480, width=640, seed=0):
+    """
+    Returns list of random BGR uint8 images.
+    """
+
+    rng = np.random.RandomState(seed)
+    return [rng.randint(0, 255, (height, width, 3), dtype=np.uint8) for _ in range(count)]
@@ -0,0 +1,327 @@
+"""
+Frame-sequence inference for drone video: a request carries a short video chunk (Content-Type
+video/*, e.g. video/mp4) or an ordered batch of JPEG/NPY frames (SEQUENCE_CONTENT_TYPE, body
+in image-batch format, see d2_deserializer.encode_image_batch).
+
+Frames are decoded by a background thread into a bounded queue while the model runs. Full
+detection runs only on keyframes: the first frame, every keyframe_interval-th frame since the
+last keyframe, and frames which differ from the last keyframe by more than diff_threshold
+(mean absolute difference of small grayscale thumbnails, 0-255 scale). Other frames reuse the
+detections of the last keyframe:
+    propagate="reuse"  detections are returned unchanged
+    propagate="shift"  global camera motion since the keyframe is estimated by phase correlation
+                       of the thumbnails, boxes are shifted by it and the difference check is done
+                       on motion compensated thumbnails, so panning alone doesn't force detection.
+                       Masks stay at keyframe position, frame results report the applied shift.
+
+Lower keyframe_interval and diff_threshold trade throughput for accuracy. Results are produced
+frame by frame, as NDJSON they stream back while later frames are still being processed:
+
+    {"frame": 0, "keyframe": true, "source_frame": 0, "shift": [0.0, 0.0], "instances": {...}}
+    ...
+    {"summary": {"frames": 120, "keyframes": 25, "skip_rate": 0.79, "fps": 41.3, ...}}
+
+"instances" has the same schema as d2_to_json() responses.
+"""
+
+import json
+import logging
+import os
+import queue
+import sys
+import tempfile
+import threading
+import time
+
+import cv2
+import numpy as np
+
+import d2_deserializer
+import request_options
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.DEBUG)
+logger.addHandler(logging.StreamHandler(sys.stdout))
+
+SEQUENCE_CONTENT_TYPE = "application/x-d2-frame-sequence"
+
+# width of grayscale thumbnails used for frame difference and motion estimation
+THUMBNAIL_WIDTH = 160
+
+_VIDEO_SUFFIXES = {"video/mp4": ".mp4", "video/x-msvideo": ".avi", "video/quicktime": ".mov",
+                   "video/x-matroska": ".mkv", "video/webm": ".webm"}
+
+
+def is_sequence_request(content_type):
+
+    mime, _ = request_options.parse_content_type(content_type)
+    return mime.startswith("video/") or mime == SEQUENCE_CONTENT_TYPE
+
+
+def _frame_array(frame):
+
+    return frame["image"] if isinstance(frame, dict) else frame
+
+
+def _frame_width(frame):
+
+    return frame["width"] if isinstance(frame, dict) else frame.shape[1]
+
+
+class FrameSequence:
+    """
+    Ordered frames of a request, decoded lazily by a background thread when iterated.
+    decode_frame converts an encoded frame of a frame batch to numpy image (or image dict).
+    """
+
+    def __init__(self, body, content_type, decode_frame, options=None, queue_size=8):
+
+        self.body = body
+        self.mime, _ = request_options.parse_content_type(content_type)
+        self.decode_frame = decode_frame
+        self.options = options or {}
+        self.queue_size = queue_size
+        # frame rate of the video, None for frame batches
+        self.source_fps = None
+
+    def _read_video(self):
+
+        fd, path = tempfile.mkstemp(suffix=_VIDEO_SUFFIXES.get(self.mime, ".mp4"))
+        try:
+            # OpenCV decodes videos only from files
+            with os.fdopen(fd, "wb") as f:
+                f.write(self.body)
+            capture = cv2.VideoCapture(path)
+            if not capture.isOpened():
+                raise ValueError(f"Can't decode video of type {self.mime}")
+            self.source_fps = capture.get(cv2.CAP_PROP_FPS) or None
+            try:
+                while True:
+                    ok, frame = capture.read()
+                    if not ok:
+                        break
+                    yield frame
+            finally:
+                capture.release()
+        finally:
+            os.remove(path)
+
+    def _read_frames(self):
+
+        if self.mime.startswith("video/"):
+            yield from self._read_video()
+        else:
+            for payload in d2_deserializer.decode_image_batch(self.body):
+                yield self.decode_frame(payload)
+
+    def _decode(self, frames, stop):
+
+        def put(item):
+            # gives up when the consumer stopped iterating
+            while not stop.is_set():
+                try:
+                    frames.put(item, timeout=0.1)
+                    return True
+                except queue.Full:
+                    pass
+            return False
+
+        try:
+            for frame in self._read_frames():
+                if self.options:
+                    frame = request_options.attach_options(frame, self.options)
+                if not put(frame):
+                    return
+        except Exception as e:
+            put(e)
+            return
+        put(None)
+
+    def __iter__(self):
+
+        frames = queue.Queue(self.queue_size)
+        stop = threading.Event()
+        thread = threading.Thread(target=self._decode, args=(frames, stop), name="d2-frame-decoder", daemon=True)
+        thread.start()
+
+        try:
+            while True:
+                frame = frames.get()
+                if frame is None:
+                    return
+                if isinstance(frame, Exception):
+                    raise frame
+                yield frame
+        finally:
+            stop.set()
+
+
+class FrameResult:
+
+    def __init__(self, frame, keyframe, source_frame, shift, prediction):
+
+        self.frame = frame
+        self.keyframe = keyframe
+        self.source_frame = source_frame
+        # (dx, dy) applied to boxes of source frame detections
+        self.shift = shift
+        # detections of the source frame
+        self.prediction = prediction
+
+
+def _thumbnail(frame):
+
+    image = _frame_array(frame)
+    height, width = image.shape[:2]
+    thumb_height = max(1, int(round(height * THUMBNAIL_WIDTH / width)))
+    thumb = cv2.resize(image, (THUMBNAIL_WIDTH, thumb_height), interpolation=cv2.INTER_AREA)
+    if thumb.ndim == 3:
+        thumb = cv2.cvtColor(thumb, cv2.COLOR_BGR2GRAY)
+    return thumb.astype(np.float32)
+
+
+def estimate_shift(reference, thumb):
+    """
+    Returns (dx, dy) translation of thumb relative to reference thumbnail in thumbnail pixels.
+    """
+
+    (dx, dy), _ = cv2.phaseCorrelate(reference, thumb)
+    return dx, dy
+
+
+def frame_difference(reference, thumb, shift=(0.0, 0.0)):
+    """
+    Mean absolute difference of thumbnails, reference is moved by shift first.
+    """
+
+    if shift != (0.0, 0.0):
+        matrix = np.float32([[1, 0, shift[0]], [0, 1, shift[1]]])
+        reference = cv2.warpAffine(reference, matrix, (reference.shape[1], reference.shape[0]),
+                                   borderMode=cv2.BORDER_REPLICATE)
+    return float(np.mean(np.abs(thumb - reference)))
+
+
+class SequenceRun:
+    """
+    Iterable of FrameResult, runs detect(frame) on keyframes of frames.
+    Statistics of the run are available from stats() once it is consumed.
+    """
+
+    def __init__(self, detect, frames, keyframe_interval=5, diff_threshold=12.0, propagate="reuse"):
+
+        request_options.validate({"propagate": propagate})
+
+        self.detect = detect
+        self.frames = frames
+        self.keyframe_interval = max(1, keyframe_interval)
+        self.diff_threshold = diff_threshold
+        self.propagate = propagate
+
+        self.num_frames = 0
+        self.num_keyframes = 0
+        self.detect_seconds = 0.0
+        self.elapsed = None
+
+    def __iter__(self):
+
+        start = time.monotonic()
+        last_keyframe, reference, prediction = None, None, None
+        shift = (0.0, 0.0)
+
+        for i, frame in enumerate(self.frames):
+            keyframe = last_keyframe is None or i - last_keyframe >= self.keyframe_interval
+            thumb = None
+
+            if self.diff_threshold is not None or self.propagate == "shift":
+                thumb = _thumbnail(frame)
+            if not keyframe:
+                thumb_shift = estimate_shift(reference, thumb) if self.propagate == "shift" else (0.0, 0.0)
+                if self.diff_threshold is not None:
+                    keyframe = frame_difference(reference, thumb, thumb_shift) > self.diff_threshold
+                scale = _frame_width(frame) / THUMBNAIL_WIDTH
+                shift = (thumb_shift[0] * scale, thumb_shift[1] * scale)
+
+            if keyframe:
+                detect_start = time.monotonic()
+                prediction = self.detect(frame)
+                self.detect_seconds += time.monotonic() - detect_start
+                self.num_keyframes += 1
+                last_keyframe, reference, shift = i, thumb, (0.0, 0.0)
+
+            self.num_frames += 1
+            yield FrameResult(i, keyframe, last_keyframe, shift, prediction)
+
+        self.elapsed = time.monotonic() - start
+        logger.info(f"Sequence of {self.num_frames} frames with {self.num_keyframes} keyframes "
+                    f"processed at {self.num_frames / max(self.elapsed, 1e-9):.1f} fps")
+
+    def stats(self):
+
+        elapsed = self.elapsed or 0.0
+        source_fps = getattr(self.frames, "source_fps", None)
+        stats = {
+            "frames": self.num_frames,
+            "keyframes": self.num_keyframes,
+            "skip_rate": 1 - self.num_keyframes / self.num_frames if self.num_frames else 0.0,
+            "elapsed_sec": elapsed,
+            "fps": self.num_frames / elapsed if elapsed else None,
+            "detection_ms_mean": self.detect_seconds / self.num_keyframes * 1000 if self.num_keyframes else None,
+            "keyframe_interval": self.keyframe_interval,
+            "diff_threshold": self.diff_threshold,
+            "propagate": self.propagate,
+        }
+        if source_fps:
+            stats["source_fps"] = source_fps
+            # > 1 means the sequence is processed faster than real time
+            stats["realtime_factor"] = stats["fps"] / source_fps if stats["fps"] else None
+
+        return stats
+
+
+def _shift_boxes(instances_dict, shift):
+
+    if shift == (0.0, 0.0) or "pred_boxes" not in instances_dict:
+        return instances_dict
+
+    boxes = np.asarray(instances_dict["pred_boxes"], dtype=np.float64).reshape(-1, 4)
+    boxes = boxes + np.array([shift[0], shift[1], shift[0], shift[1]])
+    height, width = instances_dict["image_size"]
+    boxes[:, 0::2] = boxes[:, 0::2].clip(0, width)
+    boxes[:, 1::2] = boxes[:, 1::2].clip(0, height)
+
+    return dict(instances_dict, pred_boxes=boxes.tolist())
+
+
+def sequence_to_ndjson(run):
+    """
+    Generator of NDJSON lines, one per frame and a summary line. Detections of a keyframe are
+    converted (and masks RLE encoded) once and reused by the frames which propagate them.
+    """
+
+    source_frame, instances_dict, instances_json = None, None, None
+
+    for result in run:
+        if result.source_frame != source_frame:
+            source_frame = result.source_frame
+            instances_dict = d2_deserializer._d2_to_dict(result.prediction)
+            instances_json = json.dumps(instances_dict)
+
+        if result.shift == (0.0, 0.0):
+            instances = instances_json
+        else:
+            instances = json.dumps(_shift_boxes(instances_dict, result.shift))
+
+        header = json.dumps({"frame": result.frame, "keyframe": result.keyframe, "source_frame": result.source_frame,
+                             "shift": [round(result.shift[0], 2), round(result.shift[1], 2)]})
+        yield header[:-1] + ', "instances": ' + instances + "}\n"
+
+    yield json.dumps({"summary": run.stats()}) + "\n"
+
+
+def sequence_to_json(run):
+    """
+    Serializes all frames as JSON object {"frames": [...], "summary": {...}}.
+    """
+
+    lines = [line.rstrip("\n") for line in sequence_to_ndjson(run)]
+    return '{"frames": [' + ", ".join(lines[:-1]) + '], ' + lines[-1][1:]
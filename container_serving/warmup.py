@@ -0,0 +1,161 @@
+"""
+Warm-up of freshly loaded predictors.
+
+First requests after model load pay for allocator pool growth, cuDNN/oneDNN kernel selection
+and lazy module initialization. warmup() runs synthetic images of the sizes seen in production
+before the endpoint reports healthy. Sizes come from a warm-up manifest, which can be recorded
+from real traffic with ShapeRecorder:
+
+    {"shapes": [{"height": 4000, "width": 6000, "count": 1520}, ...]}
+"""
+
+import json
+import logging
+import os
+import sys
+import threading
+import time
+from collections import Counter
+
+import numpy as np
+import torch
+
+import batching
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.DEBUG)
+logger.addHandler(logging.StreamHandler(sys.stdout))
+
+# used when no manifest is available: common landscape and portrait camera sizes
+DEFAULT_SHAPES = [(480, 640), (640, 480), (1080, 1920)]
+
+
+def parse_shapes(spec):
+    """
+    Parses shapes from "HxW,HxW" string.
+    """
+
+    return [tuple(int(v) for v in item.lower().split("x")) for item in spec.split(",") if item]
+
+
+def load_manifest(path, max_shapes=8):
+    """
+    Returns up to max_shapes most frequent (height, width) pairs from warm-up manifest.
+    """
+
+    with open(path) as f:
+        manifest = json.load(f)
+
+    shapes = sorted(manifest["shapes"], key=lambda s: s.get("count", 0), reverse=True)
+    return [(s["height"], s["width"]) for s in shapes[:max_shapes]]
+
+
+def warmup(predictor, shapes, iterations=1, batch_size=1):
+    """
+    Runs random images of each shape through batching.run_batch(), iterations times, i.e. the
+    same code path (inference context, cpu_perf wrappers, postprocessing) requests take.
+    With batch_size > 1 batched forward passes are warmed up as well.
+    Returns list of timings in seconds, one dict per shape and iteration.
+    """
+
+    use_cuda = predictor.cfg.MODEL.DEVICE.startswith("cuda")
+    rng = np.random.RandomState(0)
+    timings = []
+
+    total_start = time.monotonic()
+    for height, width in shapes:
+        image = rng.randint(0, 255, (height, width, 3), dtype=np.uint8)
+
+        for i in range(iterations):
+            start = time.monotonic()
+            batching.run_batch(predictor, [image])
+            if batch_size > 1:
+                batching.run_batch(predictor, [image] * batch_size)
+            if use_cuda:
+                torch.cuda.synchronize()
+            elapsed = time.monotonic() - start
+
+            timings.append({"height": height, "width": width, "iteration": i, "sec": elapsed})
+            logger.info(f"Warm-up {height}x{width} iteration {i} took {elapsed * 1000:.1f} ms")
+
+    logger.info(f"Warm-up of {len(shapes)} shapes completed in {time.monotonic() - total_start:.2f} s")
+
+    return timings
+
+
+class ShapeRecorder:
+    """
+    Counts sizes of incoming images and periodically writes them to warm-up manifest.
+    """
+
+    def __init__(self, path, flush_every=100):
+
+        self.path = path
+        self.flush_every = flush_every
+
+        self._counts = Counter()
+        self._pending = 0
+        self._lock = threading.Lock()
+
+        if os.path.exists(path):
+            with open(path) as f:
+                for s in json.load(f)["shapes"]:
+                    self._counts[(s["height"], s["width"])] += s.get("count", 1)
+
+    def record(self, height, width):
+
+        with self._lock:
+            self._counts[(height, width)] += 1
+            self._pending += 1
+            if self._pending >= self.flush_every:
+                self._flush()
+
+    def flush(self):
+
+        with self._lock:
+            self._flush()
+
+    def _flush(self):
+
+        shapes = [{"height": h, "width": w, "count": c} for (h, w), c in self._counts.most_common()]
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump({"shapes": shapes}, f)
+        os.replace(tmp_path, self.path)
+        self._pending = 0
+
+
+def _first_request_latency(warm, shapes, queue):
+
+    import tiny_model
+
+    torch.set_num_threads(1)
+    predictor = tiny_model.get_tiny_predictor()
+    if warm:
+        warmup(predictor, shapes, iterations=2)
+
+    image = tiny_model.random_images(1, *shapes[0], seed=1)[0]
+    start = time.monotonic()
+    batching.run_batch(predictor, [image])
+    queue.put(time.monotonic() - start)
+
+
+if __name__ == "__main__":
+    """
+    CPU check with a tiny random model: first request after warm-up must be faster than first
+    request of a cold predictor. Each mode runs in a fresh process, so that caches start cold.
+    """
+    import multiprocessing as mp
+
+    CTX = mp.get_context("spawn")
+    SHAPES = [(480, 640)]
+    LATENCIES = {}
+    for WARM in (False, True):
+        QUEUE = CTX.Queue()
+        PROC = CTX.Process(target=_first_request_latency, args=(WARM, SHAPES, QUEUE))
+        PROC.start()
+        LATENCIES["warm" if WARM else "cold"] = QUEUE.get()
+        PROC.join()
+
+    assert LATENCIES["warm"] < LATENCIES["cold"], f"Warm-up didn't speed up first request: {LATENCIES}"
+    print(f"First request: cold {LATENCIES['cold'] * 1000:.1f} ms, warm {LATENCIES['warm'] * 1000:.1f} ms")
@@ -0,0 +1,347 @@
+"""
+Multi-worker CPU serving with a single copy of model weights, for large CPU instances where
+one model server worker can't use all cores efficiently.
+
+The parent process loads the model once with handler.model_fn(), binds the listening socket
+and forks `workers` processes, each serving the socket with local_server.ModelServer. Forked
+workers share the parent's memory copy-on-write and inference never writes the weights, so
+their pages stay shared (memory-mapped .d2w weights, see fast_weights.py, are shared through
+the page cache as well). Each worker is pinned to a disjoint set of physical cores, hyper-thread
+siblings are kept together, and runs torch with as many intra-op threads as it has physical
+cores and a single inter-op thread, so workers don't compete for cores.
+
+The parent only loads weights and never runs the model: OpenMP thread pools don't survive fork,
+a worker forked after the parent started intra-op parallel work can hang in its first parallel
+region. The parent loads the model with a single intra-op thread, and warm-up and CPU performance
+mode (cpu_perf.optimize, which converts memory format and prepacks weights) are moved from
+model_fn to the workers, after pinning. Weights changed by the CPU performance mode are private
+to each worker. Workers which exit are restarted with the same cores, unless they fail within
+STARTUP_GRACE_SEC of their start, which stops the pool.
+
+Every report_interval seconds the parent logs aggregate throughput and per-worker memory as one
+JSON line: RSS counts shared pages in every process, PSS splits them between the processes
+sharing them, so sum of PSS is the actual memory use of the pool.
+
+Sample command:
+    python worker_pool.py --model-dir /opt/ml/model --handler predict_coco --port 8080 --workers 4
+"""
+
+import argparse
+import gc
+import importlib
+import json
+import logging
+import multiprocessing
+import os
+import signal
+import socket
+import sys
+import time
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.DEBUG)
+logger.addHandler(logging.StreamHandler(sys.stdout))
+
+# workers exiting sooner after start are failing to start, they aren't restarted
+STARTUP_GRACE_SEC = 10
+
+
+def _parse_cpu_list(spec):
+    """
+    Parses Linux CPU list, e.g. "0-3,8,10-11".
+    """
+
+    cpus = []
+    for item in spec.strip().split(","):
+        if not item:
+            continue
+        start, _, end = item.partition("-")
+        cpus.extend(range(int(start), int(end or start) + 1))
+    return cpus
+
+
+def physical_cores(cpus=None):
+    """
+    Groups logical CPUs available to the process (or cpus) by physical core, returns sorted list
+    of lists of logical CPU ids. Each CPU is its own core if sysfs topology is not available.
+    """
+
+    cpus = sorted(os.sched_getaffinity(0) if cpus is None else cpus)
+    cores, seen = [], set()
+    for cpu in cpus:
+        if cpu in seen:
+            continue
+        try:
+            with open(f"/sys/devices/system/cpu/cpu{cpu}/topology/thread_siblings_list") as f:
+                siblings = [c for c in _parse_cpu_list(f.read()) if c in cpus]
+        except OSError:
+            siblings = [cpu]
+        seen.update(siblings)
+        cores.append(siblings)
+
+    return cores
+
+
+def partition_cores(cores, workers):
+    """
+    Splits physical cores into `workers` disjoint contiguous groups, sizes differ by at most one core.
+    Returns list of (logical CPU ids, number of physical cores) per worker.
+    """
+
+    if workers > len(cores):
+        raise ValueError(f"Can't pin {workers} workers to {len(cores)} physical cores")
+
+    groups, start = [], 0
+    for i in range(workers):
+        size = len(cores) // workers + (1 if i < len(cores) % workers else 0)
+        group = cores[start:start + size]
+        groups.append(([cpu for core in group for cpu in core], size))
+        start += size
+
+    return groups
+
+
+def memory_usage(pid):
+    """
+    Returns RSS and PSS of process in MB, PSS is None if the kernel doesn't report it.
+    """
+
+    usage = {"rss_mb": None, "pss_mb": None}
+    try:
+        with open(f"/proc/{pid}/status") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    usage["rss_mb"] = int(line.split()[1]) / 1024
+        # smaps_rollup exists since Linux 4.14
+        with open(f"/proc/{pid}/smaps_rollup") as f:
+            for line in f:
+                if line.startswith("Pss:"):
+                    usage["pss_mb"] = int(line.split()[1]) / 1024
+    except OSError:
+        pass
+
+    return usage
+
+
+class WorkerPool:
+    """
+    Loads model of handler module once and serves it from forked workers pinned to disjoint cores.
+    """
+
+    def __init__(self, handler, model_dir, workers, host="0.0.0.0", port=8080, threads_per_worker=1,
+                 max_queue=16, warmup_iterations=1, report_interval=30):
+
+        self.handler = handler
+        self.model_dir = model_dir
+        self.threads_per_worker = threads_per_worker
+        self.max_queue = max_queue
+        self.warmup_iterations = warmup_iterations
+        self.report_interval = report_interval
+
+        self.partitions = partition_cores(physical_cores(), workers)
+
+        import cpu_perf
+        import torch
+
+        # loading runs no parallel regions with a single thread, so no OpenMP pool exists at fork,
+        # CPU performance mode runs ops and is applied by the workers, see module docstring
+        torch.set_num_threads(1)
+        self.cpu_perf = cpu_perf.ENABLED
+        cpu_perf.ENABLED = False
+
+        start = time.monotonic()
+        self.model = handler.model_fn(model_dir)
+        logger.info(f"Model loaded in {time.monotonic() - start:.2f} s")
+
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.sock.bind((host, port))
+        self.sock.listen(1024)
+
+        # requests served by each worker, written by the worker only
+        self.counters = [multiprocessing.RawValue("Q", 0) for _ in self.partitions]
+        self.pids = [None] * len(self.partitions)
+        self.started = [None] * len(self.partitions)
+        self._running = False
+
+    def _optimize(self):
+
+        import cpu_perf
+
+        # models loaded lazily by registries are optimized by the handler
+        cpu_perf.ENABLED = self.cpu_perf
+        if self.cpu_perf and hasattr(self.model, "cfg") and self.model.cfg.MODEL.DEVICE == "cpu":
+            cpu_perf.optimize(self.model, threads=0, interop_threads=0)
+
+    def _warmup(self):
+
+        if self.warmup_iterations <= 0 or not hasattr(self.model, "cfg"):
+            # model registries load models lazily, exported models have no Detectron2 config
+            return
+
+        import warmup
+
+        manifest_path = os.path.join(self.model_dir, getattr(self.handler, "WARMUP_MANIFEST", "warmup.json"))
+        if os.path.exists(manifest_path):
+            shapes = warmup.load_manifest(manifest_path)
+        elif os.environ.get("D2_WARMUP_SHAPES"):
+            shapes = warmup.parse_shapes(os.environ["D2_WARMUP_SHAPES"])
+        else:
+            shapes = warmup.DEFAULT_SHAPES
+        warmup.warmup(self.model, shapes, self.warmup_iterations)
+
+    def _run_worker(self, index):
+
+        import cpu_perf
+        import local_server
+        import torch
+
+        cpus, num_cores = self.partitions[index]
+        os.sched_setaffinity(0, cpus)
+        # thread pools of the worker are created only now, after fork and pinning
+        torch.set_num_threads(num_cores)
+        cpu_perf.configure_threads(0, 1)
+        logger.info(f"Worker {index} (pid {os.getpid()}) pinned to CPUs {cpus} with {num_cores} threads")
+
+        self._optimize()
+        self._warmup()
+
+        server = local_server.ModelServer(self.handler, self.model_dir, self.threads_per_worker, self.max_queue,
+                                          model=self.model, request_counter=self.counters[index])
+        server.serve(None, None, sock=self.sock)
+
+    def _spawn(self, index):
+
+        # the parent must not run intra-op parallel work (model inference, warm-up, cpu_perf.optimize)
+        # before this point, OpenMP state of the parent isn't valid in the child, see module docstring
+        pid = os.fork()
+        if pid == 0:
+            signal.signal(signal.SIGTERM, signal.SIG_DFL)
+            signal.signal(signal.SIGINT, signal.SIG_DFL)
+            try:
+                self._run_worker(index)
+            except Exception as e:
+                logger.error(f"Worker {index} failed...")
+                logger.error(e)
+            finally:
+                os._exit(1)
+
+        self.pids[index] = pid
+        self.started[index] = time.monotonic()
+
+    def _reap(self):
+        """
+        Restarts workers which exited.
+        """
+
+        while True:
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except ChildProcessError:
+                return
+            if pid == 0:
+                return
+            if pid in self.pids and self._running:
+                index = self.pids.index(pid)
+                self.pids[index] = None
+                if time.monotonic() - self.started[index] < STARTUP_GRACE_SEC:
+                    logger.error(f"Worker {index} (pid {pid}) failed to start with status {status}, stopping")
+                    self._running = False
+                    return
+                logger.warning(f"Worker {index} (pid {pid}) exited with status {status}, restarting")
+                self._spawn(index)
+
+    def report(self, requests, elapsed):
+        """
+        Returns dict with throughput since the last report and memory usage of the pool.
+        """
+
+        workers = []
+        for index, (pid, (cpus, num_cores)) in enumerate(zip(self.pids, self.partitions)):
+            worker = {"worker": index, "pid": pid, "cpus": cpus, "threads": num_cores,
+                      "requests": self.counters[index].value}
+            worker.update(memory_usage(pid))
+            workers.append(worker)
+
+        parent = memory_usage(os.getpid())
+        pss = [w["pss_mb"] for w in workers] + [parent["pss_mb"]]
+
+        return {
+            "throughput_rps": requests / elapsed if elapsed else None,
+            "requests": sum(w["requests"] for w in workers),
+            "workers": workers,
+            "parent": parent,
+            "total_rss_mb": sum(w["rss_mb"] or 0 for w in workers) + (parent["rss_mb"] or 0),
+            "total_pss_mb": sum(pss) if None not in pss else None,
+        }
+
+    def _stop(self, *_):
+        self._running = False
+
+    def run(self):
+
+        # objects allocated so far aren't tracked by GC any more, so collections in workers
+        # don't write to their pages and break copy-on-write sharing (Python 3.7+)
+        if hasattr(gc, "freeze"):
+            gc.collect()
+            gc.freeze()
+
+        self._running = True
+        signal.signal(signal.SIGTERM, self._stop)
+        signal.signal(signal.SIGINT, self._stop)
+        for index in range(len(self.partitions)):
+            self._spawn(index)
+
+        last_time, last_requests = time.monotonic(), 0
+        try:
+            while self._running:
+                time.sleep(min(1.0, self.report_interval))
+                self._reap()
+
+                now = time.monotonic()
+                if now - last_time >= self.report_interval:
+                    requests = sum(counter.value for counter in self.counters)
+                    logger.info(json.dumps(self.report(requests - last_requests, now - last_time)))
+                    last_time, last_requests = now, requests
+        finally:
+            self._running = False
+            for pid in self.pids:
+                try:
+                    os.kill(pid, signal.SIGTERM)
+                except (ProcessLookupError, TypeError):
+                    pass
+            for pid in self.pids:
+                try:
+                    os.waitpid(pid, 0)
+                except (ChildProcessError, TypeError):
+                    pass
+            self.sock.close()
+
+
+def main(args):
+
+    # warm-up runs in workers, see module docstring
+    os.environ["D2_WARMUP_ITERATIONS"] = "0"
+    handler = importlib.import_module(args.handler)
+
+    pool = WorkerPool(handler, args.model_dir, args.workers, args.host, args.port, args.threads_per_worker,
+                      args.max_queue, args.warmup_iterations, args.report_interval)
+    pool.run()
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--model-dir', type=str, default="/opt/ml/model")
+    parser.add_argument('--handler', type=str, default="predict_coco", help="handler module")
+    parser.add_argument('--host', type=str, default="0.0.0.0")
+    parser.add_argument('--port', type=int, default=8080)
+    parser.add_argument('--workers', type=int, default=max(1, len(physical_cores()) // 4),
+                        help="worker processes, each gets an equal share of physical cores")
+    parser.add_argument('--threads-per-worker', type=int, default=1, help="requests processed concurrently by a worker")
+    parser.add_argument('--max-queue', type=int, default=16, help="requests waiting in a worker, more are rejected")
+    parser.add_argument('--warmup-iterations', type=int, default=int(os.environ.get("D2_WARMUP_ITERATIONS", 1)))
+    parser.add_argument('--report-interval', type=float, default=30, help="seconds between throughput reports")
+    args = parser.parse_args()
+
+    main(args)
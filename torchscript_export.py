@@ -1,4 +1,5 @@
 import argparse
+import json
 import numpy as np
 from PIL import Image
 
@@ -6,87 +7,222 @@ import torchvision, torch
 from detectron2.checkpoint import DetectionCheckpointer
 from detectron2.engine import DefaultPredictor
 from detectron2.modeling import build_model
+from detectron2.modeling.postprocessing import detector_postprocess
 from detectron2.config import get_cfg
 from detectron2.structures import ImageList
+import detectron2.data.transforms as T
 import cv2
 
+# metadata of exported model stored next to the graph, read by container_serving/exported_model.py
+METADATA_FILE = "metadata.json"
+OUTPUT_NAMES = ["boxes", "scores", "classes", "masks"]
+
+
+class ExportWrapper(torch.nn.Module):
+    """
+    Complete GeneralizedRCNN inference with plain tensor inputs and outputs:
+
+    inputs: HxWx3 uint8 image resized to test resolution, in the channel order of the source image (BGR),
+            and original image height and width as 0-dim int64 tensors
+    outputs: boxes (N x 4, in original resolution), scores (N), classes (N), masks (N x H x W bool,
+             pasted into original resolution, N x 0 x 0 for models without mask head)
+
+    Layout conversion, normalization, padding, backbone, RPN, ROI heads, box rescaling and mask
+    pasting are part of the graph. Resize stays outside, as traced graph freezes the output size.
+
+    With paste_masks=False masks are N x 1 x M x M probabilities at ROI resolution, which the caller
+    pastes (see exported_model.paste_masks), as mask pasting doesn't export to ONNX.
+    """
+
+    def __init__(self, model, input_format, paste_masks=True):
+
+        super().__init__()
+        self.model = model
+        self.flip_channels = input_format == "RGB"
+        self.paste_masks = paste_masks
+
+    def forward(self, image, height, width):
+
+        if self.flip_channels:
+            image = image.flip(2)
+        image = image.permute(2, 0, 1).float()
+
+        instances = self.model.inference([{"image": image}], do_postprocess=False)[0]
+
+        if self.paste_masks:
+            instances = detector_postprocess(instances, height, width)
+            boxes = instances.pred_boxes.tensor
+        else:
+            boxes = self._rescale_boxes(instances.pred_boxes.tensor, image, height, width)
+
+        if instances.has("pred_masks"):
+            masks = instances.pred_masks
+        else:
+            masks = torch.zeros((len(instances), 0, 0), dtype=torch.bool, device=image.device)
+
+        return boxes, instances.scores, instances.pred_classes, masks
+
+    @staticmethod
+    def _rescale_boxes(boxes, image, height, width):
+        # same as box part of detector_postprocess, written with tensor ops only
+        size = torch.stack([width, height, width, height]).to(boxes.dtype)
+        # shape as tensor keeps input size dynamic in traced/exported graph
+        input_size = torch._shape_as_tensor(image)[1:].to(device=boxes.device, dtype=boxes.dtype)
+        scale = size / torch.cat([input_size.flip(0), input_size.flip(0)])
+        return torch.min(torch.max(boxes * scale, torch.zeros_like(size)), size)
+
+
+def _get_cfg(args):
 
-def _get_model(args):
-    
     cfg = get_cfg()
     cfg.merge_from_file(args.config)
-    cfg.MODEL.ROI_HEADS.SCORE_THRESH_TEST = 0.7 # set threshold for this model
+    cfg.MODEL.ROI_HEADS.SCORE_THRESH_TEST = args.score_thresh # set threshold for this model
+    cfg.MODEL.DEVICE = args.device
+
+    return cfg
+
+
+def _get_model(cfg, args):
 
     model = build_model(cfg) # returns a torch.nn.Module
     weights = args.weights if args.weights!=None else cfg.MODEL.WEIGHTS
-    
+
     DetectionCheckpointer(model).load(weights) # must load weights this way, can't use cfg.MODEL.WEIGHTS = "..."
     model.train(False) # inference mode
-    
+
     return model
 
-def _get_d2_inputs(image):
-    
-    img = cv2.imread(args.image)
-    img = np.transpose(img,(2,0,1))
-    img_tensor = torch.from_numpy(img)
-    inputs = [{"image":img_tensor}, {"image":img_tensor}] # inputs is ready
-    
-    return inputs
-    
-
-def run_script(args):
-    
-    print("start scripting")
-    model = _get_model(args)
-    
-    # Trace parts of composite RCNN model
-    # 1. BACKBONE
-    scripted = torch.jit.script(model.backbone)
-    
-    # 2. PROPOSAL NETWORK
-    #TODO: this is not implemented currently.
-    
-    return scripted
+
+def get_sample_inputs(cfg, image_path=None, device="cpu"):
+    """
+    Returns ExportWrapper inputs for image_path (random image if not set).
+    """
+
+    if image_path is not None:
+        img = cv2.imread(image_path)
+    else:
+        img = np.random.RandomState(0).randint(0, 255, (480, 640, 3), dtype=np.uint8)
+
+    height, width = img.shape[:2]
+    aug = T.ResizeShortestEdge([cfg.INPUT.MIN_SIZE_TEST, cfg.INPUT.MIN_SIZE_TEST], cfg.INPUT.MAX_SIZE_TEST)
+    img = aug.get_transform(img).apply_image(img)
+
+    return (torch.as_tensor(img, device=device),
+            torch.tensor(height, device=device), torch.tensor(width, device=device))
+
+
+def get_metadata(cfg, paste_masks=True):
+    """
+    Preprocessing parameters the serving handler needs without Detectron2 config.
+    """
+
+    return {
+        "min_size_test": cfg.INPUT.MIN_SIZE_TEST,
+        "max_size_test": cfg.INPUT.MAX_SIZE_TEST,
+        "input_format": cfg.INPUT.FORMAT,
+        "mask_on": cfg.MODEL.MASK_ON,
+        "paste_masks": paste_masks,
+        "score_thresh_test": cfg.MODEL.ROI_HEADS.SCORE_THRESH_TEST,
+        "detections_per_image": cfg.TEST.DETECTIONS_PER_IMAGE,
+    }
+
+
+def export_torchscript(model, cfg, inputs, output, freeze=True, optimize=False):
+    """
+    Traces model wrapped in ExportWrapper, optionally freezes it and saves with metadata.
+    Detectron2 modeling code is trace-friendly, so traced graph works for any input size.
+    """
+
+    wrapper = ExportWrapper(model, cfg.INPUT.FORMAT).eval()
+
+    with torch.no_grad():
+        traced = torch.jit.trace(wrapper, inputs, check_trace=False)
+
+        if freeze:
+            # inlines weights as constants and folds conv+bn, only for inference
+            traced = torch.jit.freeze(traced)
+            if optimize:
+                traced = torch.jit.optimize_for_inference(traced)
+
+        # traced graph has to reproduce eager outputs on the sample
+        _check_outputs(wrapper(*inputs), traced(*inputs), "Traced")
+
+    torch.jit.save(traced, output, _extra_files={METADATA_FILE: json.dumps(get_metadata(cfg))})
+    print(f"saved TorchScript model to {output}")
+
+    return traced
+
+
+def export_onnx(model, cfg, inputs, output, opset=11):
+    """
+    Exports model wrapped in ExportWrapper (without mask pasting) to ONNX with dynamic image size.
+    Metadata is stored in model metadata_props, requires onnx package.
+    """
+
+    import onnx
+
+    wrapper = ExportWrapper(model, cfg.INPUT.FORMAT, paste_masks=False).eval()
+
+    with torch.no_grad():
+        torch.onnx.export(wrapper, inputs, output, opset_version=opset,
+                          input_names=["image", "height", "width"], output_names=OUTPUT_NAMES,
+                          dynamic_axes={"image": {0: "input_height", 1: "input_width"},
+                                        **{name: {0: "instances"} for name in OUTPUT_NAMES}})
+
+    onnx_model = onnx.load(output)
+    onnx.checker.check_model(onnx_model)
+    for key, value in get_metadata(cfg, paste_masks=False).items():
+        prop = onnx_model.metadata_props.add()
+        prop.key, prop.value = key, json.dumps(value)
+    onnx.save(onnx_model, output)
+    print(f"saved ONNX model to {output}")
+
+
+def _check_outputs(expected, actual, name):
+
+    for output_name, e, a in zip(OUTPUT_NAMES, expected, actual):
+        if e.shape != a.shape or not torch.allclose(e.float(), a.float(), atol=1e-3):
+            raise RuntimeError(f"{name} model output {output_name} differs from eager model")
 
 
 def run_trace(args):
-    
+
     print("start tracing")
-    model = _get_model(args)
-    inputs = _get_d2_inputs(args.image)
-    
-    print(inputs)
-
-    # Trace parts of composite RCNN model
-    # 1. BACKBONE
-    images_prep = model.preprocess_image(inputs)
-    
-    output = model.backbone(images_prep.tensor)
-    traced_bcbn = torch.jit.trace(model.backbone, images_prep.tensor)
-    
-    # 2. PROPOSAL NETWORK
-    #TODO: this is not implemented currently.
-    
-    
+    cfg = _get_cfg(args)
+    inputs = get_sample_inputs(cfg, args.image, args.device)
+
+    return export_torchscript(_get_model(cfg, args), cfg, inputs, args.output, args.freeze, args.optimize)
+
+
+def run_onnx(args):
+
+    print("start ONNX export")
+    cfg = _get_cfg(args)
+    inputs = get_sample_inputs(cfg, args.image, args.device)
+
+    export_onnx(_get_model(cfg, args), cfg, inputs, args.output, args.opset)
+
 
 if __name__ == "__main__":
-    
+
     # Sagemaker configuration
     parser = argparse.ArgumentParser()
 
     parser.add_argument('--config', type=str)
-    parser.add_argument('--task', default='script', type=str)
-    parser.add_argument('--image', default=None, type=str)
+    parser.add_argument('--task', default='trace', type=str, help="trace (TorchScript) or onnx")
+    parser.add_argument('--image', default=None, type=str, help="sample image for tracing, random if not set")
     parser.add_argument('--device', default='cuda:0', type=str)
     parser.add_argument('--weights', default=None)
+    parser.add_argument('--output', default='model.ts', type=str)
+    parser.add_argument('--score-thresh', default=0.5, type=float)
+    parser.add_argument('--freeze', default=1, type=int, help="freeze graph for inference")
+    parser.add_argument('--optimize', default=0, type=int, help="run torch.jit.optimize_for_inference on frozen graph")
+    parser.add_argument('--opset', default=11, type=int, help="ONNX opset version")
     args = parser.parse_args()
-    
-    if args.task=='script':
-        run_script(args)    
-    elif args.task=='trace':
-        run_trace(args)
-        
-    
 
-         
\ No newline at end of file
+    if args.task=='trace':
+        run_trace(args)
+    elif args.task=='onnx':
+        run_onnx(args)
+    else:
+        raise ValueError(f"Unsupported task {args.task}")